@@ -98,6 +98,22 @@ def _make_main_parser():
     fill_common_parser.add_argument(
             '--move-batch-size', dest='move_batch_size', default=1, type=int,
             help='Maximum number of fill moves to process in each prediction batch.')
+    fill_common_parser.add_argument(
+            '--concurrent-regions', dest='concurrent_regions', default=1, type=int,
+            help='Number of regions each model fills at once, combining their moves '
+                 'into shared prediction batches.')
+    fill_common_parser.add_argument(
+            '--prediction-cache-bytes', dest='prediction_cache_bytes', default=None, type=int,
+            help='Byte budget for caching predictions of moves with identical inputs, '
+                 'such as when refilling or remasking regions. Disabled by default.')
+    fill_common_parser.add_argument(
+            '--prediction-cache-mask-levels', dest='prediction_cache_mask_levels', default=None, type=int,
+            help='Quantize masks to this many levels when matching cached predictions, '
+                 'rather than requiring identical masks.')
+    fill_common_parser.add_argument(
+            '--image-halo', action='store_true', dest='image_halo', default=False,
+            help='Pad the image once in tiles along its faces, rather than padding each '
+                 'block read near its boundary. Faster, but holds the padded tiles in memory.')
     fill_common_parser.add_argument(
             '--max-moves', dest='max_moves', default=None, type=int,
             help='Cancel filling after this many moves.')
@@ -287,6 +303,10 @@ def main():
                                 background_label_id=args.background_label_id,
                                 bias=args.bias,
                                 move_batch_size=args.move_batch_size,
+                                concurrent_regions=args.concurrent_regions,
+                                prediction_cache_bytes=args.prediction_cache_bytes,
+                                prediction_cache_mask_levels=args.prediction_cache_mask_levels,
+                                image_halo=args.image_halo,
                                 max_moves=args.max_moves,
                                 max_bodies=args.max_bodies,
                                 filter_seeds_by_mask=not args.ignore_mask,
@@ -307,6 +327,10 @@ def main():
                                bounds_input_file=args.bounds_input_file,
                                bias=args.bias,
                                move_batch_size=args.move_batch_size,
+                               concurrent_regions=args.concurrent_regions,
+                               prediction_cache_bytes=args.prediction_cache_bytes,
+                               prediction_cache_mask_levels=args.prediction_cache_mask_levels,
+                               image_halo=args.image_halo,
                                max_moves=args.max_moves,
                                remask_interval=args.remask_interval,
                                moves=args.bounds_num_moves)
@@ -42,10 +42,32 @@ class VolumeConfig(BaseConfig):
         Resolution to which volumes will be downsampled before processing.
     label_downsampling : str
         Method for downsampling label masks. One of 'majority' or 'conjunction'.
+    leaf_cache_bytes : int, optional
+        Byte budget for populated octree leaves of each block sparse volume.
+        Least recently used leaves beyond this budget are evicted and
+        repopulated on their next access. If not provided, populated leaves
+        are never evicted.
+    populator_threads : int, optional
+        Number of threads each block sparse volume uses to populate octree
+        leaves missing for an access concurrently. If not provided, leaves
+        are populated serially as they are reached.
+    leaf_compress_after : int, optional
+        For block sparse region masks, number of accesses after which leaves
+        not accessed in that time are compressed in memory. If not provided,
+        leaves are never compressed.
     """
     def __init__(self, settings):
         self.resolution = np.array(settings.get('resolution', [1, 1, 1]))
         self.label_downsampling = str(settings.get('label_downsampling', 'majority'))
+        self.leaf_cache_bytes = settings.get('leaf_cache_bytes', None)
+        if self.leaf_cache_bytes is not None:
+            self.leaf_cache_bytes = int(self.leaf_cache_bytes)
+        self.populator_threads = settings.get('populator_threads', None)
+        if self.populator_threads is not None:
+            self.populator_threads = int(self.populator_threads)
+        self.leaf_compress_after = settings.get('leaf_compress_after', None)
+        if self.leaf_compress_after is not None:
+            self.leaf_compress_after = int(self.leaf_compress_after)
 
 
 class ModelConfig(BaseConfig):
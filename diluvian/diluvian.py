@@ -18,6 +18,7 @@ import numpy as np
 import pytoml as toml
 import six
 from six.moves import input as raw_input
+from six.moves import queue
 from tqdm import tqdm
 
 from .config import CONFIG
@@ -33,7 +34,12 @@ from .volumes import (
         partition_volumes,
         SubvolumeBounds,
         )
-from .regions import Region
+from .regions import (
+        ImageHalo,
+        PredictionCache,
+        Region,
+        RegionFillScheduler,
+        )
 
 
 def generate_subvolume_bounds(filename, volumes, num_bounds, sparse=False, moves=None):
@@ -75,7 +81,11 @@ def fill_volume_with_model(
         reject_non_seed_components=True,
         reject_early_termination=False,
         remask_interval=None,
-        shuffle_seeds=True):
+        shuffle_seeds=True,
+        concurrent_regions=1,
+        prediction_cache_bytes=None,
+        prediction_cache_mask_levels=None,
+        image_halo=False):
     subvolume = volume.get_subvolume(SubvolumeBounds(start=np.zeros(3, dtype=np.int64), stop=volume.shape))
     # Create an output label volume.
     if resume_prediction is None:
@@ -120,52 +130,71 @@ def fill_volume_with_model(
             lock.release()
             return ret
 
-        while True:
-            seed = seeds.get(True)
-
-            if not isinstance(seed, np.ndarray):
-                logging.debug('Worker %s: got DONE', worker_id)
-                break
-
-            if is_revoked(seed):
-                results.put((seed, None))
-                continue
-
-            def stopping_callback(region):
-                stop = is_revoked(seed)
-                if reject_non_seed_components and \
-                   region.bias_against_merge and \
-                   region.mask[tuple(region.seed_vox)] < 0.5:
-                    stop = True
-                return stop
+        def stopping_callback(region):
+            stop = is_revoked(region.seed_vox)
+            if reject_non_seed_components and \
+               region.bias_against_merge and \
+               region.mask[tuple(region.seed_vox)] < 0.5:
+                stop = True
+            return stop
 
-            logging.debug('Worker %s: got seed %s', worker_id, np.array_str(seed))
-
-            # Flood-fill and get resulting mask.
-            # Allow reading outside the image volume bounds to allow segmentation
-            # to fill all the way to the boundary.
-            region = Region(image, seed_vox=seed, sparse_mask=True, block_padding='reflect')
-            region.bias_against_merge = bias
-            early_termination = False
-            try:
-                six.next(region.fill(
-                    model,
-                    move_batch_size=move_batch_size,
-                    max_moves=max_moves,
-                    progress=2 + worker_id,
-                    stopping_callback=stopping_callback,
-                    remask_interval=remask_interval))
-            except Region.EarlyFillTermination:
-                early_termination = True
-            except StopIteration:
-                pass
+        if prediction_cache_bytes:
+            prediction_cache = PredictionCache(prediction_cache_bytes, prediction_cache_mask_levels)
+        else:
+            prediction_cache = None
+
+        scheduler = RegionFillScheduler(
+            model,
+            concurrent_regions,
+            prediction_cache=prediction_cache,
+            move_batch_size=move_batch_size,
+            max_moves=max_moves,
+            progress=2 + worker_id if concurrent_regions == 1 else False,
+            stopping_callback=stopping_callback,
+            remask_interval=remask_interval)
+
+        # Pad the image once for all regions, rather than each block read near its boundary.
+        halo = ImageHalo(image, 'reflect') if image_halo else None
+
+        def seed_regions():
+            while True:
+                # Only wait for a seed if no regions are being filled.
+                try:
+                    seed = seeds.get(not scheduler.active)
+                except queue.Empty:
+                    yield None
+                    continue
+
+                if not isinstance(seed, np.ndarray):
+                    logging.debug('Worker %s: got DONE', worker_id)
+                    break
+
+                if is_revoked(seed):
+                    results.put((seed, None))
+                    continue
+
+                logging.debug('Worker %s: got seed %s', worker_id, np.array_str(seed))
+
+                # Flood-fill and get resulting mask.
+                # Allow reading outside the image volume bounds to allow segmentation
+                # to fill all the way to the boundary.
+                region = Region(image, seed_vox=seed, sparse_mask=True, block_padding='reflect',
+                                image_halo=halo)
+                region.bias_against_merge = bias
+                yield region
+
+        for region, early_termination in scheduler.fill(seed_regions()):
             if reject_early_termination and early_termination:
                 body = None
             else:
                 body = region.to_body()
-            logging.debug('Worker %s: seed %s filled', worker_id, np.array_str(seed))
+            logging.debug('Worker %s: seed %s filled', worker_id, np.array_str(region.seed_vox))
+            if prediction_cache is not None:
+                logging.debug('Worker %s: prediction cache hit rate %.3f (%s hits, %s misses, %s evictions)',
+                              worker_id, prediction_cache.hit_rate, prediction_cache.hits,
+                              prediction_cache.misses, prediction_cache.evictions)
 
-            results.put((seed, body))
+            results.put((region.seed_vox, body))
 
     # Generate seeds from volume.
     generator = preprocessing.SEED_GENERATORS[seed_generator]
@@ -211,7 +240,7 @@ def fill_volume_with_model(
 
         return total
 
-    for _ in range(min(num_seeds, num_workers * worker_prequeue)):
+    for _ in range(min(num_seeds, num_workers * max(worker_prequeue, concurrent_regions))):
         processed_seeds = queue_next_seed()
         pbar.update(processed_seeds)
 
@@ -405,7 +434,11 @@ def fill_region_with_model(
         max_moves=None,
         remask_interval=None,
         sparse=False,
-        moves=None):
+        moves=None,
+        concurrent_regions=1,
+        prediction_cache_bytes=None,
+        prediction_cache_mask_levels=None,
+        image_halo=False):
     # Late import to avoid Keras import until TF bindings are set.
     from .network import load_model
 
@@ -440,21 +473,33 @@ def fill_region_with_model(
             for k, v in six.iteritems(volumes)]
     if augment:
         subvolumes = map(augment_subvolume_generator, subvolumes)
-    regions = Roundrobin(*[Region.from_subvolume_generator(v, block_padding='reflect') for v in subvolumes])
+    regions = Roundrobin(*[Region.from_subvolume_generator(v, block_padding='reflect', image_halo=image_halo)
+                           for v in subvolumes])
 
     model = load_model(model_file, CONFIG.network)
 
-    for region in regions:
-        region.bias_against_merge = bias
-        try:
-            six.next(region.fill(
-                    model,
-                    progress=True,
-                    move_batch_size=move_batch_size,
-                    max_moves=max_moves,
-                    remask_interval=remask_interval))
-        except (StopIteration, Region.EarlyFillTermination):
-            pass
+    def biased(regions):
+        for region in regions:
+            region.bias_against_merge = bias
+            yield region
+
+    # Share predictions between the scheduled fill and animation or render
+    # refills of the same region.
+    if prediction_cache_bytes:
+        prediction_cache = PredictionCache(prediction_cache_bytes, prediction_cache_mask_levels)
+    else:
+        prediction_cache = None
+
+    scheduler = RegionFillScheduler(
+            model,
+            concurrent_regions,
+            prediction_cache=prediction_cache,
+            progress=concurrent_regions == 1,
+            move_batch_size=move_batch_size,
+            max_moves=max_moves,
+            remask_interval=remask_interval)
+
+    for region, _ in scheduler.fill(biased(regions)):
         body = region.to_body()
         viewer = region.get_viewer()
         try:
@@ -465,6 +510,10 @@ def fill_region_with_model(
                        shader=get_color_shader(2))
         except ValueError:
             logging.info('Seed not in body.')
+        if prediction_cache is not None:
+            logging.info('Prediction cache hit rate: %.3f (%s hits, %s misses, %s evictions)',
+                         prediction_cache.hit_rate, prediction_cache.hits,
+                         prediction_cache.misses, prediction_cache.evictions)
         print(viewer)
         while True:
             s = raw_input('Press Enter to continue, '
@@ -483,7 +532,8 @@ def fill_region_with_model(
                         progress=True,
                         move_batch_size=move_batch_size,
                         max_moves=max_moves,
-                        remask_interval=remask_interval)
+                        remask_interval=remask_interval,
+                        prediction_cache=prediction_cache)
                 s = raw_input("Press Enter when animation is complete...")
             elif s == 'r':
                 region.render_body()
@@ -494,7 +544,8 @@ def fill_region_with_model(
                         progress=True,
                         move_batch_size=move_batch_size,
                         max_moves=max_moves,
-                        remask_interval=remask_interval)
+                        remask_interval=remask_interval,
+                        prediction_cache=prediction_cache)
             elif s == 's':
                 body.to_swc('{}.swc'.format('_'.join(map(str, tuple(body.seed)))))
             elif s == 'v':
@@ -4,8 +4,82 @@
 
 from __future__ import division
 
+from collections import Counter, OrderedDict
+import functools
+import itertools
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
+import threading
+import zlib
+
 import numpy as np
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Guards in-flight concurrent leaf population across all octrees.
+_POPULATING_LOCK = threading.Lock()
+
+
+class _NullLock(object):
+    """Stand-in for the lock of an octree that is not thread-safe."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_LOCK = _NullLock()
+
+
+def synchronized(method):
+    """Decorate an octree volume method to hold the volume's lock, if any."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def get_uniform_value(data):
+    """Get the single value of an array, if it has only one.
+
+    NaN values are considered equal to each other.
+
+    Returns
+    -------
+    tuple
+        A single-element tuple of the value, or ``None`` if the array is not
+        uniform.
+    """
+    value = data.flat[0]
+    if value != value:
+        if np.isnan(data).all():
+            return (value,)
+    elif (data == value).all():
+        return (value,)
+    return None
+
+
+def uniform_values_equal(a, b):
+    return a == b or (a != a and b != b)
+
+
+def iter_terminal_nodes(node):
+    """Iterate leaf and uniform nodes in the subtree of a node."""
+    if isinstance(node, BranchNode):
+        for child in node.iter_children():
+            for terminal in iter_terminal_nodes(child):
+                yield terminal
+    elif node is not None:
+        yield node
+
 
 class OctreeVolume(object):
     """Octree-backed block sparse 3D array.
@@ -27,14 +101,73 @@ class OctreeVolume(object):
     populator : function, optional
         A function taking a tuple of ndarray bounds for the coordinates of
         the subvolume to populate and returning the data for that subvolume.
+    leaf_cache : LeafCache or int, optional
+        Cache bounding the memory used by leaves created by the populator,
+        which may be shared between volumes. If an int, a cache with this
+        byte budget is created for this volume only. By default populated
+        leaves are never evicted.
+    populator_threads : int, optional
+        If provided, all leaves missing for an access are populated
+        concurrently by a pool of this many threads before the access is
+        assembled. This is useful for populators that mostly wait on I/O.
+    write_back : LeafStore, optional
+        If provided, written leaves are tracked as dirty and written to this
+        store when flushed or evicted by the leaf cache, rather than being
+        kept in memory indefinitely. Leaves in the store are read from it in
+        preference to the populator when next accessed.
+    compress_after : int, optional
+        If provided, after every this many accesses to the volume, leaves
+        not accessed since the previous such sweep are compressed in memory.
+        Compressed leaves are transparently decompressed when next accessed.
+    background : optional
+        Value of unoccupied regions of the volume, such as NaN for region
+        masks. If provided, uniform regions with other values are considered
+        occupied by ``get_leaf_bounds``.
+    thread_safe : bool, optional
+        If true, the volume may be shared between threads. Writes and other
+        structural changes, such as inserting populated leaves, evicting,
+        compressing and decompressing leaves, hold a lock for the volume and
+        its mips.
+        Reads of populated leaves do not take the lock, so concurrent
+        readers do not contend, but may observe a concurrent write to the
+        same region partially. Unless ``populator_threads`` is set, a leaf
+        missing for accesses from several threads at once may be populated
+        by each of them, with only the first inserted. Writers evict leaves
+        from the leaf cache only after releasing the lock, so thread-safe
+        volumes may share a cache.
     """
 
-    def __init__(self, leaf_shape, bounds, dtype, populator=None):
+    def __init__(self, leaf_shape, bounds, dtype, populator=None, leaf_cache=None, populator_threads=None,
+                 write_back=None, compress_after=None, background=None, thread_safe=False):
         self.leaf_shape = np.asarray(leaf_shape).astype(np.int64)
         self.bounds = (np.asarray(bounds[0], dtype=np.int64),
                        np.asarray(bounds[1], dtype=np.int64))
         self.dtype = np.dtype(dtype)
         self.populator = populator
+        if leaf_cache is not None and not isinstance(leaf_cache, LeafCache):
+            leaf_cache = LeafCache(leaf_cache)
+        self.leaf_cache = leaf_cache
+        self.populator_threads = populator_threads
+        self._populator_pool = None
+        self._populating = {}
+        self._mips = {}
+        self.write_back = write_back
+        self.compress_after = compress_after
+        self._accesses = 0
+        self.background = background
+        self.thread_safe = thread_safe
+        self._lock = threading.RLock() if thread_safe else None
+        self.access_profile = None
+        # Regions written since the last flush to the write-back store.
+        self._unflushed = []
+        # Index of leaves and non-background uniform nodes, with counts of
+        # their lower and upper bounds along each axis.
+        self._index = OrderedDict()
+        self._index_bounds = ([Counter() for _ in range(3)], [Counter() for _ in range(3)])
+        self._init_nodes()
+
+    def _init_nodes(self):
+        """Create the empty node structure of this octree."""
         ceil_bounds = self.leaf_shape * \
             np.exp2(np.ceil(np.log2((self.bounds[1] - self.bounds[0]) /
                                     self.leaf_shape.astype(np.float64)))).astype(np.int64).max()
@@ -42,45 +175,1337 @@ class OctreeVolume(object):
 
     @property
     def shape(self):
-        return tuple(self.root_node.get_size())
+        return tuple(self.root_node.get_size())
+
+    @property
+    def can_populate(self):
+        return self.populator is not None or self.write_back is not None
+
+    def get_checked_np_key(self, key):
+        # Special exception for [:] for uniform assignment.
+        if isinstance(key, slice) and key.start is None and key.stop is None:
+            return self.bounds
+
+        if not hasattr(key, '__len__') or len(key) != 3:
+            raise IndexError('Octrees may only be indexed in 3 dimensions')
+
+        # Convert keys to two numpy arrays for ease.
+        npkey = (np.zeros(3, dtype=np.int64), np.zeros(3, dtype=np.int64))
+        for i, k in enumerate(key):
+            if isinstance(k, slice):
+                if k.step is not None:
+                    raise IndexError('Octrees do not yet support step slicing')
+                npkey[0][i] = k.start if k.start is not None else self.bounds[0][i]
+                npkey[1][i] = k.stop if k.stop is not None else self.bounds[1][i]
+            else:
+                npkey[0][i] = k
+                npkey[1][i] = k + 1
+
+        if np.any(np.less(npkey[0], self.bounds[0])) or \
+           np.any(np.greater(npkey[1], self.bounds[1])) or \
+           np.any(np.greater_equal(npkey[0], npkey[1])):
+            raise IndexError('Invalid indices: outside bounds or empty interval: '
+                             '{} (bounds {})'.format(str(key), str(self.bounds)))
+
+        return npkey
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Thread pools can not be pickled, and in-flight population is not
+        # meaningful in another process.
+        state['_populator_pool'] = None
+        state['_populating'] = {}
+        # Mips are populated by closures over this volume, and are rebuilt
+        # on demand.
+        state['_mips'] = {}
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.thread_safe:
+            self._lock = threading.RLock()
+
+    def locked(self):
+        """Get a context holding this volume's lock, if it is thread-safe."""
+        return _NULL_LOCK if self._lock is None else self._lock
+
+    def __getitem__(self, key):
+        npkey = self.get_checked_np_key(key)
+
+        self.begin_access(npkey)
+        chunk = self.root_node[npkey]
+        self.end_access()
+        return chunk
+
+    def __setitem__(self, key, value):
+        npkey = self.get_checked_np_key(key)
+
+        with self.locked():
+            self.begin_access(npkey)
+            self.root_node[npkey] = value
+            self.end_access(written=npkey, evict=False)
+        self.evict_leaves()
+
+    def read_into(self, key, out):
+        """Read a region of this volume into an existing array.
+
+        Parameters
+        ----------
+        key : tuple of slice
+        out : ndarray
+            Array with the shape of the region to fill.
+
+        Returns
+        -------
+        ndarray
+            ``out``.
+        """
+        npkey = self.get_checked_np_key(key)
+        if out.shape != tuple(npkey[1] - npkey[0]):
+            raise ValueError('Output shape {} does not match key shape {}'.format(
+                             out.shape, tuple(npkey[1] - npkey[0])))
+
+        self.begin_access(npkey)
+        self.root_node.read_into(npkey, out)
+        self.end_access()
+        return out
+
+    def update(self, key, func, value=None):
+        """Modify a region of this volume in place, leaf by leaf.
+
+        Parameters
+        ----------
+        key : tuple of slice
+        func : function
+            Function taking a writable view of the volume data for part of
+            the region and the corresponding part of ``value``, and modifying
+            the view in place.
+        value : ndarray or scalar, optional
+            If an array with the shape of the region, the part corresponding
+            to each view is passed to ``func``. Otherwise passed unchanged.
+        """
+        npkey = self.get_checked_np_key(key)
+
+        with self.locked():
+            self.begin_access(npkey)
+            self.root_node.update(npkey, func, value)
+            self.end_access(written=npkey, evict=False)
+        self.evict_leaves()
+
+    def reduce(self, key, leaf_func, uniform_func, combine):
+        """Reduce a region of this volume without assembling it in memory.
+
+        Parameters
+        ----------
+        key : tuple of slice
+        leaf_func : function
+            Function reducing a view of leaf data to a partial result.
+        uniform_func : function
+            Function taking a uniform value and number of voxels with that
+            value and returning a partial result.
+        combine : function
+            Function taking an iterable of partial results and returning the
+            reduction. Partial results are computed lazily, so functions like
+            ``any`` that stop early avoid traversing the rest of the region.
+        """
+        npkey = self.get_checked_np_key(key)
+
+        self.begin_access(npkey)
+        result = combine(self.iter_reduce(npkey, leaf_func, uniform_func))
+        self.end_access()
+        return result
+
+    def iter_reduce(self, npkey, leaf_func, uniform_func):
+        return self.root_node.iter_reduce(npkey, leaf_func, uniform_func)
+
+    def max(self, key=slice(None)):
+        return self.reduce(key, np.max, lambda v, n: v, lambda p: np.max(list(p)))
+
+    def nanmax(self, key=slice(None)):
+        """Maximum of a region ignoring NaNs, or NaN if all values are NaN."""
+        return self.reduce(key, lambda a: np.fmax.reduce(a, axis=None), lambda v, n: v,
+                           lambda p: np.fmax.reduce(list(p)))
+
+    def any(self, key=slice(None)):
+        return self.reduce(key, np.any, lambda v, n: bool(v), any)
+
+    def all(self, key=slice(None)):
+        return self.reduce(key, np.all, lambda v, n: bool(v), all)
+
+    def sum(self, key=slice(None)):
+        return self.reduce(key, np.sum, lambda v, n: v * n, sum)
+
+    def count_nonzero(self, key=slice(None)):
+        return self.reduce(key, np.count_nonzero, lambda v, n: n if v != 0 else 0, sum)
+
+    def profile_accesses(self, chunk_shape=None):
+        """Start recording the regions accessed in this volume.
+
+        Parameters
+        ----------
+        chunk_shape : ndarray, optional
+            See ``AccessProfile``.
+
+        Returns
+        -------
+        AccessProfile
+        """
+        self.access_profile = AccessProfile(self.bounds, chunk_shape=chunk_shape)
+        return self.access_profile
+
+    def begin_access(self, npkey):
+        """Record and prepare the leaves of a region for an access.
+
+        Parameters
+        ----------
+        npkey : tuple of ndarray
+            Checked key of the region accessed.
+        """
+        if self.access_profile is not None:
+            self.access_profile.record(npkey)
+        if self.populator_threads:
+            self.populate_concurrently(npkey)
+
+    def end_access(self, written=None, evict=True):
+        """Evict cached leaves and compress cold leaves after an access.
+
+        Parameters
+        ----------
+        written : tuple of ndarray, optional
+            Checked key of the region written by the access, if any.
+        evict : bool, optional
+            Whether to evict cached leaves. Writers holding this volume's
+            lock instead call ``evict_leaves`` once they release it.
+        """
+        if written is not None:
+            self.mark_uniform_written(written)
+            if self._mips:
+                self.invalidate_mips(written)
+        if evict:
+            self.evict_leaves()
+        if self.compress_after:
+            self._accesses += 1
+            if self._accesses >= self.compress_after:
+                self._accesses = 0
+                self.compress(cold=True)
+
+    def evict_leaves(self):
+        """Evict leaves from this volume's leaf cache until it is within budget.
+
+        Evicting a leaf takes the lock of the volume it belongs to, which may
+        be another volume sharing the cache. To avoid deadlock with writers
+        to that volume, this must not be called holding any volume's lock.
+        """
+        if self.leaf_cache is not None:
+            self.leaf_cache.evict()
+
+    @synchronized
+    def compress(self, cold=False):
+        """Compress the data of leaves in memory.
+
+        Parameters
+        ----------
+        cold : bool, optional
+            If true, only compress leaves that have not been accessed since
+            the last cold compression.
+
+        Returns
+        -------
+        int
+            Number of leaves compressed.
+        """
+        count = 0
+        for leaf in self.iter_leaves():
+            if cold and leaf.accessed:
+                leaf.accessed = False
+                continue
+            if leaf.compress():
+                count += 1
+        return count
+
+    @synchronized
+    def get_mip(self, scale, reduction=np.mean, dtype=None):
+        """Get a downsampled level of a mip pyramid of this volume.
+
+        Mip levels are octrees populated on demand from the next finer level,
+        so that access at a coarse scale does not touch this volume's leaves
+        once the corresponding mip leaves are populated. Every level has the
+        leaf shape of this volume, so that a read at any scale spans about as
+        many leaves. Writes to this volume discard the intersecting leaves of
+        its mips. Mips should not be written to.
+
+        Parameters
+        ----------
+        scale : sequence of int
+            Power-of-two downsampling factor along each axis.
+        reduction : function, optional
+            Function reducing an array along a tuple of axes, used to combine
+            each block of voxels into one. Defaults to ``numpy.mean``.
+        dtype : numpy.data-type, optional
+            Data type of the mip. Defaults to that of this volume.
+
+        Returns
+        -------
+        OctreeVolume
+            Octree of the same type as this volume whose bounds are those of
+            this volume divided by ``scale``.
+        """
+        scale = tuple(int(s) for s in scale)
+        if len(scale) != 3 or any(s < 1 or s & (s - 1) for s in scale):
+            raise ValueError('Mip scale {} is not a power of two along each of 3 axes'.format(scale))
+        if all(s == 1 for s in scale):
+            return self
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        step = tuple(2 if s > 1 else 1 for s in scale)
+        if step != scale:
+            return self.get_mip(step, reduction, dtype).get_mip(
+                    [s // t for s, t in zip(scale, step)], reduction, dtype)
+
+        mip_key = (step, reduction, dtype)
+        mip = self._mips.get(mip_key)
+        if mip is None:
+            step = np.array(step, dtype=np.int64)
+
+            def populator(bounds):
+                shape = bounds[1] - bounds[0]
+                data = self[tuple(map(slice, bounds[0] * step, bounds[1] * step))]
+                return reduction(data.reshape((shape[0], step[0], shape[1], step[1], shape[2], step[2])),
+                                 axis=(1, 3, 5))
+
+            mip = self._derived_type()(self.leaf_shape,
+                                       (-(-self.bounds[0] // step), self.bounds[1] // step),
+                                       dtype,
+                                       populator=populator,
+                                       leaf_cache=self.leaf_cache,
+                                       thread_safe=self.thread_safe)
+            # Writes to this volume discard leaves of its mips, so they share
+            # its lock.
+            mip._lock = self._lock
+            self._mips[mip_key] = mip
+        return mip
+
+    def _derived_type(self):
+        """Octree class of volumes derived from this one, such as mips."""
+        return type(self)
+
+    @synchronized
+    def invalidate_mips(self, npkey):
+        """Discard leaves of mips of this volume intersecting a region."""
+        for (step, _, _), mip in self._mips.items():
+            mip_key = (np.maximum(npkey[0] // step, mip.bounds[0]),
+                       np.minimum(-(-npkey[1] // step), mip.bounds[1]))
+            if np.any(np.greater_equal(mip_key[0], mip_key[1])):
+                continue
+            mip.discard_leaves(mip_key)
+            if mip._mips:
+                mip.invalidate_mips(mip_key)
+
+    @synchronized
+    def discard_leaves(self, npkey):
+        """Discard leaves intersecting a region, so they are repopulated.
+
+        Uniform nodes are not affected.
+
+        Parameters
+        ----------
+        npkey : tuple of ndarray
+            Checked key, as from ``get_checked_np_key``.
+        """
+        if isinstance(self.root_node, BranchNode):
+            self.root_node.discard_leaves(npkey)
+
+    def populate(self, bounds):
+        """Create a leaf with data from the populator.
+
+        Parameters
+        ----------
+        bounds : tuple of ndarray
+            Unclipped bounds of the leaf.
+
+        Returns
+        -------
+        LeafNode
+            The new leaf, whose parent must be set by the caller.
+        """
+        return self.create_populated_leaf(bounds, self.read_populator(bounds))
+
+    def read_populator(self, bounds):
+        """Read data for a leaf from the write-back store or populator.
+
+        Parameters
+        ----------
+        bounds : tuple of ndarray
+            Unclipped bounds of the leaf.
+
+        Returns
+        -------
+        ndarray
+        """
+        populator_bounds = [bounds[0].copy(), np.minimum(bounds[1], self.bounds[1])]
+        if self.write_back is not None and self.write_back.contains(populator_bounds):
+            return self.write_back.read(populator_bounds).astype(self.dtype)
+        if self.populator is None:
+            raise ValueError('Attempt to retrieve unpopulated region without octree populator')
+        return self.populator(populator_bounds).astype(self.dtype)
+
+    def create_populated_leaf(self, bounds, data):
+        leaf = LeafNode(None, bounds, data)
+        if self.leaf_cache is not None:
+            self.leaf_cache.add(leaf)
+        return leaf
+
+    def find_unpopulated(self, npkey):
+        """Find leaves spanned by a key that must be populated.
+
+        Parameters
+        ----------
+        npkey : tuple of ndarray
+            Checked key, as from ``get_checked_np_key``.
+
+        Returns
+        -------
+        list of tuple
+            For each missing leaf, its unclipped bounds and a function
+            taking the populated ``LeafNode`` and inserting it into this
+            octree if it is still missing.
+        """
+        missing = []
+        if isinstance(self.root_node, BranchNode):
+            self.root_node.find_unpopulated(npkey, missing)
+        return missing
+
+    def populate_concurrently(self, npkey):
+        """Populate all leaves spanned by a key using the populator thread pool.
+
+        Population of a leaf already in flight, for example from an access
+        in another thread, is not duplicated.
+        """
+        if not self.can_populate:
+            return
+        missing = self.find_unpopulated(npkey)
+        if not missing:
+            return
+
+        if self._populator_pool is None:
+            self._populator_pool = ThreadPool(self.populator_threads)
+        pending = []
+        with _POPULATING_LOCK:
+            for bounds, insert in missing:
+                leaf_key = tuple(bounds[0])
+                result = self._populating.get(leaf_key)
+                if result is None:
+                    result = self._populator_pool.apply_async(self.populate, (bounds,))
+                    self._populating[leaf_key] = result
+                pending.append((leaf_key, bounds, insert, result))
+
+        for leaf_key, bounds, insert, result in pending:
+            try:
+                leaf = result.get()
+            except BaseException:
+                # Let later accesses retry the leaf rather than reraise.
+                with _POPULATING_LOCK:
+                    if self._populating.get(leaf_key) is result:
+                        del self._populating[leaf_key]
+                raise
+            with _POPULATING_LOCK:
+                if self._populating.pop(leaf_key, None) is None:
+                    # Another access has already inserted this leaf.
+                    continue
+            with self.locked():
+                insert(leaf)
+
+    def close(self):
+        """Stop the populator thread pool and close the write-back store, if any.
+
+        Dirty leaves are flushed to the write-back store before it is closed,
+        after which the volume must not be accessed. Volumes without a store
+        remain usable, and start a new pool if they must populate leaves
+        concurrently again.
+        """
+        pool = self._populator_pool
+        if pool is not None:
+            self._populator_pool = None
+            pool.close()
+            pool.join()
+        if self.write_back is not None:
+            self.flush()
+            self.write_back.close()
+
+    def mark_written(self, leaf):
+        """Record that the data of a leaf in this octree has been written.
+
+        Written leaves are marked dirty. Without a write-back store, they are
+        no longer backed by the populator and so are never evicted. With one,
+        they remain evictable.
+        """
+        leaf.dirty = True
+        if self.write_back is None:
+            leaf.uncache()
+            return
+        if leaf.cache is None and self.leaf_cache is not None:
+            self.leaf_cache.add(leaf, populated=False)
+
+    def mark_uniform_written(self, npkey):
+        """Record that uniform regions within a region may have been written.
+
+        Uniform regions intersecting recorded regions are written to the
+        write-back store when flushed.
+        """
+        if self.write_back is None:
+            return
+        if self._unflushed:
+            last = self._unflushed[-1]
+            if np.all(np.less_equal(last[0], npkey[0])) and np.all(np.greater_equal(last[1], npkey[1])):
+                return
+        self._unflushed.append((npkey[0].copy(), npkey[1].copy()))
+
+    def flush_uniform(self):
+        """Write the leaves of uniform regions written since the last flush.
+
+        Returns
+        -------
+        int
+            Number of leaves written.
+        """
+        unflushed, self._unflushed = self._unflushed, []
+        if not unflushed:
+            return 0
+        written = set()
+        for bounds, node in list(self.iter_terminal_regions()):
+            if not isinstance(node, tuple):
+                continue
+            for key in unflushed:
+                lower = np.maximum(bounds[0], key[0])
+                upper = np.minimum(bounds[1], key[1])
+                if np.any(np.greater_equal(lower, upper)):
+                    continue
+                # Uniform regions are aligned to leaves, so any leaf of one
+                # intersecting a written region was written entirely.
+                lo = (lower - self.bounds[0]) // self.leaf_shape
+                hi = -((self.bounds[0] - upper) // self.leaf_shape)
+                for idx in itertools.product(*[range(lo[n], hi[n]) for n in range(3)]):
+                    if idx in written:
+                        continue
+                    written.add(idx)
+                    leaf_lower = self.bounds[0] + np.array(idx, dtype=np.int64) * self.leaf_shape
+                    leaf_upper = np.minimum(leaf_lower + self.leaf_shape, self.bounds[1])
+                    self.write_back.write((leaf_lower, leaf_upper),
+                                          np.full(tuple(leaf_upper - leaf_lower), node[0], dtype=self.dtype))
+        return len(written)
+
+    def flush_leaf(self, leaf):
+        """Write a dirty leaf to the write-back store."""
+        clipped = np.minimum(leaf.bounds[1], self.bounds[1])
+        size = clipped - leaf.bounds[0]
+        self.write_back.write((leaf.bounds[0], clipped), leaf.read_data()[:size[0], :size[1], :size[2]])
+        leaf.dirty = False
+
+    @synchronized
+    def flush(self):
+        """Write all dirty leaves to the write-back store.
+
+        Leaves of uniform regions written since the last flush, including
+        leaves made uniform by ``compact``, are written to the store with
+        their uniform value, but remain uniform in this octree.
+
+        Returns
+        -------
+        int
+            Number of leaves written.
+        """
+        if self.write_back is None:
+            raise ValueError('Octree has no write-back store to flush to')
+        count = self.flush_uniform()
+        for leaf in self.iter_leaves():
+            if leaf.dirty:
+                self.flush_leaf(leaf)
+                count += 1
+        return count
+
+    def is_occupied(self, node):
+        return isinstance(node, LeafNode) or \
+            (self.background is not None and not uniform_values_equal(node.value, self.background))
+
+    def index_nodes(self, node, add=True):
+        """Add or remove the terminal nodes of a subtree from the leaf index."""
+        for terminal in iter_terminal_nodes(node):
+            if not self.is_occupied(terminal):
+                continue
+            if add:
+                if terminal in self._index:
+                    continue
+                self._index[terminal] = None
+            elif self._index.pop(terminal, False) is False:
+                continue
+            for bound, counters in zip(terminal.bounds, self._index_bounds):
+                for n, counter in enumerate(counters):
+                    if add:
+                        counter[bound[n]] += 1
+                    else:
+                        counter[bound[n]] -= 1
+                        if not counter[bound[n]]:
+                            del counter[bound[n]]
+
+    def reindex(self, node, replacement):
+        self.index_nodes(node, add=False)
+        self.index_nodes(replacement)
+        # Leaves of the replaced subtree are no longer in this octree, so
+        # must not be evicted from it.
+        for leaf in node.iter_leaves():
+            leaf.uncache()
+
+    def iter_leaves(self):
+        """Iterator over all non-uniform leaf nodes.
+
+        Yields
+        ------
+        LeafNode
+        """
+        for node in list(self._index):
+            if isinstance(node, LeafNode):
+                yield node
+
+    def get_leaf_uniform_value(self, leaf):
+        """Get the single value of a leaf's data within the volume, if any.
+
+        See ``get_uniform_value``.
+        """
+        size = np.minimum(leaf.bounds[1], self.bounds[1]) - leaf.bounds[0]
+        return get_uniform_value(leaf.read_data()[:size[0], :size[1], :size[2]])
+
+    @synchronized
+    def compact(self):
+        """Collapse leaves and branches with uniform data into uniform nodes.
+
+        Leaves whose data has become uniform are replaced by uniform leaves,
+        and branches whose children are all uniform with the same value are
+        replaced by uniform branches. Branches with unpopulated children are
+        not collapsed.
+
+        Returns
+        -------
+        int
+            Number of leaves made uniform.
+        """
+        if not isinstance(self.root_node, BranchNode):
+            return 0
+        return self.root_node.compact()[0]
+
+    def get_leaf_bounds(self):
+        """Get the bounding box of occupied regions of the volume.
+
+        Occupied regions are leaves and, if the volume has a background
+        value, uniform regions with a different value.
+
+        Returns
+        -------
+        list of ndarray
+        """
+        lower, upper = self._index_bounds
+        if lower[0]:
+            bounds = [np.array([min(c) for c in lower], dtype=np.int64),
+                      np.array([max(c) for c in upper], dtype=np.int64)]
+        else:
+            bounds = [np.array(self.bounds[1]), np.array(self.bounds[0])]
+
+        bounds[0] = np.maximum(bounds[0], self.bounds[0])
+        bounds[1] = np.minimum(bounds[1], self.bounds[1])
+
+        return bounds
+
+    @classmethod
+    def from_dense(cls, array, leaf_shape, default=None, offset=None, **kwargs):
+        """Build an octree from a dense array.
+
+        Rather than assigning the array through ``__setitem__``, leaves are
+        built directly from blocks of the array in one pass. Blocks with a
+        single value are stored as uniform nodes, which are merged where
+        possible, rather than as leaves.
+
+        Parameters
+        ----------
+        array : ndarray
+        leaf_shape : tuple of int or ndarray
+            Shape of tree leaves in voxels.
+        default : optional
+            Background value of the volume, unless ``background`` is given.
+        offset : ndarray, optional
+            Lower bound of the volume. Defaults to the origin.
+        **kwargs
+            Other arguments to the constructor of the octree.
+
+        Returns
+        -------
+        OctreeVolume
+            Octree of this class with the shape and dtype of the array.
+        """
+        offset = np.zeros(3, dtype=np.int64) if offset is None else np.asarray(offset, dtype=np.int64)
+        if default is not None:
+            kwargs.setdefault('background', default)
+        volume = cls(leaf_shape, (offset, offset + array.shape), array.dtype, **kwargs)
+        volume.build_dense(array)
+        return volume
+
+    def build_dense(self, array):
+        """Build the nodes of this empty octree from a dense array.
+
+        See ``from_dense``.
+        """
+        value = self.root_node.build_dense(array)
+        if value is not None:
+            self.root_node = UniformBranchNode(self, self.root_node.bounds, self.dtype, value[0],
+                                               clip_bound=self.root_node.clip_bound)
+        self.index_nodes(self.root_node)
+
+    def to_dense(self, out=None, bounds=None):
+        """Read a region of this volume into a dense array.
+
+        Leaf data is copied directly into the output array.
+
+        Parameters
+        ----------
+        out : ndarray, optional
+            Array with the shape of the region to fill. Allocated if not
+            provided.
+        bounds : tuple of ndarray, optional
+            Lower and upper bounds of the region. Defaults to the volume
+            bounds.
+
+        Returns
+        -------
+        ndarray
+        """
+        if bounds is None:
+            bounds = self.bounds
+        if out is None:
+            out = np.empty(tuple(np.subtract(bounds[1], bounds[0])), dtype=self.dtype)
+        return self.read_into(tuple(map(slice, bounds[0], bounds[1])), out)
+
+    def map_copy(self, dtype, leaf_map, uniform_map):
+        """Create a copy of this octree by mapping node data.
+
+        Note that because leaves and uniform nodes can have separate mapping,
+        the ranges of this tree and the copied tree may not be bijective.
+
+        Populators are not copied.
+
+        Parameters
+        ----------
+        dtype : numpy.data-type
+            Data type for the constructed copy
+        leaf_map : function
+            Function mapping leaf node data for the constructed copy.
+        uniform_map : function
+            Function mapping uniform node values.
+
+        Returns
+        -------
+        OctreeVolume
+            Copied octree with the same structure as this octree.
+        """
+        background = None if self.background is None else uniform_map(self.background)
+        copy = OctreeVolume(self.leaf_shape, self.bounds, dtype, compress_after=self.compress_after,
+                            background=background)
+        copy.root_node = self.root_node.map_copy(copy, leaf_map, uniform_map)
+        copy.index_nodes(copy.root_node)
+        return copy
+
+    def iter_terminal_regions(self, unpopulated=False):
+        """Iterate the leaves and uniform regions of this volume.
+
+        Parameters
+        ----------
+        unpopulated : bool, optional
+            If true, also include the leaves that are not populated, if this
+            volume can populate them, so that every voxel of the volume is in
+            some region. Otherwise unpopulated regions are not included.
+
+        Yields
+        ------
+        tuple of ndarray
+            Bounds of the region, clipped to the volume bounds.
+        LeafNode or tuple
+            The leaf, a single-element tuple of the uniform value, or
+            ``None`` for an unpopulated leaf, whose data must be read through
+            the volume.
+        """
+        for node in iter_terminal_nodes(self.root_node):
+            bounds = (node.bounds[0], np.minimum(node.bounds[1], self.bounds[1]))
+            yield bounds, (node if isinstance(node, LeafNode) else (node.value,))
+        if unpopulated:
+            for bounds in self.iter_unpopulated_regions():
+                yield bounds, None
+
+    def iter_unpopulated_regions(self):
+        """Iterate the bounds of leaves of this volume that are not populated.
+
+        Nothing is yielded if this volume can not populate leaves, since its
+        unpopulated regions can not be read.
+
+        Yields
+        ------
+        tuple of ndarray
+            Bounds of the leaf, clipped to the volume bounds.
+        """
+        if not self.can_populate:
+            return
+        for bounds, _ in self.find_unpopulated(self.bounds):
+            yield bounds[0], np.minimum(bounds[1], self.bounds[1])
+
+    def _read_operand(self, operand, bounds):
+        """Read a region of an octree or array spanning this volume."""
+        if isinstance(operand, OctreeVolume):
+            return operand[tuple(map(slice, bounds[0], bounds[1]))]
+        return operand[tuple(map(slice, bounds[0] - self.bounds[0], bounds[1] - self.bounds[0]))]
+
+    def _get_operand_uniform_truth(self, operand, bounds):
+        """Get whether a region of an operand is all true or all false, if either.
+
+        Returns
+        -------
+        tuple
+            A single-element tuple of the truth of the region, or ``None``
+            if it is mixed.
+        """
+        if isinstance(operand, OctreeVolume):
+            key = tuple(map(slice, bounds[0], bounds[1]))
+            if not operand.any(key):
+                return (False,)
+            if operand.all(key):
+                return (True,)
+            return None
+        block = self._read_operand(operand, bounds)
+        if not block.any():
+            return (False,)
+        if block.all():
+            return (True,)
+        return None
+
+    def _set_operation(self, other, op):
+        """Combine the truth of this volume and another region by region.
+
+        Parameters
+        ----------
+        other : OctreeVolume or ndarray
+            Octree with the same bounds as this volume, or array with its
+            shape.
+        op : function
+            Elementwise boolean function of this volume and ``other``.
+
+        Returns
+        -------
+        OctreeVolume
+            Boolean octree of the result, with background ``False``.
+        """
+        if isinstance(other, OctreeVolume):
+            if not all(np.array_equal(a, b) for a, b in zip(self.bounds, other.bounds)):
+                raise ValueError('Octrees must have the same bounds for set operations')
+        elif other.shape != self.shape:
+            raise ValueError('Array shape {} does not match octree shape {}'.format(other.shape, self.shape))
+
+        result = self._derived_type()(self.leaf_shape, self.bounds, np.bool_, background=False)
+        result[:] = False
+        for bounds, node in list(self.iter_terminal_regions(unpopulated=True)):
+            key = tuple(map(slice, bounds[0], bounds[1]))
+            if not isinstance(node, tuple):
+                size = bounds[1] - bounds[0]
+                data = self[key] if node is None else node.data[:size[0], :size[1], :size[2]]
+                block = op(data.astype(np.bool_), self._read_operand(other, bounds).astype(np.bool_))
+            else:
+                value = bool(node[0])
+                if op(value, False) == op(value, True):
+                    # The result does not depend on the other operand, such
+                    # as for uniform false regions of a conjunction.
+                    block = op(value, False)
+                else:
+                    truth = self._get_operand_uniform_truth(other, bounds)
+                    if truth is not None:
+                        block = op(value, truth[0])
+                    else:
+                        block = op(value, self._read_operand(other, bounds).astype(np.bool_))
+            if np.any(block):
+                result[key] = block
+        return result
+
+    def logical_and(self, other):
+        """Intersection of the truth of this volume and an octree or array.
+
+        Regions of this volume that are uniformly false are not read from
+        ``other``, so the cost is proportional to the occupied regions of
+        this volume. Leaves of this volume that are not yet populated are
+        read through its populator.
+
+        Parameters
+        ----------
+        other : OctreeVolume or ndarray
+            Octree with the same bounds as this volume, or array with its
+            shape.
+
+        Returns
+        -------
+        OctreeVolume
+            Boolean octree of the result, with background ``False``.
+        """
+        return self._set_operation(other, np.logical_and)
+
+    def logical_or(self, other):
+        """Union of the truth of this volume and an octree or array.
+
+        See ``logical_and``.
+        """
+        return self._set_operation(other, np.logical_or)
+
+    def logical_andnot(self, other):
+        """Difference of the truth of this volume and an octree or array.
+
+        See ``logical_and``.
+        """
+        return self._set_operation(other, lambda a, b: np.logical_and(a, np.logical_not(b)))
+
+    def masked_assign(self, mask, value):
+        """Assign a value to voxels of this volume where a mask is true.
+
+        Regions of the mask octree that are uniformly false are skipped.
+        Unpopulated leaves of the mask octree, or of this volume for an
+        array mask, are read through their populators.
+
+        Parameters
+        ----------
+        mask : OctreeVolume or ndarray
+            Octree with the same bounds as this volume, or array with its
+            shape.
+        value : scalar, OctreeVolume or ndarray
+            Value to assign, or octree or array spanning this volume from
+            which values are assigned.
+
+        Returns
+        -------
+        int
+            Number of voxels assigned.
+        """
+        if isinstance(mask, OctreeVolume):
+            regions = list(mask.iter_terminal_regions(unpopulated=True))
+        else:
+            regions = list(self.iter_terminal_regions(unpopulated=True))
+        count = 0
+        for bounds, node in regions:
+            key = tuple(map(slice, bounds[0], bounds[1]))
+            if not isinstance(mask, OctreeVolume):
+                block = self._read_operand(mask, bounds)
+                truth = get_uniform_value(block)
+            elif node is None:
+                block = mask[key]
+                truth = None
+            elif isinstance(node, LeafNode):
+                size = bounds[1] - bounds[0]
+                block = node.data[:size[0], :size[1], :size[2]]
+                truth = None
+            else:
+                truth = node
+            if truth is not None:
+                if not truth[0]:
+                    continue
+                self[key] = value if np.isscalar(value) else self._read_operand(value, bounds)
+                count += int(np.prod(bounds[1] - bounds[0]))
+                continue
+
+            block = block.astype(np.bool_)
+            if not block.any():
+                continue
+            if np.isscalar(value):
+                self.update(key, lambda view, m: np.copyto(view, value, where=m), block)
+            else:
+                data = self.to_dense(bounds=bounds)
+                np.copyto(data, self._read_operand(value, bounds), where=block)
+                self[key] = data
+            count += int(np.count_nonzero(block))
+        return count
+
+    def fullness(self):
+        potential_leaves = np.prod(np.ceil(np.true_divide(self.bounds[1] - self.bounds[0], self.leaf_shape)))
+        return self.root_node.count_leaves() / float(potential_leaves)
+
+    def get_volume(self):
+        return self
+
+    def replace_child(self, child, replacement):
+        if child != self.root_node:
+            raise ValueError('Attempt to replace unknown child')
+
+        self.root_node = replacement
+
+
+class FlatOctreeVolume(OctreeVolume):
+    """Block sparse 3D array with a flat, hash-indexed leaf store.
+
+    This has the same interface and semantics as ``OctreeVolume``, but rather
+    than resolving each access by descending through branch nodes, leaves are
+    kept in a dict keyed by their integer coordinates in the leaf grid.
+    Uniform regions are kept in a separate dict keyed by octree level and
+    grid coordinates at that level, so that uniform assignment to aligned
+    blocks does not need to materialize leaves. The implicit octree over the
+    leaf grid is identical to that of ``OctreeVolume``, so leaf bounds,
+    uniform splitting and fullness behave the same.
+
+    Parameters
+    ----------
+    leaf_shape : tuple of int or ndarray
+        Shape of tree leaves in voxels.
+    bounds : tuple of tuple of int or ndarray
+        The lower and upper coordinate bounds of the volume, in voxels.
+    dtype : numpy.data-type
+    populator : function, optional
+        A function taking a tuple of ndarray bounds for the coordinates of
+        the subvolume to populate and returning the data for that subvolume.
+    leaf_cache : LeafCache or int, optional
+        See ``OctreeVolume``.
+    populator_threads : int, optional
+        See ``OctreeVolume``.
+    write_back : LeafStore, optional
+        See ``OctreeVolume``.
+    compress_after : int, optional
+        See ``OctreeVolume``.
+    background : optional
+        See ``OctreeVolume``.
+    thread_safe : bool, optional
+        See ``OctreeVolume``.
+    """
+
+    def _init_nodes(self):
+        self.grid_shape = tuple(int(x) for x in
+                                -((self.bounds[0] - self.bounds[1]) // self.leaf_shape))
+        self.depth = int(np.ceil(np.log2(max(self.grid_shape))))
+        self._origin = tuple(int(x) for x in self.bounds[0])
+        self._clip = tuple(int(x) for x in self.bounds[1])
+        self._leaf = tuple(int(x) for x in self.leaf_shape)
+        # Map from leaf grid coordinates to ``LeafNode``.
+        self.leaves = {}
+        # Map from (level, i, j, k) grid coordinates to uniform values, where
+        # level 0 is the leaf level.
+        self.uniform = {}
+
+    @property
+    def shape(self):
+        return tuple(self.bounds[1] - self.bounds[0])
 
-    def get_checked_np_key(self, key):
-        # Special exception for [:] for uniform assignment.
-        if isinstance(key, slice) and key.start is None and key.stop is None:
-            return self.bounds
+    def _leaf_range(self, key):
+        """Inclusive lower and exclusive upper leaf grid coordinates of a key."""
+        lo = [(key[0][n] - self._origin[n]) // self._leaf[n] for n in range(3)]
+        hi = [(key[1][n] - 1 - self._origin[n]) // self._leaf[n] + 1 for n in range(3)]
+        return lo, hi
 
-        if not hasattr(key, '__len__') or len(key) != 3:
-            raise IndexError('Octrees may only be indexed in 3 dimensions')
+    def _leaf_bounds(self, idx):
+        lo = np.array([self._origin[n] + idx[n] * self._leaf[n] for n in range(3)], dtype=np.int64)
+        return (lo, lo + self.leaf_shape)
 
-        # Convert keys to two numpy arrays for ease.
-        npkey = (np.zeros(3, dtype=np.int64), np.zeros(3, dtype=np.int64))
-        for i, k in enumerate(key):
-            if isinstance(k, slice):
-                if k.step is not None:
-                    raise IndexError('Octrees do not yet support step slicing')
-                npkey[0][i] = k.start if k.start is not None else self.bounds[0][i]
-                npkey[1][i] = k.stop if k.stop is not None else self.bounds[1][i]
+    def _get_uniform(self, idx):
+        """Find the level and value of the uniform block containing a leaf.
+
+        Returns
+        -------
+        tuple
+            Level and value of the uniform block, or ``None`` if the leaf is
+            not in any uniform block.
+        """
+        uniform = self.uniform
+        if not uniform:
+            return None
+        i, j, k = idx
+        for level in range(self.depth + 1):
+            ukey = (level, i >> level, j >> level, k >> level)
+            if ukey in uniform:
+                return level, uniform[ukey]
+        return None
+
+    def _get_node(self, idx):
+        """Get the leaf or uniform value for a leaf grid coordinate.
+
+        Populates the leaf if it has no data.
+
+        Returns
+        -------
+        LeafNode or tuple
+            Either the leaf node, or a single-element tuple of its uniform
+            value.
+        """
+        leaf = self.leaves.get(idx)
+        if leaf is not None:
+            return leaf
+        uniform = self._get_uniform(idx)
+        if uniform is not None:
+            return (uniform[1],)
+        return self._populate_leaf(idx)
+
+    def _populate_leaf(self, idx):
+        leaf = self.populate(self._leaf_bounds(idx))
+        with self.locked():
+            existing = self.leaves.get(idx)
+            if existing is None:
+                uniform = self._get_uniform(idx)
+                if uniform is not None:
+                    existing = (uniform[1],)
+            if existing is not None:
+                # Populated or written concurrently by another thread.
+                leaf.uncache()
+                return existing
+            leaf.parent = self
+            self.leaves[idx] = leaf
+        return leaf
+
+    def _make_leaf_inserter(self, idx):
+        def insert(leaf):
+            if idx not in self.leaves and self._get_uniform(idx) is None:
+                leaf.parent = self
+                self.leaves[idx] = leaf
             else:
-                npkey[0][i] = k
-                npkey[1][i] = k + 1
+                leaf.uncache()
+        return insert
+
+    def find_unpopulated(self, npkey):
+        key = (npkey[0].tolist(), npkey[1].tolist())
+        lo, hi = self._leaf_range(key)
+        missing = []
+        for idx in itertools.product(*[range(lo[n], hi[n]) for n in range(3)]):
+            if idx not in self.leaves and self._get_uniform(idx) is None:
+                missing.append((self._leaf_bounds(idx), self._make_leaf_inserter(idx)))
+        return missing
+
+    def _drop_leaf(self, idx):
+        leaf = self.leaves.pop(idx, None)
+        if leaf is not None:
+            leaf.uncache()
+
+    def _materialize_leaf(self, idx):
+        """Get a dense leaf for a leaf grid coordinate, splitting uniform blocks."""
+        leaf = self.leaves.get(idx)
+        if leaf is not None:
+            return leaf
+        uniform = self._get_uniform(idx)
+        if uniform is None:
+            return self._populate_leaf(idx)
+        self._split_uniform(idx, *uniform)
+        value = self.uniform.pop((0,) + tuple(idx))
+        leaf_bounds = self._leaf_bounds(idx)
+        data = np.full(tuple(np.minimum(leaf_bounds[1], self.bounds[1]) - leaf_bounds[0]), value, dtype=self.dtype)
+        leaf = LeafNode(self, leaf_bounds, data)
+        self.leaves[idx] = leaf
+        return leaf
+
+    def _split_uniform(self, idx, level, value, to_level=0):
+        """Split a uniform block into uniform children down to a level.
+
+        Mirrors replacement of ``UniformBranchNode`` by uniform children in
+        ``OctreeVolume``: children entirely outside the volume are omitted.
+        """
+        for split_level in range(level, to_level, -1):
+            ukey = (split_level,) + tuple(x >> split_level for x in idx)
+            del self.uniform[ukey]
+            child_level = split_level - 1
+            for offset in itertools.product((0, 1), repeat=3):
+                child = tuple(2 * ukey[n + 1] + offset[n] for n in range(3))
+                if any((child[n] << child_level) >= self.grid_shape[n] for n in range(3)):
+                    continue
+                self.uniform[(child_level,) + child] = value
+
+    def _clear_block(self, level, block):
+        """Remove all leaves and uniform values contained in a block."""
+        if level == 0:
+            self._drop_leaf(block)
+            self.uniform.pop((0,) + block, None)
+            return
 
-        if np.any(np.less(npkey[0], self.bounds[0])) or \
-           np.any(np.greater(npkey[1], self.bounds[1])) or \
-           np.any(np.greater_equal(npkey[0], npkey[1])):
-            raise IndexError('Invalid indices: outside bounds or empty interval: '
-                             '{} (bounds {})'.format(str(key), str(self.bounds)))
+        def contained(ukey):
+            shift = level - ukey[0]
+            return shift >= 0 and all((ukey[n + 1] >> shift) == block[n] for n in range(3))
 
-        return npkey
+        for idx in [idx for idx in self.leaves if contained((0,) + idx)]:
+            self._drop_leaf(idx)
+        for ukey in [ukey for ukey in self.uniform if contained(ukey)]:
+            del self.uniform[ukey]
+
+    def _aligned_blocks(self, lo, hi, level=None, block=(0, 0, 0)):
+        """Decompose a leaf grid range into maximal aligned octree blocks.
+
+        Yields
+        ------
+        tuple
+            Level and block coordinates of each octree block fully contained
+            in the leaf grid range (after clipping the range to the grid).
+        """
+        if level is None:
+            level = self.depth
+        block_lo = [b << level for b in block]
+        block_hi = [min((b + 1) << level, g) for b, g in zip(block, self.grid_shape)]
+        if any(block_lo[n] >= hi[n] or block_hi[n] <= lo[n] for n in range(3)):
+            return
+        if all(block_lo[n] >= lo[n] and block_hi[n] <= hi[n] for n in range(3)):
+            yield level, block
+            return
+        for offset in itertools.product((0, 1), repeat=3):
+            for b in self._aligned_blocks(lo, hi, level - 1, tuple(2 * block[n] + offset[n] for n in range(3))):
+                yield b
+
+    def _covered_leaf_range(self, key):
+        """Leaf grid range of leaves whose clipped extent is fully covered by a key."""
+        lo = [-((self._origin[n] - key[0][n]) // self._leaf[n]) for n in range(3)]
+        hi = [(key[1][n] - self._origin[n]) // self._leaf[n] for n in range(3)]
+        for n in range(3):
+            if key[1][n] == self._clip[n]:
+                hi[n] = self.grid_shape[n]
+        return lo, hi
+
+    def _leaf_slices(self, idx, key):
+        """Slices of a leaf's data and of a key-shaped chunk for their intersection."""
+        leaf_sl = []
+        chunk_sl = []
+        for n in range(3):
+            leaf_min = self._origin[n] + idx[n] * self._leaf[n]
+            start = max(leaf_min, key[0][n])
+            stop = min(leaf_min + self._leaf[n], key[1][n])
+            leaf_sl.append(slice(start - leaf_min, stop - leaf_min))
+            chunk_sl.append(slice(start - key[0][n], stop - key[0][n]))
+        return tuple(leaf_sl), tuple(chunk_sl)
 
     def __getitem__(self, key):
         npkey = self.get_checked_np_key(key)
+        self.begin_access(npkey)
+        try:
+            key = (npkey[0].tolist(), npkey[1].tolist())
+            lo, hi = self._leaf_range(key)
+
+            if all(hi[n] - lo[n] == 1 for n in range(3)):
+                node = self._get_node(tuple(lo))
+                if isinstance(node, tuple):
+                    return np.full(tuple(npkey[1] - npkey[0]), node[0], dtype=self.dtype)
+                node.touch()
+                return node.data[self._leaf_slices(tuple(lo), key)[0]]
+
+            chunk = np.empty(tuple(npkey[1] - npkey[0]), self.dtype)
+            self._read_leaves(key, lo, hi, chunk)
+            return chunk
+        finally:
+            self.end_access()
+
+    def _read_leaves(self, key, lo, hi, out):
+        for idx in itertools.product(*[range(lo[n], hi[n]) for n in range(3)]):
+            node = self._get_node(idx)
+            leaf_sl, chunk_sl = self._leaf_slices(idx, key)
+            if isinstance(node, tuple):
+                out[chunk_sl] = node[0]
+            else:
+                node.touch()
+                out[chunk_sl] = node.data[leaf_sl]
+
+    def read_into(self, key, out):
+        """Read a region of this volume into an existing array.
+
+        See ``OctreeVolume.read_into``.
+        """
+        npkey = self.get_checked_np_key(key)
+        if out.shape != tuple(npkey[1] - npkey[0]):
+            raise ValueError('Output shape {} does not match key shape {}'.format(
+                             out.shape, tuple(npkey[1] - npkey[0])))
+        self.begin_access(npkey)
+        key = (npkey[0].tolist(), npkey[1].tolist())
+        lo, hi = self._leaf_range(key)
+        self._read_leaves(key, lo, hi, out)
+        self.end_access()
+        return out
+
+    def iter_reduce(self, npkey, leaf_func, uniform_func):
+        key = (npkey[0].tolist(), npkey[1].tolist())
+        lo, hi = self._leaf_range(key)
+        for idx in itertools.product(*[range(lo[n], hi[n]) for n in range(3)]):
+            node = self._get_node(idx)
+            leaf_sl, chunk_sl = self._leaf_slices(idx, key)
+            if isinstance(node, tuple):
+                yield uniform_func(node[0], int(np.prod([s.stop - s.start for s in chunk_sl])))
+            else:
+                node.touch()
+                yield leaf_func(node.data[leaf_sl])
 
-        return self.root_node[npkey]
+    @synchronized
+    def discard_leaves(self, npkey):
+        key = (npkey[0].tolist(), npkey[1].tolist())
+        lo, hi = self._leaf_range(key)
+        for idx in itertools.product(*[range(lo[n], hi[n]) for n in range(3)]):
+            self._drop_leaf(idx)
 
-    def __setitem__(self, key, value):
+    def update(self, key, func, value=None):
+        """Modify a region of this volume in place, leaf by leaf.
+
+        See ``OctreeVolume.update``.
+        """
         npkey = self.get_checked_np_key(key)
+        with self.locked():
+            self._update(npkey, func, value)
+            self.end_access(written=npkey, evict=False)
+        self.evict_leaves()
+
+    def _update(self, npkey, func, value):
+        self.begin_access(npkey)
+        key = (npkey[0].tolist(), npkey[1].tolist())
+        lo, hi = self._leaf_range(key)
+        is_array = isinstance(value, np.ndarray)
+
+        for idx in itertools.product(*[range(lo[n], hi[n]) for n in range(3)]):
+            leaf_sl, chunk_sl = self._leaf_slices(idx, key)
+            leaf = self._materialize_leaf(idx)
+            self.mark_written(leaf)
+            func(leaf.data[leaf_sl], value[chunk_sl] if is_array else value)
 
-        self.root_node[npkey] = value
+    def __setitem__(self, key, value):
+        npkey = self.get_checked_np_key(key)
+        with self.locked():
+            self._setitem(npkey, value)
+            self.end_access(written=npkey, evict=False)
+        self.evict_leaves()
+
+    def _setitem(self, npkey, value):
+        self.begin_access(npkey)
+        key = (npkey[0].tolist(), npkey[1].tolist())
+        lo, hi = self._leaf_range(key)
+        cov_lo, cov_hi = self._covered_leaf_range(key)
+        is_array = isinstance(value, np.ndarray)
+
+        covered = set()
+        if (not hasattr(value, '__len__') or len(value) == 1) and \
+           all(cov_lo[n] < cov_hi[n] for n in range(3)):
+            # Uniform assignment to aligned blocks fully covered by the key.
+            for level, block in self._aligned_blocks(cov_lo, cov_hi):
+                idx = tuple(b << level for b in block)
+                uniform = self._get_uniform(idx)
+                if uniform is not None and uniform[0] > level:
+                    self._split_uniform(idx, uniform[0], uniform[1], to_level=level)
+                self._clear_block(level, block)
+                self.uniform[(level,) + block] = value
+                covered.update(itertools.product(*[
+                    range(block[n] << level, min((block[n] + 1) << level, self.grid_shape[n]))
+                    for n in range(3)]))
+
+        for idx in itertools.product(*[range(lo[n], hi[n]) for n in range(3)]):
+            if idx in covered:
+                continue
+            leaf_sl, chunk_sl = self._leaf_slices(idx, key)
+            leaf = self.leaves.get(idx)
+            if leaf is None and is_array and all(cov_lo[n] <= idx[n] < cov_hi[n] for n in range(3)):
+                # Leaves entirely overwritten need not be populated.
+                uniform = self._get_uniform(idx)
+                if uniform is not None:
+                    self._split_uniform(idx, *uniform)
+                    del self.uniform[(0,) + idx]
+                leaf = LeafNode(self, self._leaf_bounds(idx), np.asarray(value[chunk_sl], dtype=self.dtype))
+                self.leaves[idx] = leaf
+                self.mark_written(leaf)
+                continue
+            if leaf is None:
+                leaf = self._materialize_leaf(idx)
+            self.mark_written(leaf)
+            if is_array:
+                leaf.data[leaf_sl] = value[chunk_sl]
+            else:
+                leaf.data[leaf_sl] = value
 
     def iter_leaves(self):
         """Iterator over all non-uniform leaf nodes.
@@ -89,14 +1514,36 @@ class OctreeVolume(object):
         ------
         LeafNode
         """
-        for leaf in self.root_node.iter_leaves():
+        for leaf in list(self.leaves.values()):
             yield leaf
 
+    def reindex(self, node, replacement):
+        # The leaf and uniform dicts are themselves the index.
+        pass
+
     def get_leaf_bounds(self):
-        bounds = [np.array(self.bounds[1]), np.array(self.bounds[0])]
-        for leaf in self.iter_leaves():
-            bounds[0] = np.minimum(bounds[0], leaf.bounds[0])
-            bounds[1] = np.maximum(bounds[1], leaf.bounds[1])
+        """Get the bounding box of occupied regions of the volume.
+
+        See ``OctreeVolume.get_leaf_bounds``.
+        """
+        lo = [None] * 3
+        hi = [None] * 3
+        blocks = [(0, idx) for idx in self.leaves]
+        if self.background is not None:
+            blocks.extend((ukey[0], ukey[1:]) for ukey, value in self.uniform.items()
+                          if not uniform_values_equal(value, self.background))
+        for level, block in blocks:
+            for n in range(3):
+                block_lo = block[n] << level
+                block_hi = (block[n] + 1) << level
+                lo[n] = block_lo if lo[n] is None else min(lo[n], block_lo)
+                hi[n] = block_hi if hi[n] is None else max(hi[n], block_hi)
+
+        if blocks:
+            bounds = [self.bounds[0] + np.array(lo, dtype=np.int64) * self.leaf_shape,
+                      self.bounds[0] + np.array(hi, dtype=np.int64) * self.leaf_shape]
+        else:
+            bounds = [np.array(self.bounds[1]), np.array(self.bounds[0])]
 
         bounds[0] = np.maximum(bounds[0], self.bounds[0])
         bounds[1] = np.minimum(bounds[1], self.bounds[1])
@@ -106,41 +1553,755 @@ class OctreeVolume(object):
     def map_copy(self, dtype, leaf_map, uniform_map):
         """Create a copy of this octree by mapping node data.
 
-        Note that because leaves and uniform nodes can have separate mapping,
-        the ranges of this tree and the copied tree may not be bijective.
+        See ``OctreeVolume.map_copy``.
+        """
+        background = None if self.background is None else uniform_map(self.background)
+        copy = FlatOctreeVolume(self.leaf_shape, self.bounds, dtype, compress_after=self.compress_after,
+                                background=background)
+        for idx, leaf in self.leaves.items():
+            copy.leaves[idx] = LeafNode(copy, leaf.bounds, leaf_map(leaf.read_data()))
+        for ukey, value in self.uniform.items():
+            copy.uniform[ukey] = uniform_map(value)
+        return copy
 
-        Populators are not copied.
+    def iter_terminal_regions(self, unpopulated=False):
+        """Iterate the leaves and uniform regions of this volume.
+
+        See ``OctreeVolume.iter_terminal_regions``.
+        """
+        for leaf in list(self.leaves.values()):
+            yield (leaf.bounds[0], np.minimum(leaf.bounds[1], self.bounds[1])), leaf
+        for ukey, value in list(self.uniform.items()):
+            lower = self.bounds[0] + (np.array(ukey[1:], dtype=np.int64) << ukey[0]) * self.leaf_shape
+            upper = np.minimum(lower + (self.leaf_shape << ukey[0]), self.bounds[1])
+            yield (lower, upper), (value,)
+        if unpopulated:
+            for bounds in self.iter_unpopulated_regions():
+                yield bounds, None
+
+    def build_dense(self, array):
+        """Build the leaves of this empty octree from a dense array.
+
+        See ``OctreeVolume.from_dense``.
+        """
+        for idx in itertools.product(*[range(n) for n in self.grid_shape]):
+            leaf_bounds = self._leaf_bounds(idx)
+            clipped = np.minimum(leaf_bounds[1], self.bounds[1])
+            data = array[tuple(map(slice, leaf_bounds[0] - self.bounds[0], clipped - self.bounds[0]))]
+            value = get_uniform_value(data)
+            if value is None:
+                self.leaves[idx] = LeafNode(self, leaf_bounds, data)
+            else:
+                self.uniform[(0,) + idx] = value[0]
+        self._merge_uniform()
+
+    @synchronized
+    def compact(self):
+        """Collapse leaves and blocks with uniform data into uniform values.
+
+        See ``OctreeVolume.compact``.
+        """
+        count = 0
+        for idx, leaf in list(self.leaves.items()):
+            value = self.get_leaf_uniform_value(leaf)
+            if value is not None:
+                self._drop_leaf(idx)
+                self.uniform[(0,) + idx] = value[0]
+                self.mark_uniform_written(leaf.bounds)
+                count += 1
+
+        self._merge_uniform()
+        return count
+
+    def _merge_uniform(self):
+        """Merge uniform blocks whose siblings all have the same value."""
+        for level in range(1, self.depth + 1):
+            children = {}
+            for ukey, value in self.uniform.items():
+                if ukey[0] == level - 1:
+                    children.setdefault(tuple(x >> 1 for x in ukey[1:]), []).append(value)
+            for block, values in children.items():
+                num_children = np.prod([
+                    sum(1 for o in (0, 1) if ((2 * block[n] + o) << (level - 1)) < self.grid_shape[n])
+                    for n in range(3)])
+                if len(values) < num_children or \
+                   not all(uniform_values_equal(values[0], v) for v in values[1:]):
+                    continue
+                for offset in itertools.product((0, 1), repeat=3):
+                    self.uniform.pop((level - 1,) + tuple(2 * block[n] + offset[n] for n in range(3)), None)
+                self.uniform[(level,) + block] = values[0]
+
+    def fullness(self):
+        potential_leaves = np.prod(self.grid_shape)
+        uniform_leaves = sum(1 for ukey in self.uniform if ukey[0] == 0)
+        return (len(self.leaves) + uniform_leaves) / float(potential_leaves)
+
+    def replace_child(self, child, replacement):
+        idx = tuple(int(x) for x in (child.bounds[0] - self.bounds[0]) // self.leaf_shape)
+        if self.leaves.get(idx) is not child:
+            raise ValueError('Attempt to replace unknown child')
+
+        del self.leaves[idx]
+        if isinstance(replacement, UniformNode):
+            self.uniform[(0,) + idx] = replacement.value
+        elif replacement is not None:
+            replacement.parent = self
+            self.leaves[idx] = replacement
+
+
+# Open files backing shared octree volumes in this process, by real path.
+_SHARED_FILES = {}
+_SHARED_FILES_LOCK = threading.Lock()
+# Files opened by a parent of this process. Closing them, or releasing their
+# maps, would release this process's locks on them, so they are kept open.
+_INHERITED_FILES = []
+
+
+class _SharedFile(object):
+    """A process's descriptor and maps of a file backing shared octree volumes.
+
+    POSIX file locks belong to a process, and closing any descriptor of a
+    file releases all the process's locks on it, including closing the
+    descriptor that ``mmap`` duplicates when a map is released. So each
+    process opens and maps each file once for all the volumes backed by it.
+    Since threads of a process can not exclude each other with file locks,
+    they coordinate slot claims with ``populated`` and ``claimed``.
+    """
+    def __init__(self, path, directory_shape, dtype, data_offset, data_shape):
+        self.file = open(path, 'r+b')
+        self.fd = self.file.fileno()
+        self.pid = os.getpid()
+        self.volumes = 0
+        data_bytes = int(np.prod(data_shape)) * dtype.itemsize
+        if os.fstat(self.fd).st_size < data_offset + data_bytes:
+            self.file.truncate(data_offset + data_bytes)
+        self.directory = np.memmap(self.file, dtype=np.uint8, mode='r+', shape=directory_shape)
+        self.data = np.memmap(self.file, dtype=dtype, mode='r+', offset=data_offset, shape=data_shape)
+        self.populated = threading.Condition()
+        self.claimed = set()
+
+    @staticmethod
+    def open(path, directory_shape, dtype, data_offset, data_shape):
+        """Get this process's open file at a path, opening it if necessary."""
+        key = os.path.realpath(path)
+        with _SHARED_FILES_LOCK:
+            shared = _SHARED_FILES.get(key)
+            # Forked processes inherit neither the file locks nor the claims
+            # of their parent, so open the file anew.
+            if shared is None or shared.pid != os.getpid():
+                if shared is not None:
+                    _INHERITED_FILES.append(shared)
+                shared = _SHARED_FILES[key] = _SharedFile(path, directory_shape, dtype, data_offset, data_shape)
+            elif shared.directory.shape != directory_shape or shared.data.dtype != dtype or \
+                    shared.data.shape != data_shape:
+                raise ValueError('Shared octree file {} is open with another shape or dtype'.format(path))
+            shared.volumes += 1
+        return shared
+
+    def release(self):
+        """Release a volume's use of this file, closing it once unused."""
+        with _SHARED_FILES_LOCK:
+            self.volumes -= 1
+            if self.volumes or self.pid != os.getpid():
+                return
+            key = os.path.realpath(self.file.name)
+            if _SHARED_FILES.get(key) is self:
+                del _SHARED_FILES[key]
+            self.directory = None
+            self.data = None
+            self.file.close()
+
+
+class SharedOctreeVolume(FlatOctreeVolume):
+    """Read-only block sparse 3D array whose leaves are shared between processes.
+
+    Leaf data is kept in a sparse memory-mapped file, by default in
+    ``/dev/shm`` where available, with a slot for every leaf of the leaf
+    grid. A directory of leaf states in the same file records which slots
+    have been populated, so that a leaf populated by any process holding this
+    volume is read from the shared slot by all others rather than from the
+    populator. Only populated slots consume memory.
+
+    A process populating a leaf holds a lock on its slot in the file, which
+    other processes wait on. Since the operating system releases the lock if
+    the process exits, a slot left unfinished by a process that died is
+    claimed again by the next process to read it. Threads of the same process
+    wait on a condition instead. This requires POSIX file locks.
+
+    Since POSIX file locks belong to the process and are released when it
+    closes any descriptor of the file, a process opens each file once for
+    all volumes backed by it, such as copies unpickled in the same process,
+    and claims of their threads exclude each other. Views of leaf data must
+    not outlive the volume, as releasing the last of them after the file is
+    closed and reopened releases the locks of the reopened file.
+
+    The volume can be passed to worker processes either by forking or by
+    pickling, in which case the file is reopened by path. Processes only
+    keep lightweight leaf wrappers around views of the shared data.
+
+    Parameters
+    ----------
+    leaf_shape : tuple of int or ndarray
+        Shape of tree leaves in voxels.
+    bounds : tuple of tuple of int or ndarray
+        The lower and upper coordinate bounds of the volume, in voxels.
+    dtype : numpy.data-type
+    populator : function
+        See ``OctreeVolume``.
+    leaf_cache : LeafCache or int, optional
+        Accepted for compatibility with ``OctreeVolume``, but ignored since
+        leaf data is not held by this process.
+    populator_threads : int, optional
+        See ``OctreeVolume``. Leaves are populated into their shared slots
+        by the thread pool.
+    path : str, optional
+        Path of the file backing the volume. A temporary file is created
+        if not given.
+    """
+    EMPTY = 0
+    POPULATING = 1
+    READY = 2
+
+    def __init__(self, leaf_shape, bounds, dtype, populator=None, leaf_cache=None, populator_threads=None,
+                 path=None):
+        if fcntl is None:
+            raise OSError('Shared octree volumes require POSIX file locks')
+        super(SharedOctreeVolume, self).__init__(leaf_shape, bounds, dtype, populator=populator,
+                                                 populator_threads=populator_threads)
+        if path is None:
+            shm = '/dev/shm'
+            fd, path = tempfile.mkstemp(prefix='diluvian-octree-', suffix='.dat',
+                                        dir=shm if os.path.isdir(shm) else None)
+            os.close(fd)
+        self.path = path
+        self._owner = os.getpid()
+        granularity = mmap.ALLOCATIONGRANULARITY
+        self._data_offset = -(-int(np.prod(self.grid_shape)) // granularity) * granularity
+        self._open()
+
+    def _open(self):
+        self._shared = _SharedFile.open(self.path, self.grid_shape, self.dtype, self._data_offset,
+                                        self.grid_shape + self._leaf)
+        self._directory = self._shared.directory
+        self._data = self._shared.data
+
+    def _get_shared(self):
+        """Get this process's open file backing this volume."""
+        if self._shared.pid != os.getpid():
+            # Forked from the process that opened the file.
+            self._open()
+        return self._shared
+
+    def __getstate__(self):
+        state = super(SharedOctreeVolume, self).__getstate__()
+        for name in ('_directory', '_data', '_shared'):
+            state[name] = None
+        # Copies never remove the file, even if unpickled by its creator.
+        state['_owner'] = None
+        state['leaves'] = {}
+        return state
+
+    def __setstate__(self, state):
+        super(SharedOctreeVolume, self).__setstate__(state)
+        self._open()
+
+    def close(self):
+        """Release the shared file, removing it if this process created it."""
+        super(SharedOctreeVolume, self).close()
+        self._directory = None
+        self._data = None
+        self.leaves = {}
+        if self._shared is not None:
+            self._shared.release()
+            self._shared = None
+        if os.getpid() == self._owner and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _derived_type(self):
+        return FlatOctreeVolume
+
+    def _lock_file(self, offset, shared=False, block=True):
+        """Lock a byte of the shared file, returning whether it was locked."""
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not block:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.lockf(self._shared.fd, flags, 1, offset)
+        except (IOError, OSError):
+            if block:
+                raise
+            return False
+        return True
+
+    def _unlock_file(self, offset):
+        fcntl.lockf(self._shared.fd, fcntl.LOCK_UN, 1, offset)
+
+    def _claim(self, shared, idx, slot):
+        """Claim a leaf slot for population if it is empty or abandoned.
+
+        Must be called holding ``shared.populated``. The byte of the file
+        after the last slot's byte serves as a lock for the directory between
+        processes.
+
+        Returns
+        -------
+        int
+            State of the slot, which is ``EMPTY`` if it was claimed.
+        """
+        directory = int(self._directory.size)
+        self._lock_file(directory)
+        try:
+            state = self._directory[idx]
+            if state == self.POPULATING and slot not in shared.claimed and self._lock_file(slot, block=False):
+                # The process populating the slot exited before finishing.
+                self._unlock_file(slot)
+                state = self.EMPTY
+            if state == self.EMPTY:
+                # Held until population finishes or this process exits.
+                self._lock_file(slot)
+                self._directory[idx] = self.POPULATING
+                shared.claimed.add(slot)
+            return state
+        finally:
+            self._unlock_file(directory)
+
+    def populate(self, bounds):
+        shared = self._get_shared()
+        idx = tuple(int(x) for x in (bounds[0] - self.bounds[0]) // self.leaf_shape)
+        shape = np.minimum(bounds[1], self.bounds[1]) - bounds[0]
+        view = self._data[idx][tuple(slice(0, s) for s in shape)]
+        slot = int(np.ravel_multi_index(idx, self.grid_shape))
+
+        while True:
+            with shared.populated:
+                state = self._claim(shared, idx, slot)
+                if state == self.POPULATING and slot in shared.claimed:
+                    # Another thread of this process is populating this leaf.
+                    shared.populated.wait()
+                    continue
+            if state == self.READY:
+                break
+            if state == self.EMPTY:
+                try:
+                    view[:] = self.read_populator(bounds)
+                    state = self.READY
+                finally:
+                    with shared.populated:
+                        self._directory[idx] = state
+                        shared.claimed.discard(slot)
+                        self._unlock_file(slot)
+                        shared.populated.notify_all()
+                break
+            # Another process is populating this leaf, so wait for it to
+            # release the slot's lock by finishing or exiting.
+            self._lock_file(slot, shared=True)
+            with shared.populated:
+                # If another thread of this process claimed the slot in the
+                # meantime, the lock now belongs to its claim.
+                if slot not in shared.claimed:
+                    self._unlock_file(slot)
+
+        view = view.view(np.ndarray)
+        view.flags.writeable = False
+        leaf = LeafNode(None, bounds, np.empty((0, 0, 0), dtype=self.dtype))
+        leaf.data = view
+        return leaf
+
+    def shared_leaves(self):
+        """Number of leaves populated in the shared file by any process."""
+        return int(np.count_nonzero(self._directory == self.READY))
+
+    def compress(self, cold=False):
+        return 0
+
+    def __setitem__(self, key, value):
+        raise ValueError('Shared octree volumes are read-only')
+
+    def update(self, key, func, value=None):
+        raise ValueError('Shared octree volumes are read-only')
+
+
+class AccessProfile(object):
+    """Record of the regions accessed in an octree volume.
+
+    A profile recorded from a representative workload, such as filling a
+    few regions, estimates how many populator calls and how many voxels read
+    from the volume's backend other leaf shapes would have needed, so that a
+    better leaf shape can be configured for the volume. Estimates assume
+    populated leaves are never evicted and that populating a leaf reads every
+    backend chunk it intersects in full.
+
+    Parameters
+    ----------
+    bounds : tuple of ndarray
+        Bounds of the profiled volume.
+    chunk_shape : ndarray, optional
+        Shape of the chunks the volume's backend is stored in, such as image
+        tiles or N5 blocks, aligned to the lower bound of the volume. By
+        default the backend is assumed to read single voxels.
+    max_keys : int, optional
+        Number of accesses to record, after which further accesses are
+        ignored.
+    """
+    def __init__(self, bounds, chunk_shape=None, max_keys=100000):
+        self.bounds = (np.asarray(bounds[0], dtype=np.int64),
+                       np.asarray(bounds[1], dtype=np.int64))
+        if chunk_shape is None:
+            chunk_shape = np.ones(3)
+        self.chunk_shape = np.asarray(chunk_shape).astype(np.int64)
+        self.max_keys = max_keys
+        self.lowers = []
+        self.uppers = []
+
+    def __len__(self):
+        return len(self.lowers)
+
+    def record(self, npkey):
+        if len(self.lowers) < self.max_keys:
+            self.lowers.append(npkey[0] - self.bounds[0])
+            self.uppers.append(npkey[1] - self.bounds[0])
+
+    def key_shapes(self):
+        """Count the recorded accesses of each shape.
+
+        Returns
+        -------
+        collections.Counter
+            Counts keyed by shape tuples.
+        """
+        return Counter(tuple(int(x) for x in upper - lower) for lower, upper in zip(self.lowers, self.uppers))
+
+    def evaluate(self, leaf_shape):
+        """Estimate the cost of the recorded accesses with a leaf shape.
 
         Parameters
         ----------
-        dtype : numpy.data-type
-            Data type for the constructed copy
-        leaf_map : function
-            Function mapping leaf node data for the constructed copy.
-        uniform_map : function
-            Function mapping uniform node values.
+        leaf_shape : ndarray
 
         Returns
         -------
-        OctreeVolume
-            Copied octree with the same structure as this octree.
+        populator_calls : int
+            Number of distinct leaves accessed.
+        voxels_read : int
+            Number of voxels of backend chunks read to populate them.
         """
-        copy = OctreeVolume(self.leaf_shape, self.bounds, dtype)
-        copy.root_node = self.root_node.map_copy(copy, leaf_map, uniform_map)
-        return copy
+        if not self.lowers:
+            return 0, 0
+        leaf_shape = np.asarray(leaf_shape).astype(np.int64)
+        shape = self.bounds[1] - self.bounds[0]
+        grid_shape = -(-shape // leaf_shape)
+        lower = np.stack(self.lowers) // leaf_shape
+        upper = (np.stack(self.uppers) - 1) // leaf_shape + 1
+
+        # Mark the leaves covered by each access with the corners of its box
+        # in a difference array, which cumulative sums turn into coverage.
+        coverage = np.zeros(grid_shape + 1, dtype=np.int64)
+        for corner in itertools.product((0, 1), repeat=3):
+            index = tuple(upper[:, n] if corner[n] else lower[:, n] for n in range(3))
+            np.add.at(coverage, index, -1 if sum(corner) % 2 else 1)
+        for n in range(3):
+            coverage = coverage.cumsum(axis=n)
+        populated = coverage[:-1, :-1, :-1] > 0
+
+        # Number of chunks intersecting each leaf along each axis.
+        chunk_counts = []
+        for n in range(3):
+            leaf_min = np.arange(grid_shape[n]) * leaf_shape[n]
+            leaf_max = np.minimum(leaf_min + leaf_shape[n], shape[n])
+            chunk_counts.append((leaf_max - 1) // self.chunk_shape[n] - leaf_min // self.chunk_shape[n] + 1)
+        chunks_read = np.einsum('ijk,i,j,k', populated.astype(np.int64), *chunk_counts)
+
+        return int(populated.sum()), int(chunks_read) * int(np.prod(self.chunk_shape))
+
+    def candidate_leaf_shapes(self):
+        """Leaf shapes of whole chunks comparable to the recorded accesses.
+
+        Along each axis, candidate extents are multiples of the chunk extent
+        by 2^i or 3 * 2^i between a quarter and twice the largest access
+        extent, or a single chunk if that is larger.
+        """
+        extents = np.max(np.stack(self.uppers) - np.stack(self.lowers), axis=0)
+        shape = self.bounds[1] - self.bounds[0]
+        axes = []
+        for n in range(3):
+            chunk = self.chunk_shape[n]
+            lower = max(chunk, extents[n] // 4)
+            upper = max(chunk, min(2 * extents[n], shape[n] + chunk - 1))
+            multiples = set()
+            power = 1
+            while chunk * power <= upper:
+                multiples.update(m for m in (power, 3 * power) if lower <= chunk * m <= upper)
+                power *= 2
+            axes.append(sorted(chunk * m for m in multiples) or [chunk])
+        return [np.array(s, dtype=np.int64) for s in itertools.product(*axes)]
+
+    def recommend_leaf_shape(self, candidates=None, call_cost=32768):
+        """Find the leaf shape minimizing the cost of the recorded accesses.
+
+        The cost of a leaf shape is the number of voxels read from the
+        backend plus ``call_cost`` for each populator call.
 
-    def fullness(self):
-        potential_leaves = np.prod(np.ceil(np.true_divide(self.bounds[1] - self.bounds[0], self.leaf_shape)))
-        return self.root_node.count_leaves() / float(potential_leaves)
+        Parameters
+        ----------
+        candidates : iterable of ndarray, optional
+            Leaf shapes to consider. Defaults to ``candidate_leaf_shapes``.
+        call_cost : int, optional
+            Overhead of each populator call, such as a request to a remote
+            backend, in voxels read.
 
-    def get_volume(self):
+        Returns
+        -------
+        ndarray
+            Recommended leaf shape, or ``None`` if no accesses were recorded.
+        """
+        if not self.lowers:
+            return None
+        if candidates is None:
+            candidates = self.candidate_leaf_shapes()
+
+        def cost(leaf_shape):
+            calls, voxels = self.evaluate(leaf_shape)
+            return calls * call_cost + voxels
+
+        return min(candidates, key=cost)
+
+
+class LeafCache(object):
+    """Bounded least-recently-used cache of populated octree leaves.
+
+    Leaves created by an octree's populator are tracked in order of access.
+    When the total size of tracked leaves exceeds the byte budget, the least
+    recently used leaves are evicted from their octrees, so that the next
+    access to them will transparently repopulate them. Leaves that have been
+    written to are no longer tracked and are never evicted.
+
+    A cache may be shared between several octrees to bound their combined
+    memory, and between threads.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Byte budget for the data of tracked leaves.
+
+    Attributes
+    ----------
+    nbytes : int
+        Current size of data of tracked leaves.
+    hits, misses, evictions : int
+        Counts of accesses to tracked leaves, leaves populated, and leaves
+        evicted, respectively. The access for which a leaf is populated is
+        counted only as a miss.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.leaves = OrderedDict()
+        # Populated leaves not yet touched by the access that missed them.
+        self._missed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, leaf, populated=True):
+        with self._lock:
+            if populated:
+                self.misses += 1
+                self._missed.add(leaf)
+            leaf.cache = self
+            self.leaves[leaf] = leaf.nbytes
+            self.nbytes += leaf.nbytes
+
+    def touch(self, leaf):
+        with self._lock:
+            if leaf in self._missed:
+                self._missed.discard(leaf)
+            else:
+                self.hits += 1
+            nbytes = self.leaves.pop(leaf, None)
+            if nbytes is not None:
+                self.leaves[leaf] = nbytes
+
+    def resize(self, leaf):
+        """Update the size of a tracked leaf after it is (de)compressed."""
+        with self._lock:
+            nbytes = self.leaves.get(leaf)
+            if nbytes is not None:
+                self.leaves[leaf] = leaf.nbytes
+                self.nbytes += leaf.nbytes - nbytes
+
+    def discard(self, leaf):
+        with self._lock:
+            leaf.cache = None
+            self._missed.discard(leaf)
+            nbytes = self.leaves.pop(leaf, None)
+            if nbytes is not None:
+                self.nbytes -= nbytes
+
+    def evict(self):
+        """Evict least recently used leaves until within the byte budget."""
+        while True:
+            with self._lock:
+                if self.nbytes <= self.max_bytes or not self.leaves:
+                    return
+                leaf, nbytes = self.leaves.popitem(last=False)
+                self.nbytes -= nbytes
+                self._missed.discard(leaf)
+                leaf.cache = None
+                self.evictions += 1
+            # Octree locks are taken outside the cache lock, since writes to
+            # an octree holding its lock discard leaves from the cache.
+            if leaf.parent is not None:
+                volume = leaf.get_volume()
+                with volume.locked():
+                    if leaf.parent is not None:
+                        if leaf.dirty:
+                            volume.flush_leaf(leaf)
+                        leaf.replace(None)
+
+    def stats(self):
+        """Summarize cache usage.
+
+        Returns
+        -------
+        dict
+        """
+        accesses = self.hits + self.misses
+        return {
+            'leaves': len(self.leaves),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / float(accesses) if accesses else 0.0,
+        }
+
+
+class LeafStore(object):
+    """Chunked dataset used as the write-back store of an octree.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or ndarray
+        Dataset spanning the octree volume that supports NumPy slicing for
+        reads and writes, such as an HDF5 or N5 dataset. For efficiency it
+        should be chunked with the octree leaf shape.
+    offset : ndarray, optional
+        Volume coordinates of the dataset origin. Defaults to the origin.
+    stored_dataset : h5py.Dataset or ndarray, optional
+        Boolean dataset with an element for each leaf of the octree leaf
+        grid, recording which leaves have been written to ``dataset``, so
+        that they are read from it rather than populated when the store is
+        reopened. Requires ``leaf_shape``.
+    leaf_shape : ndarray, optional
+        Shape of octree leaves.
+    h5file : h5py.File, optional
+        File containing the datasets, which is closed with the store.
+
+    Attributes
+    ----------
+    stored : set of tuple
+        Lower bounds of leaves that have been written to the dataset.
+    reads, writes : int
+        Counts of leaves read from and written to the dataset.
+    """
+    def __init__(self, dataset, offset=None, stored_dataset=None, leaf_shape=None, h5file=None):
+        self.dataset = dataset
+        if offset is None:
+            offset = np.zeros(3, dtype=np.int64)
+        self.offset = np.asarray(offset, dtype=np.int64)
+        self.stored_dataset = stored_dataset
+        self.leaf_shape = None if leaf_shape is None else np.asarray(leaf_shape, dtype=np.int64)
+        self.h5file = h5file
+        self.stored = set()
+        if stored_dataset is not None:
+            for idx in np.transpose(np.nonzero(stored_dataset[...])):
+                self.stored.add(tuple((self.offset + idx * self.leaf_shape).tolist()))
+        self.reads = 0
+        self.writes = 0
+
+    @classmethod
+    def from_hdf5(cls, filename, name, bounds, dtype, leaf_shape):
+        """Create a store backed by a dataset in an HDF5 file.
+
+        Which leaves have been written is recorded in a boolean dataset
+        named ``name`` with a ``_stored`` suffix, so leaves written to a
+        store are read from it when the store is reopened.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the HDF5 file, which is created if it does not exist.
+        name : str
+            Path of the dataset in the file, which is created if it does not
+            exist.
+        bounds : tuple of ndarray
+            Bounds of the octree volume.
+        dtype : numpy.data-type
+        leaf_shape : ndarray
+            Shape of octree leaves, used as the dataset chunk shape.
+
+        Returns
+        -------
+        LeafStore
+            Store owning the open file, which must be closed with ``close``.
+        """
+        import h5py
+
+        shape = tuple(np.asarray(bounds[1]) - np.asarray(bounds[0]))
+        chunks = tuple(np.minimum(leaf_shape, shape))
+        grid_shape = tuple(-(-np.asarray(shape) // np.asarray(leaf_shape)))
+        h5file = h5py.File(filename, 'a')
+        dataset = h5file.require_dataset(name, shape=shape, dtype=dtype, chunks=chunks)
+        stored_dataset = h5file.require_dataset(name + '_stored', shape=grid_shape, dtype=np.bool_,
+                                                fillvalue=False)
+        return cls(dataset, offset=bounds[0], stored_dataset=stored_dataset, leaf_shape=leaf_shape,
+                   h5file=h5file)
+
+    def __enter__(self):
         return self
 
-    def replace_child(self, child, replacement):
-        if child != self.root_node:
-            raise ValueError('Attempt to replace unknown child')
+    def __exit__(self, *exc):
+        self.close()
+        return False
 
-        self.root_node = replacement
+    def close(self):
+        """Close the file of this store, if it owns one."""
+        if self.h5file is not None:
+            self.h5file.close()
+            self.h5file = None
+
+    def get_slices(self, bounds):
+        lo = bounds[0] - self.offset
+        hi = bounds[1] - self.offset
+        return tuple(slice(int(a), int(b)) for a, b in zip(lo, hi))
+
+    def contains(self, bounds):
+        return tuple(bounds[0].tolist()) in self.stored
+
+    def read(self, bounds):
+        self.reads += 1
+        return self.dataset[self.get_slices(bounds)]
+
+    def write(self, bounds, data):
+        self.writes += 1
+        self.dataset[self.get_slices(bounds)] = data
+        self.stored.add(tuple(bounds[0].tolist()))
+        if self.stored_dataset is not None:
+            self.stored_dataset[tuple((bounds[0] - self.offset) // self.leaf_shape)] = True
 
 
 class Node(object):
@@ -165,7 +2326,9 @@ class Node(object):
         return self.parent.get_volume()
 
     def replace(self, replacement):
+        volume = self.get_volume()
         self.parent.replace_child(self, replacement)
+        volume.reindex(self, replacement)
         self.parent = None
 
 
@@ -178,6 +2341,14 @@ class BranchNode(Node):
     def count_leaves(self):
         return sum(c.count_leaves() for s in self.children for r in s for c in r if c is not None)
 
+    def iter_children(self):
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    child = self.children[i][j][k]
+                    if child is not None:
+                        yield child
+
     def iter_leaves(self):
         for i in range(2):
             for j in range(2):
@@ -224,20 +2395,26 @@ class BranchNode(Node):
 
         return (child_bounds, clip_bound)
 
+    def get_children(self, inds):
+        """Get children by index, populating any that are missing."""
+        children = []
+        for i, j, k in inds:
+            child = self.children[i][j][k]
+            if child is None:
+                child = self.populate_child(i, j, k)
+            children.append(child)
+
+        return children
+
     def __getitem__(self, key):
         inds = self.get_children_mask(key)
-
-        for i, j, k in inds:
-            if self.children[i][j][k] is None:
-                self.populate_child(i, j, k)
+        children = self.get_children(inds)
 
         if len(inds) == 1:
-            i, j, k = inds[0]
-            return self.children[i][j][k][key]
+            return children[0][key]
 
         chunk = np.empty(tuple(key[1] - key[0]), self.get_volume().dtype)
-        for i, j, k in inds:
-            child = self.children[i][j][k]
+        for child in children:
             subchunk = child.get_intersection(key)
             ind = (subchunk[0] - key[0], subchunk[1] - key[0])
             chunk[ind[0][0]:ind[1][0],
@@ -256,12 +2433,7 @@ class BranchNode(Node):
 
         inds = self.get_children_mask(key)
 
-        for i, j, k in inds:
-            if self.children[i][j][k] is None:
-                self.populate_child(i, j, k)
-
-        for i, j, k in inds:
-            child = self.children[i][j][k]
+        for child in self.get_children(inds):
             subchunk = child.get_intersection(key)
             ind = (subchunk[0] - key[0], subchunk[1] - key[0])
             if isinstance(value, np.ndarray):
@@ -271,23 +2443,179 @@ class BranchNode(Node):
             else:
                 child[subchunk] = value
 
+    def read_into(self, key, out):
+        for child in self.get_children(self.get_children_mask(key)):
+            subchunk = child.get_intersection(key)
+            ind = (subchunk[0] - key[0], subchunk[1] - key[0])
+            child.read_into(subchunk, out[ind[0][0]:ind[1][0],
+                                          ind[0][1]:ind[1][1],
+                                          ind[0][2]:ind[1][2]])
+
+    def update(self, key, func, value):
+        for child in self.get_children(self.get_children_mask(key)):
+            subchunk = child.get_intersection(key)
+            ind = (subchunk[0] - key[0], subchunk[1] - key[0])
+            if isinstance(value, np.ndarray):
+                child.update(subchunk, func, value[ind[0][0]:ind[1][0],
+                                                   ind[0][1]:ind[1][1],
+                                                   ind[0][2]:ind[1][2]])
+            else:
+                child.update(subchunk, func, value)
+
+    def iter_reduce(self, key, leaf_func, uniform_func):
+        for child in self.get_children(self.get_children_mask(key)):
+            for partial in child.iter_reduce(child.get_intersection(key), leaf_func, uniform_func):
+                yield partial
+
+    def discard_leaves(self, key):
+        for i, j, k in self.get_children_mask(key):
+            child = self.children[i][j][k]
+            if isinstance(child, BranchNode):
+                child.discard_leaves(child.get_intersection(key))
+            elif isinstance(child, LeafNode):
+                child.uncache()
+                child.replace(None)
+
+    def build_dense(self, array):
+        """Build the descendants of this empty branch from a dense array.
+
+        Parameters
+        ----------
+        array : ndarray
+            Data of the whole volume.
+
+        Returns
+        -------
+        tuple
+            A single-element tuple of the value of this branch if all its
+            children are uniform with the same value, otherwise ``None``.
+        """
+        volume = self.get_volume()
+        child_values = []
+        for i, j, k in itertools.product((0, 1), repeat=3):
+            child_bounds, child_clip_bound = self.get_child_bounds(i, j, k)
+            if child_clip_bound is not None and np.any(np.greater_equal(child_bounds[0], child_clip_bound)):
+                continue
+            if np.any(np.less_equal(child_bounds[1] - child_bounds[0], volume.leaf_shape)):
+                data = array[tuple(map(slice, child_bounds[0] - volume.bounds[0],
+                                       np.minimum(child_bounds[1], volume.bounds[1]) - volume.bounds[0]))]
+                value = get_uniform_value(data)
+                if value is None:
+                    child = LeafNode(self, child_bounds, data)
+                else:
+                    child = UniformLeafNode(self, child_bounds, volume.dtype, value[0])
+            else:
+                child = BranchNode(self, child_bounds, clip_bound=child_clip_bound)
+                value = child.build_dense(array)
+                if value is not None:
+                    child = UniformBranchNode(self, child_bounds, volume.dtype, value[0],
+                                              clip_bound=child_clip_bound)
+            self.children[i][j][k] = child
+            if child_values is None:
+                continue
+            if isinstance(child, UniformNode):
+                child_values.append(child.value)
+            else:
+                child_values = None
+
+        if child_values and all(uniform_values_equal(child_values[0], v) for v in child_values[1:]):
+            return (child_values[0],)
+        return None
+
+    def compact(self):
+        """Collapse uniform descendants of this branch.
+
+        Returns
+        -------
+        tuple
+            Number of leaves made uniform, and a single-element tuple of the
+            value of this branch if all its children are now uniform with
+            the same value, otherwise ``None``.
+        """
+        volume = self.get_volume()
+        count = 0
+        values = []
+        for i, j, k in itertools.product((0, 1), repeat=3):
+            child = self.children[i][j][k]
+            if child is None:
+                child_bounds, child_clip_bound = self.get_child_bounds(i, j, k)
+                if child_clip_bound is not None and np.any(np.greater_equal(child_bounds[0], child_clip_bound)):
+                    continue
+                values = None
+            elif isinstance(child, BranchNode):
+                child_count, value = child.compact()
+                count += child_count
+                if value is None:
+                    values = None
+                elif values is not None:
+                    values.append(value[0])
+            elif isinstance(child, LeafNode):
+                value = volume.get_leaf_uniform_value(child)
+                if value is None:
+                    values = None
+                    continue
+                child.uncache()
+                child.replace(UniformLeafNode(self, child.bounds, volume.dtype, value[0]))
+                volume.mark_uniform_written(child.bounds)
+                count += 1
+                if values is not None:
+                    values.append(value[0])
+            elif values is not None:
+                values.append(child.value)
+
+        if values and all(uniform_values_equal(values[0], v) for v in values[1:]):
+            self.replace(UniformBranchNode(self.parent, self.bounds, volume.dtype, values[0],
+                                           clip_bound=self.clip_bound))
+            return count, (values[0],)
+        return count, None
+
+    def find_unpopulated(self, key, missing):
+        for i, j, k in self.get_children_mask(key):
+            child = self.children[i][j][k]
+            if child is None:
+                child_bounds, _ = self.get_child_bounds(i, j, k)
+                child_shape = child_bounds[1] - child_bounds[0]
+                if np.any(np.less_equal(child_shape, self.get_volume().leaf_shape)):
+                    missing.append((child_bounds, self._make_child_inserter(i, j, k)))
+                    continue
+                child = self.populate_child(i, j, k)
+            if isinstance(child, BranchNode):
+                child.find_unpopulated(child.get_intersection(key), missing)
+
+    def _make_child_inserter(self, i, j, k):
+        def insert(leaf):
+            if self.children[i][j][k] is None:
+                leaf.parent = self
+                self.children[i][j][k] = leaf
+                self.get_volume().index_nodes(leaf)
+            else:
+                leaf.uncache()
+        return insert
+
     def populate_child(self, i, j, k):
         volume = self.get_volume()
-        if volume.populator is None:
+        if not volume.can_populate:
             raise ValueError('Attempt to retrieve unpopulated region without octree populator')
 
         child_bounds, child_clip_bound = self.get_child_bounds(i, j, k)
         child_shape = child_bounds[1] - child_bounds[0]
         if np.any(np.less_equal(child_shape, volume.leaf_shape)):
-            populator_bounds = [child_bounds[0].copy(), child_bounds[1].copy()]
-            if child_clip_bound is not None:
-                populator_bounds[1] = np.minimum(populator_bounds[1], child_clip_bound)
-            data = volume.populator(populator_bounds).astype(volume.dtype)
-            child = LeafNode(self, child_bounds, data)
+            child = volume.populate(child_bounds)
         else:
             child = BranchNode(self, child_bounds, clip_bound=child_clip_bound)
 
-        self.children[i][j][k] = child
+        with volume.locked():
+            existing = self.children[i][j][k]
+            if existing is not None:
+                # Populated concurrently by another thread.
+                if isinstance(child, LeafNode):
+                    child.uncache()
+                return existing
+            child.parent = self
+            if isinstance(child, LeafNode):
+                volume.index_nodes(child)
+            self.children[i][j][k] = child
+        return child
 
     def replace_child(self, child, replacement):
         for i in range(2):
@@ -301,10 +2629,122 @@ class BranchNode(Node):
 
 
 class LeafNode(Node):
+    # Cache tracking this leaf if it is populated or write-back data.
+    cache = None
+    # Whether this leaf has been written since it was populated or flushed.
+    dirty = False
+    # Codec, shape, dtype and bytes of the data if it is compressed.
+    compressed = None
+
     def __init__(self, parent, bounds, data):
         super(LeafNode, self).__init__(parent, bounds)
         self.data = data.copy()
 
+    @property
+    def data(self):
+        self.accessed = True
+        data = self._data
+        if data is None:
+            data = self.decompress()
+        return data
+
+    @data.setter
+    def data(self, data):
+        self.accessed = True
+        self._data = data
+        self.compressed = None
+
+    # Compression sets ``compressed`` before clearing ``_data``, and
+    # decompression sets ``_data`` before clearing ``compressed``, so that
+    # readers not holding the volume's lock always find one of them.
+    # Decompression holds the volume's lock, so that data written by a
+    # writer after decompressing is never replaced by a concurrent reader's
+    # decoded copy.
+
+    def locked(self):
+        """Get a context holding the lock of this leaf's volume, if any."""
+        node = self.parent
+        while isinstance(node, Node):
+            node = node.parent
+        # Leaves removed from their volume are no longer written.
+        return _NULL_LOCK if node is None else node.locked()
+
+    @property
+    def nbytes(self):
+        data = self._data
+        if data is None:
+            return len(self.compressed[3])
+        return data.nbytes
+
+    def read_data(self):
+        """Get this leaf's data without decompressing it in place."""
+        data = self._data
+        if data is None:
+            compressed = self.compressed
+            if compressed is None:
+                return self._data
+            return self.decode(*compressed)
+        return data
+
+    @staticmethod
+    def encode(data):
+        if data.dtype == np.bool_:
+            return 'packbits', data.shape, data.dtype, np.packbits(data, axis=None).tobytes()
+        return 'zlib', data.shape, data.dtype, zlib.compress(data.tobytes(), 1)
+
+    @staticmethod
+    def decode(codec, shape, dtype, encoded):
+        if codec == 'packbits':
+            bits = np.unpackbits(np.frombuffer(encoded, dtype=np.uint8))
+            return bits[:int(np.prod(shape))].astype(np.bool_).reshape(shape)
+        return np.frombuffer(bytearray(zlib.decompress(encoded)), dtype=dtype).reshape(shape)
+
+    def compress(self):
+        """Compress this leaf's data in memory if that makes it smaller.
+
+        Returns
+        -------
+        bool
+            Whether the data was compressed.
+        """
+        if self.compressed is not None:
+            return False
+        compressed = self.encode(self._data)
+        if len(compressed[3]) >= self._data.nbytes:
+            return False
+        self.compressed = compressed
+        self._data = None
+        cache = self.cache
+        if cache is not None:
+            cache.resize(self)
+        return True
+
+    def decompress(self):
+        with self.locked():
+            compressed = self.compressed
+            if compressed is None:
+                # Decompressed concurrently by another thread.
+                return self._data
+            data = self.decode(*compressed)
+            self._data = data
+            self.compressed = None
+            cache = self.cache
+            if cache is not None:
+                cache.resize(self)
+        return data
+
+    def touch(self):
+        """Mark this leaf as recently used in its cache, if any."""
+        cache = self.cache
+        if cache is not None:
+            cache.touch(self)
+
+    def uncache(self):
+        """Stop tracking this leaf in its cache, if any."""
+        cache = self.cache
+        if cache is not None:
+            cache.discard(self)
+
     def count_leaves(self):
         return 1
 
@@ -312,21 +2752,38 @@ class LeafNode(Node):
         yield self
 
     def map_copy(self, copy_parent, leaf_map, uniform_map):
-        copy = LeafNode(copy_parent, self.bounds, leaf_map(self.data))
+        copy = LeafNode(copy_parent, self.bounds, leaf_map(self.read_data()))
         return copy
 
     def __getitem__(self, key):
+        self.touch()
         ind = (key[0] - self.bounds[0], key[1] - self.bounds[0])
         return self.data[ind[0][0]:ind[1][0],
                          ind[0][1]:ind[1][1],
                          ind[0][2]:ind[1][2]]
 
     def __setitem__(self, key, value):
+        if not self.dirty:
+            self.get_volume().mark_written(self)
         ind = (key[0] - self.bounds[0], key[1] - self.bounds[0])
         self.data[ind[0][0]:ind[1][0],
                   ind[0][1]:ind[1][1],
                   ind[0][2]:ind[1][2]] = value
 
+    def read_into(self, key, out):
+        out[:] = self[key]
+
+    def iter_reduce(self, key, leaf_func, uniform_func):
+        yield leaf_func(self[key])
+
+    def update(self, key, func, value):
+        if not self.dirty:
+            self.get_volume().mark_written(self)
+        ind = (key[0] - self.bounds[0], key[1] - self.bounds[0])
+        func(self.data[ind[0][0]:ind[1][0],
+                       ind[0][1]:ind[1][1],
+                       ind[0][2]:ind[1][2]], value)
+
 
 class UniformNode(Node):
     def __init__(self, parent, bounds, dtype, value, **kwargs):
@@ -337,6 +2794,20 @@ class UniformNode(Node):
     def __getitem__(self, key):
         return np.full(tuple(key[1] - key[0]), self.value, dtype=self.dtype)
 
+    def iter_leaves(self):
+        return iter(())
+
+    def read_into(self, key, out):
+        out[:] = self.value
+
+    def iter_reduce(self, key, leaf_func, uniform_func):
+        yield uniform_func(self.value, int(np.prod(key[1] - key[0])))
+
+    def update(self, key, func, value):
+        chunk = self[key]
+        func(chunk, value)
+        self[key] = chunk
+
     def map_copy(self, copy_parent, leaf_map, uniform_map):
         copy = type(self)(copy_parent, self.bounds, copy_parent.get_volume().dtype,
                           uniform_map(self.value), clip_bound=self.clip_bound)
@@ -3,12 +3,18 @@
 
 from __future__ import division
 
+from collections import OrderedDict
+import hashlib
+import heapq
 import itertools
 import logging
 
 import matplotlib.animation as animation
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import six
 from six.moves import queue
 from tqdm import tqdm
@@ -18,11 +24,505 @@ from .octrees import OctreeVolume
 from .postprocessing import Body
 from .util import (
         get_color_shader,
+        get_nonzero_aabb,
         pad_dims,
+        pad_indices,
         WrappedViewer,
         )
 
 
+def get_move_leaf_shape(fov_shapes, move_step, move_grid_offset, max_mean_leaves=1.5):
+    """Choose an octree leaf shape for blocks accessed around a move grid.
+
+    Leaf shapes are multiples of the move step, so that blocks centered on
+    move grid voxels fall at a fixed, periodic set of offsets within leaves
+    and the number of leaves each touches is bounded. Along each axis, the
+    smallest such shape is chosen for which blocks touch on average at most
+    ``max_mean_leaves`` leaves.
+
+    Parameters
+    ----------
+    fov_shapes : sequence of ndarray
+        Shapes of blocks accessed centered on move grid voxels, such as the
+        input and output FOV shapes.
+    move_step : ndarray
+        Move grid spacing in voxels.
+    move_grid_offset : ndarray
+        Voxel coordinates of the move grid origin.
+    max_mean_leaves : float, optional
+        Maximum average number of leaves touched by a block along each axis.
+
+    Returns
+    -------
+    ndarray
+    """
+    leaf_shape = np.empty(3, dtype=np.int64)
+    for n in range(3):
+        step = max(int(move_step[n]), 1)
+        leaf = step
+        while True:
+            mean_leaves = 0
+            for fov in fov_shapes:
+                fov = int(fov[n])
+                starts = (int(move_grid_offset[n]) - (fov - 1) // 2 + step * np.arange(leaf // step)) % leaf
+                mean_leaves = max(mean_leaves, np.mean((starts + fov - 1) // leaf + 1))
+            if mean_leaves <= max_mean_leaves:
+                break
+            leaf += step
+        leaf_shape[n] = leaf
+    return leaf_shape
+
+
+class MoveQueue(object):
+    """Priority queue of move positions for filling a single region.
+
+    Unlike ``queue.PriorityQueue`` this takes no locks, since a region is
+    only filled by one thread. Each position is queued at most once, and its
+    priority can be decreased in place. Entries are ordered by priority,
+    then by position. Updated and removed positions are deleted lazily, by
+    invalidating their heap entries.
+    """
+    def __init__(self):
+        self.heap = []
+        # Map from queued position tuples to their current heap entries.
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, pos):
+        return pos in self.entries
+
+    def put(self, priority, pos):
+        """Queue a position, or decrease its priority if already queued.
+
+        Returns
+        -------
+        bool
+            Whether the position was queued or its priority decreased.
+        """
+        entry = self.entries.get(pos)
+        if entry is not None:
+            if priority >= entry[0]:
+                return False
+            entry[-1] = False
+        entry = [priority, pos, True]
+        self.entries[pos] = entry
+        heapq.heappush(self.heap, entry)
+        return True
+
+    def put_many(self, priorities, positions):
+        """Queue several positions that are not already queued."""
+        entries = [[priority, pos, True] for priority, pos in zip(priorities, positions)]
+        self.entries.update((entry[1], entry) for entry in entries)
+        if len(entries) > len(self.heap):
+            self.heap.extend(entries)
+            heapq.heapify(self.heap)
+        else:
+            for entry in entries:
+                heapq.heappush(self.heap, entry)
+
+    def remove(self, pos):
+        self.entries.pop(pos)[-1] = False
+
+    def pop(self):
+        """Remove and return the priority and position of the first move.
+
+        Raises
+        ------
+        IndexError
+            If the queue is empty.
+        """
+        while self.heap:
+            priority, pos, valid = heapq.heappop(self.heap)
+            if valid:
+                del self.entries[pos]
+                return priority, pos
+        raise IndexError('pop from an empty move queue')
+
+    def pop_batch(self, size):
+        """Remove and return up to ``size`` moves in priority order."""
+        return [self.pop() for _ in range(min(size, len(self)))]
+
+
+class MoveGrid(object):
+    """Per-position values over a region's move grid.
+
+    Values are kept in a dense array covering the move grid bounds, indexed
+    directly by position, unless the grid has more than ``max_dense``
+    positions, such as for regions spanning whole block sparse volumes. Then
+    values are kept in a dict keyed by position tuple.
+
+    Parameters
+    ----------
+    bounds : tuple of ndarray
+        Inclusive lower and exclusive upper bounds of positions.
+    dtype : numpy.data-type
+    default : optional
+        Value of positions that have not been set.
+    max_dense : int, optional
+        Maximum number of positions to allocate a dense array for.
+    """
+    def __init__(self, bounds, dtype, default=0, max_dense=2**24):
+        self.lower = tuple(int(x) for x in bounds[0])
+        shape = tuple(max(int(upper) - lower, 0) for lower, upper in zip(self.lower, bounds[1]))
+        self.dtype = np.dtype(dtype)
+        self.default = self.dtype.type(default)
+        if int(np.prod(shape)) <= max_dense:
+            self.values = np.full(shape, self.default, dtype=self.dtype)
+        else:
+            self.values = None
+            self.sparse = {}
+
+    def _index(self, pos):
+        return (pos[0] - self.lower[0], pos[1] - self.lower[1], pos[2] - self.lower[2])
+
+    def __getitem__(self, pos):
+        if self.values is None:
+            return self.sparse.get((pos[0], pos[1], pos[2]), self.default)
+        return self.values[self._index(pos)]
+
+    def __setitem__(self, pos, value):
+        if self.values is None:
+            if value == self.default:
+                self.sparse.pop((pos[0], pos[1], pos[2]), None)
+            else:
+                self.sparse[(pos[0], pos[1], pos[2])] = value
+        else:
+            self.values[self._index(pos)] = value
+
+    def get_many(self, positions):
+        """Get values of an array of positions."""
+        if self.values is None:
+            return np.array([self[pos] for pos in positions], dtype=self.dtype).reshape(len(positions))
+        return self.values[tuple((positions - self.lower).T)]
+
+    def set_many(self, positions, value):
+        """Set an array of positions to a value."""
+        if self.values is None:
+            for pos in positions:
+                self[pos] = value
+        else:
+            self.values[tuple((positions - self.lower).T)] = value
+
+
+class ComponentTracker(object):
+    """Incrementally tracked connected component of a thresholded mask containing a seed.
+
+    The mask is divided into tiles. Voxels of each tile at or above the
+    threshold are labeled into connected components local to the tile, and
+    pairs of components of adjacent tiles touching across their shared face
+    are recorded. Only tiles marked as changed are relabeled, after which
+    the tile components connected to the seed are found from a graph of
+    tile components rather than by labeling the whole mask.
+
+    Parameters
+    ----------
+    bounds : ndarray
+        Shape of the mask.
+    tile_shape : ndarray
+        Shape of tiles.
+    seed : ndarray
+        Seed voxel.
+    threshold : float
+        Mask values at or above which voxels are in components.
+
+    Attributes
+    ----------
+    labels : dict
+        Array of local component labels and number of components for each
+        tile with voxels at or above the threshold, keyed by tile index.
+    extents : dict
+        Lower and upper bounds of the voxels at or above the threshold in
+        each tile with any, keyed by tile index.
+    written_bounds : tuple of ndarray
+        Bounds of the blocks marked as changed since ``written_bounds`` was
+        last reset, or ``None`` if none have been.
+    """
+    def __init__(self, bounds, tile_shape, seed, threshold):
+        self.bounds = np.asarray(bounds, dtype=np.int64)
+        self.tile_shape = np.asarray(tile_shape, dtype=np.int64)
+        self.seed = np.asarray(seed, dtype=np.int64)
+        self.threshold = threshold
+        self.labels = {}
+        self.extents = {}
+        self.written_bounds = None
+        # Pairs of labels of components touching across the face between a
+        # tile and its successor along an axis, keyed by tile and axis.
+        self.edges = {}
+        self.changed = set()
+
+    def get_tile_bounds(self, tile):
+        tile_min = np.asarray(tile, dtype=np.int64) * self.tile_shape
+        return tile_min, np.minimum(tile_min + self.tile_shape, self.bounds)
+
+    def mark_changed(self, block_min, block_max):
+        """Mark tiles intersecting a block of the mask as changed."""
+        block_min = np.asarray(block_min, dtype=np.int64)
+        block_max = np.asarray(block_max, dtype=np.int64)
+        if self.written_bounds is None:
+            self.written_bounds = (block_min, block_max)
+        else:
+            self.written_bounds = (np.minimum(self.written_bounds[0], block_min),
+                                   np.maximum(self.written_bounds[1], block_max))
+        tile_min = block_min // self.tile_shape
+        tile_max = (block_max - 1) // self.tile_shape + 1
+        self.changed.update(itertools.product(*[range(lo, hi) for lo, hi in zip(tile_min, tile_max)]))
+
+    def mark_all_changed(self):
+        self.mark_changed(np.zeros(3, dtype=np.int64), self.bounds)
+
+    def update(self, mask):
+        """Relabel tiles of the mask that have changed.
+
+        Parameters
+        ----------
+        mask : ndarray or diluvian.octrees.OctreeVolume
+        """
+        stale_edges = set()
+        for tile in self.changed:
+            tile_min, tile_max = self.get_tile_bounds(tile)
+            block = mask[tuple(map(slice, tile_min, tile_max))] >= self.threshold
+            if block.any():
+                self.labels[tile] = ndimage.label(block)
+                extent_min, extent_max = get_nonzero_aabb(block)
+                self.extents[tile] = (tile_min + extent_min, tile_min + extent_max)
+            else:
+                self.labels.pop(tile, None)
+                self.extents.pop(tile, None)
+            for axis in range(3):
+                stale_edges.add((tile, axis))
+                pred = list(tile)
+                pred[axis] -= 1
+                stale_edges.add((tuple(pred), axis))
+        self.changed = set()
+
+        for tile, axis in stale_edges:
+            succ = list(tile)
+            succ[axis] += 1
+            succ = tuple(succ)
+            if tile not in self.labels or succ not in self.labels:
+                self.edges.pop((tile, axis), None)
+                continue
+            labels, _ = self.labels[tile]
+            succ_labels, succ_num = self.labels[succ]
+            face = np.take(labels, -1, axis=axis)
+            succ_face = np.take(succ_labels, 0, axis=axis)
+            touching = (face > 0) & (succ_face > 0)
+            pairs = np.unique(face[touching].astype(np.int64) * (succ_num + 1) + succ_face[touching])
+            if pairs.size:
+                self.edges[(tile, axis)] = np.stack(np.divmod(pairs, succ_num + 1), axis=1)
+            else:
+                self.edges.pop((tile, axis), None)
+
+    def get_bounds(self):
+        """Get the bounds of the voxels at or above the threshold as last updated."""
+        extents = list(self.extents.values())
+        return (np.min([e[0] for e in extents], axis=0), np.max([e[1] for e in extents], axis=0))
+
+    def get_seeded_labels(self, mask):
+        """Find the tile components connected to the seed.
+
+        Parameters
+        ----------
+        mask : ndarray or diluvian.octrees.OctreeVolume
+            The mask, whose changed tiles are relabeled first.
+
+        Returns
+        -------
+        dict
+            Boolean array indexed by local label of whether each component of
+            a tile is connected to the seed, keyed by tile index, or ``None``
+            if the seed is not in the thresholded mask.
+        """
+        self.update(mask)
+
+        seed_tile = tuple(self.seed // self.tile_shape)
+        if seed_tile not in self.labels:
+            return None
+        seed_label = self.labels[seed_tile][0][tuple(self.seed - self.get_tile_bounds(seed_tile)[0])]
+        if seed_label == 0:
+            return None
+
+        # Number components of all tiles consecutively, with the label 0 of
+        # each tile numbered but never connected.
+        offsets = {}
+        num_nodes = 0
+        for tile, (_, num) in six.iteritems(self.labels):
+            offsets[tile] = num_nodes
+            num_nodes += num + 1
+        edges = [np.zeros((0, 2), dtype=np.int64)]
+        for (tile, axis), pairs in six.iteritems(self.edges):
+            succ = list(tile)
+            succ[axis] += 1
+            edges.append(pairs + [offsets[tile], offsets[tuple(succ)]])
+        edges = np.concatenate(edges)
+        graph = coo_matrix((np.ones(len(edges), dtype=np.bool_), (edges[:, 0], edges[:, 1])),
+                           shape=(num_nodes, num_nodes))
+        _, components = connected_components(graph, directed=False)
+        seeded = components == components[offsets[seed_tile] + seed_label]
+
+        return {tile: seeded[offset:offset + self.labels[tile][1] + 1] for tile, offset in six.iteritems(offsets)}
+
+
+class ImageHalo(object):
+    """Padded border of an image, so that blocks extending outside it are slices.
+
+    Rather than padding each block read near the image boundary, the image
+    is padded once, but only in a slab along each face thick enough to hold
+    any block padded across that face. Each slab is divided into tiles
+    along the face, and each tile is padded when a block is first read
+    across it, so parts of faces that are never reached cost nothing. Blocks
+    inside the image are read from the image itself. A halo may be shared by
+    regions of the same image.
+
+    Padding the image as a whole gives the same blocks as padding each block
+    read inside the image, as long as blocks are centered inside the image.
+
+    Parameters
+    ----------
+    image : ndarray or diluvian.octrees.OctreeVolume
+    mode : str
+        Padding mode, as for ``numpy.pad``. One of 'edge', 'reflect' or
+        'symmetric'.
+    margin : ndarray, optional
+        Maximum extent of blocks outside the image. Defaults to the margin of
+        the model input field of view.
+    tile_shape : ndarray, optional
+        Extent of the tiles of each slab along its face. For an octree image,
+        defaults to the smallest multiple of its leaf shape that holds a
+        block, so that padding a tile populates few leaves and a block spans
+        at most two tiles along each axis. Otherwise each slab is one tile.
+    """
+    MODES = ('edge', 'reflect', 'symmetric')
+
+    def __init__(self, image, mode, margin=None, tile_shape=None):
+        if mode not in self.MODES:
+            raise ValueError('Padding mode {} is not supported by image halos.'.format(mode))
+        if margin is None:
+            margin = (CONFIG.model.input_fov_shape - 1) // 2
+        self.image = image
+        self.mode = mode
+        self.margin = np.asarray(margin, dtype=np.int64)
+        self.shape = np.array(image.shape, dtype=np.int64)
+        if np.any(self.margin >= self.shape):
+            raise ValueError('Image shape {} must be larger than the halo margin {}.'.format(
+                             self.shape, self.margin))
+        if isinstance(image, OctreeVolume):
+            # Align tiles to leaves.
+            self.tile_origin = np.zeros(3, dtype=np.int64)
+            if tile_shape is None:
+                tile_shape = image.leaf_shape * -(-(2 * self.margin + 1) // image.leaf_shape)
+        else:
+            self.tile_origin = -self.margin
+            if tile_shape is None:
+                tile_shape = self.shape + 2 * self.margin
+        self.tile_shape = np.asarray(tile_shape, dtype=np.int64)
+
+        # Blocks padded across a face are centered within the margin of it,
+        # so extend at most three margins from the padded face.
+        thickness = np.minimum(3 * self.margin, self.shape + 2 * self.margin)
+        self.slab_bounds = []
+        for axis in range(3):
+            for side in range(2):
+                slab_min = -self.margin
+                slab_max = self.shape + self.margin
+                if side == 0:
+                    slab_max = slab_max.copy()
+                    slab_max[axis] = slab_min[axis] + thickness[axis]
+                else:
+                    slab_min = slab_min.copy()
+                    slab_min[axis] = slab_max[axis] - thickness[axis]
+                self.slab_bounds.append((slab_min, slab_max))
+        # Padded tiles, keyed by slab and tile grid coordinates in the slab,
+        # once a block has been read across them.
+        self.tiles = {}
+
+    def pad(self, block_min, block_max):
+        """Read a padded block of the image."""
+        idx = [pad_indices(lo, hi, size, self.mode) for lo, hi, size in zip(block_min, block_max, self.shape)]
+        read_min = np.array([i.min() for i in idx])
+        read_max = np.array([i.max() + 1 for i in idx])
+        block = self.image[tuple(map(slice, read_min, read_max))]
+        return block[np.ix_(*[i - lo for i, lo in zip(idx, read_min)])]
+
+    def get_tile_grid(self, slab):
+        """Get the origin and shape of the tile grid of a slab."""
+        slab_min, slab_max = self.slab_bounds[slab]
+        axis = slab // 2
+        origin = self.tile_origin.copy()
+        origin[axis] = slab_min[axis]
+        tile_shape = self.tile_shape.copy()
+        tile_shape[axis] = slab_max[axis] - slab_min[axis]
+        return origin, tile_shape
+
+    def get_tile(self, slab, idx):
+        """Get a padded tile of a slab, padding it if it is not yet cached.
+
+        Returns
+        -------
+        ndarray
+            The tile.
+        ndarray
+            Lower bound of the tile in image coordinates.
+        """
+        slab_min, slab_max = self.slab_bounds[slab]
+        origin, tile_shape = self.get_tile_grid(slab)
+        tile_min = origin + np.array(idx, dtype=np.int64) * tile_shape
+        tile_max = np.minimum(tile_min + tile_shape, slab_max)
+        tile_min = np.maximum(tile_min, slab_min)
+        tile = self.tiles.get((slab, idx))
+        if tile is None:
+            tile = self.tiles[(slab, idx)] = self.pad(tile_min, tile_max)
+        return tile, tile_min
+
+    def read(self, block_min, block_max, out=None):
+        """Read a block of the image, which may extend outside it by the margin.
+
+        Parameters
+        ----------
+        block_min, block_max : ndarray
+            Extents of the block in image coordinates.
+        out : ndarray, optional
+            Array to read the block into.
+
+        Returns
+        -------
+        ndarray
+            The block, or ``out``. Unless ``out`` is provided, this may be a
+            view of the image or halo.
+        """
+        for n, (slab_min, slab_max) in enumerate(self.slab_bounds):
+            axis, side = divmod(n, 2)
+            if (block_min[axis] < 0) if side == 0 else (block_max[axis] > self.shape[axis]):
+                origin, tile_shape = self.get_tile_grid(n)
+                lo = (block_min - origin) // tile_shape
+                hi = (block_max - 1 - origin) // tile_shape + 1
+                if np.all(hi - lo == 1):
+                    tile, tile_min = self.get_tile(n, tuple(lo.tolist()))
+                    block = tile[tuple(map(slice, block_min - tile_min, block_max - tile_min))]
+                    break
+                if out is None:
+                    out = np.empty(tuple(block_max - block_min), dtype=self.image.dtype)
+                for idx in itertools.product(*[range(lo[d], hi[d]) for d in range(3)]):
+                    tile, tile_min = self.get_tile(n, idx)
+                    read_min = np.maximum(block_min, tile_min)
+                    read_max = np.minimum(block_max, tile_min + np.array(tile.shape))
+                    out[tuple(map(slice, read_min - block_min, read_max - block_min))] = \
+                        tile[tuple(map(slice, read_min - tile_min, read_max - tile_min))]
+                return out
+        else:
+            key = tuple(map(slice, block_min, block_max))
+            if out is not None and isinstance(self.image, OctreeVolume):
+                return self.image.read_into(key, out)
+            block = self.image[key]
+
+        if out is not None:
+            out[:] = block
+            return out
+        return block
+
+
 class Region(object):
     """A region (single seeded body) for flood filling.
 
@@ -52,6 +552,11 @@ class Region(object):
         extends outside the region bounds. This is passed to ``numpy.pad``.
         Defaults to ``None``, which indicates attempts to operate outside the
         region bounds are erroneous.
+    image_halo : bool or ImageHalo, optional
+        If true, image blocks extending outside the region bounds are read
+        from an ``ImageHalo`` of the image padded with ``block_padding``,
+        rather than padded as they are read. An ``ImageHalo`` of ``image``
+        may be provided to share it between regions.
 
     Attributes
     ----------
@@ -65,11 +570,18 @@ class Region(object):
     move_check_thickness : int
         Thickness in voxels to check around the move plane in each direction
         when determining which moves to queue. See ``get_moves`` method.
+    component_tracker : ComponentTracker
+        Tracks the seeded connected component of the mask as it is written,
+        for ``remask``. ``None`` if postprocessing uses a closing shape.
     """
+    # Unit vectors of move directions, in the order moves are checked.
+    MOVE_DIRECTIONS = np.array([(1, 0, 0), (-1, 0, 0),
+                                (0, 1, 0), (0, -1, 0),
+                                (0, 0, 1), (0, 0, -1)], dtype=np.int64)
 
     @staticmethod
     def from_subvolume(subvolume, **kwargs):
-        if subvolume.label_mask is not None and np.issubdtype(subvolume.label_mask.dtype, np.bool):
+        if subvolume.label_mask is not None and np.issubdtype(subvolume.label_mask.dtype, np.bool_):
             target = mask_to_output_target(subvolume.label_mask)
         else:
             target = subvolume.label_mask
@@ -83,11 +595,14 @@ class Region(object):
         subvolumes = itertools.ifilter(lambda s: s.has_uniform_seed_margin(), subvolumes)
         return itertools.imap(lambda v: Region.from_subvolume(v, **kwargs), subvolumes)
 
-    def __init__(self, image, target=None, seed_vox=None, mask=None, sparse_mask=False, block_padding=None):
+    def __init__(self, image, target=None, seed_vox=None, mask=None, sparse_mask=False, block_padding=None,
+                 image_halo=False):
         self.block_padding = block_padding
+        if image_halo and not isinstance(image_halo, ImageHalo):
+            image_halo = ImageHalo(image, block_padding)
+        self.image_halo = image_halo or None
         self.MOVE_DELTA = CONFIG.model.move_step
-        self.queue = queue.PriorityQueue()
-        self.visited = set()
+        self.queue = MoveQueue()
         self.image = image
         self.bounds = np.array(image.shape, dtype=np.int64)
         if seed_vox is None:
@@ -99,13 +614,20 @@ class Region(object):
                                    self.MOVE_DELTA)).astype(np.int64),
             self.vox_to_pos(np.array(self.bounds) - 1 - (CONFIG.model.input_fov_shape - 1) // 2),
             )
+        if self.block_padding is None:
+            grid_bounds = (self.move_bounds[0], self.move_bounds[1] + 1)
+        else:
+            grid_bounds = (np.zeros(3, dtype=np.int64), self.vox_to_pos(self.bounds - 1) + 1)
+        self.visited = MoveGrid(grid_bounds, np.bool_, False)
         self.move_check_thickness = CONFIG.model.move_check_thickness
+        # Lay out mask leaves and component tiles so that each FOV read and
+        # written for a move touches few of them.
+        leaf_shape = get_move_leaf_shape([CONFIG.model.input_fov_shape, CONFIG.model.output_fov_shape],
+                                         self.MOVE_DELTA, self.MOVE_GRID_OFFSET)
         if mask is None:
-            if isinstance(self.image, OctreeVolume):
-                self.mask = OctreeVolume(self.image.leaf_shape, (np.zeros(3), self.bounds), 'float32')
-                self.mask[:] = np.NAN
-            elif sparse_mask:
-                self.mask = OctreeVolume(CONFIG.model.training_subv_shape, (np.zeros(3), self.bounds), 'float32')
+            if isinstance(self.image, OctreeVolume) or sparse_mask:
+                self.mask = OctreeVolume(leaf_shape, (np.zeros(3), self.bounds), 'float32',
+                                         compress_after=CONFIG.volume.leaf_compress_after, background=np.NAN)
                 self.mask[:] = np.NAN
             else:
                 self.mask = np.full(self.bounds, np.NAN, dtype=np.float32)
@@ -116,7 +638,8 @@ class Region(object):
         self.bias_against_merge = False
         self.move_based_on_new_mask = False
         self.prioritize_proximity = CONFIG.model.move_priority == 'proximity'
-        self.proximity = {}
+        # L1 path distance from the seed of queued moves, or 0 if unknown.
+        self.proximity = MoveGrid(grid_bounds, np.uint16, 0)
 
         if seed_vox is None:
             seed_pos = np.floor_divide(self.move_bounds[0] + self.move_bounds[1], 2)
@@ -126,15 +649,26 @@ class Region(object):
                 'Seed position (%s) must be in region move bounds (%s, %s).' % \
                 (seed_vox, self.move_bounds[0], self.move_bounds[1])
         self.seed_pos = seed_pos
-        self.queue.put((None, seed_pos))
-        self.proximity[tuple(seed_pos)] = 1
+        self.queue.put(float('-inf'), tuple(seed_pos))
+        self.proximity[seed_pos] = 1
         self.seed_vox = self.pos_to_vox(seed_pos)
         if self.target is not None:
             self.target_offset = (self.bounds - self.target.shape) // 2
             assert np.isclose(self.target[tuple(self.seed_vox - self.target_offset)], CONFIG.model.v_true), \
                 'Seed position should be in target body.'
         self.mask[tuple(self.seed_vox)] = CONFIG.model.v_true
-        self.visited.add(tuple(self.seed_pos))
+        self.visited[self.seed_pos] = True
+
+        # The seeded component can only be tracked incrementally without
+        # morphological closing, which is not local to tiles.
+        if CONFIG.postprocessing.closing_shape is None:
+            self.component_tracker = ComponentTracker(self.bounds, leaf_shape, self.seed_vox, CONFIG.model.t_final)
+            if mask is None:
+                self.component_tracker.mark_changed(self.seed_vox, self.seed_vox + 1)
+            else:
+                self.component_tracker.mark_all_changed()
+        else:
+            self.component_tracker = None
 
     def unfilled_copy(self):
         """Clone this region in an initial state without any filling.
@@ -143,7 +677,8 @@ class Region(object):
         -------
         Region
         """
-        copy = Region(self.image, target=self.target, seed_vox=self.pos_to_vox(self.seed_pos))
+        copy = Region(self.image, target=self.target, seed_vox=self.pos_to_vox(self.seed_pos),
+                      block_padding=self.block_padding, image_halo=self.image_halo)
         copy.bias_against_merge = self.bias_against_merge
         copy.move_based_on_new_mask = self.move_based_on_new_mask
 
@@ -154,7 +689,7 @@ class Region(object):
             return a >= CONFIG.model.t_final
 
         if isinstance(self.mask, OctreeVolume):
-            hard_mask = self.mask.map_copy(np.bool, threshold, threshold)
+            hard_mask = self.mask.map_copy(np.bool_, threshold, threshold)
         else:
             hard_mask = threshold(self.mask)
 
@@ -167,11 +702,12 @@ class Region(object):
         return (pos * self.MOVE_DELTA).astype(np.int64) + self.MOVE_GRID_OFFSET
 
     def pos_in_bounds(self, pos):
+        """Check whether a position, or each of an array of positions, is in bounds."""
         if self.block_padding is None:
-            return np.all(np.greater_equal(pos, self.move_bounds[0])) and \
-                np.all(np.less_equal(pos, self.move_bounds[1]))
+            return np.all(np.greater_equal(pos, self.move_bounds[0]), axis=-1) & \
+                np.all(np.less_equal(pos, self.move_bounds[1]), axis=-1)
         else:
-            return np.all(np.less(self.pos_to_vox(pos), self.bounds)) and np.all(pos >= 0)
+            return np.all(np.less(self.pos_to_vox(pos), self.bounds), axis=-1) & np.all(pos >= 0, axis=-1)
 
     def get_block_bounds(self, vox, shape, offset=None):
         """Get the bounds of a block by center and shape, accounting padding.
@@ -241,19 +777,52 @@ class Region(object):
             in the move plane in that direction.
         """
         moves = []
-        ctr = np.asarray(mask.shape) // 2
-        for move in map(np.array, [(1, 0, 0), (-1, 0, 0),
-                                   (0, 1, 0), (0, -1, 0),
-                                   (0, 0, 1), (0, 0, -1)]):
+        for move, plane in zip(self.MOVE_DIRECTIONS, self.get_move_planes(mask.shape)):
+            moves.append({'move': move,
+                          'v': mask[plane].max()})
+        return moves
+
+    def get_move_planes(self, shape):
+        """Get keys of the move check slab in each move direction.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            Shape of the mask block.
+
+        Returns
+        -------
+        list of tuple of slice
+            Keys in the order of ``MOVE_DIRECTIONS``.
+        """
+        planes = []
+        ctr = np.asarray(shape) // 2
+        for move in self.MOVE_DIRECTIONS:
             plane_min = ctr - (-2 * np.maximum(move, 0) + 1) * self.MOVE_DELTA \
                             - np.abs(move) * (self.move_check_thickness - 1)
             plane_max = ctr + (+2 * np.minimum(move, 0) + 1) * self.MOVE_DELTA \
                             + np.abs(move) * (self.move_check_thickness - 1) + 1
-            moves.append({'move': move,
-                          'v': mask[plane_min[0]:plane_max[0],
-                                    plane_min[1]:plane_max[1],
-                                    plane_min[2]:plane_max[2]].max()})
-        return moves
+            planes.append(tuple(map(slice, plane_min, plane_max)))
+        return planes
+
+    def get_batch_moves(self, masks):
+        """Get maximum probability in each move direction for a batch of masks.
+
+        Parameters
+        ----------
+        masks : ndarray
+            Mask blocks stacked along the first axis.
+
+        Returns
+        -------
+        ndarray
+            Maximum probabilities of shape (batch, 6), with move directions
+            in the order of ``MOVE_DIRECTIONS``.
+        """
+        values = np.empty((masks.shape[0], len(self.MOVE_DIRECTIONS)), dtype=masks.dtype)
+        for n, plane in enumerate(self.get_move_planes(masks.shape[1:])):
+            values[:, n] = masks[(slice(None),) + plane].max(axis=(1, 2, 3))
+        return values
 
     def check_move_neighborhood(self, mask):
         """Given a mask block, check if any central voxels meet move threshold.
@@ -274,10 +843,32 @@ class Region(object):
         ctr = np.asarray(mask.shape) // 2
         neigh_min = ctr - self.MOVE_DELTA
         neigh_max = ctr + self.MOVE_DELTA + 1
-        neighborhood = mask[map(slice, neigh_min, neigh_max)]
+        neighborhood = mask[tuple(map(slice, neigh_min, neigh_max))]
         return np.nanmax(neighborhood) >= CONFIG.model.t_move
 
-    def add_mask(self, mask_block, mask_pos):
+    def check_block_neighborhood(self, block_min, block_max):
+        """Check ``check_move_neighborhood`` for a block of the mask.
+
+        For sparse masks this reduces the neighborhood in the mask directly,
+        without reading the block.
+        """
+        if isinstance(self.mask, OctreeVolume):
+            ctr = block_min + (block_max - block_min) // 2
+            neighborhood = tuple(map(slice, ctr - self.MOVE_DELTA, ctr + self.MOVE_DELTA + 1))
+            return self.mask.nanmax(neighborhood) >= CONFIG.model.t_move
+        return self.check_move_neighborhood(self.mask[tuple(map(slice, block_min, block_max))])
+
+    def write_mask(self, mask_block, mask_pos):
+        """Write a predicted mask block centered at a position to the mask.
+
+        Returns
+        -------
+        mask_block : ndarray
+            The part of the block inside the region bounds.
+        mask_min, mask_max, pad_pre, pad_post : ndarray
+            Bounds of the written block and its padding, as returned by
+            ``get_block_bounds``.
+        """
         mask_vox = self.pos_to_vox(mask_pos)
         mask_min, mask_max, pad_pre, pad_post = self.get_block_bounds(mask_vox, np.asarray(mask_block.shape))
 
@@ -285,32 +876,35 @@ class Region(object):
             assert self.block_padding is not None, \
                 'Position block extends out of region bounds, but padding is not enabled: {}'.format(mask_pos)
             end = [-x if x != 0 else None for x in pad_post]
-            mask_block = mask_block[list(map(slice, pad_pre, end))]
-        current_mask = self.mask[mask_min[0]:mask_max[0],
-                                 mask_min[1]:mask_max[1],
-                                 mask_min[2]:mask_max[2]]
+            mask_block = mask_block[tuple(map(slice, pad_pre, end))]
+        mask_key = tuple(map(slice, mask_min, mask_max))
 
         if self.bias_against_merge:
-            update_mask = np.isnan(current_mask) | (current_mask > 0.5) | np.less(mask_block, current_mask)
-            current_mask[update_mask] = mask_block[update_mask]
+            if isinstance(self.mask, OctreeVolume):
+                self.mask.update(mask_key, self.merge_mask_block, mask_block)
+            else:
+                self.merge_mask_block(self.mask[mask_key], mask_block)
         else:
-            current_mask[:] = mask_block
+            self.mask[mask_key] = mask_block
+        if self.component_tracker is not None:
+            self.component_tracker.mark_changed(mask_min, mask_max)
 
-        self.mask[mask_min[0]:mask_max[0],
-                  mask_min[1]:mask_max[1],
-                  mask_min[2]:mask_max[2]] = current_mask
+        return mask_block, mask_min, mask_max, pad_pre, pad_post
+
+    def add_mask(self, mask_block, mask_pos):
+        mask_block, mask_min, mask_max, pad_pre, pad_post = self.write_mask(mask_block, mask_pos)
 
-        if self.move_based_on_new_mask:
+        if self.move_based_on_new_mask or not self.bias_against_merge:
             move_check_block = mask_block
         else:
-            move_check_block = current_mask
+            move_check_block = self.get_mask_block(mask_min, mask_max)
         pad_width = list(zip(list(pad_pre), list(pad_post)))
         move_check_block = np.pad(move_check_block, pad_width, 'constant')
 
         new_moves = self.get_moves(move_check_block)
         if self.prioritize_proximity:
-            proximity = self.proximity[tuple(mask_pos)] + 1
-            del self.proximity[tuple(mask_pos)]
+            proximity = int(self.proximity[mask_pos]) + 1
+            self.proximity[mask_pos] = 0
         else:
             proximity = None
 
@@ -318,15 +912,107 @@ class Region(object):
             new_pos = mask_pos + move['move']
             if not self.pos_in_bounds(new_pos):
                 continue
-            if tuple(new_pos) not in self.visited and move['v'] >= CONFIG.model.t_move:
-                self.visited.add(tuple(new_pos))
-                priority = self.get_move_priority(new_pos, move['v'], proximity)
-                self.queue.put((priority, tuple(new_pos)))
+            if move['v'] < CONFIG.model.t_move:
+                continue
+            self.queue_move(new_pos, move['v'], proximity)
+
+    def queue_move(self, pos, value, proximity=None):
+        """Queue a move to a position if it has not yet been visited."""
+        if not self.visited[pos]:
+            self.visited[pos] = True
+            priority = self.get_move_priority(pos, value, proximity)
+            self.queue.put(priority, tuple(pos))
+        elif self.prioritize_proximity and tuple(pos) in self.queue:
+            # Moves still queued are reprioritized if reached by a
+            # shorter path.
+            priority = self.get_move_priority(pos, value, proximity)
+            self.queue.put(priority, tuple(pos))
+
+    def add_masks(self, mask_blocks, mask_positions):
+        """Add a batch of predicted mask blocks and queue their moves.
+
+        This is equivalent to calling ``add_mask`` for each block in order,
+        but move planes are reduced, and candidate moves checked and queued,
+        for the whole batch at once.
+
+        Parameters
+        ----------
+        mask_blocks : ndarray
+            Mask blocks stacked along the first axis.
+        mask_positions : sequence of ndarray
+            Move grid position of each block.
+        """
+        if self.bias_against_merge and not self.move_based_on_new_mask:
+            # Moves are checked in the mask merged with each block, which
+            # depends on the blocks added before it.
+            for mask_block, mask_pos in zip(mask_blocks, mask_positions):
+                self.add_mask(mask_block, mask_pos)
+            return
+
+        move_check_blocks = mask_blocks
+        for n, mask_pos in enumerate(mask_positions):
+            _, _, _, pad_pre, pad_post = self.write_mask(mask_blocks[n], mask_pos)
+            if np.any(pad_pre) or np.any(pad_post):
+                # Parts of the block outside the region do not allow moves.
+                if move_check_blocks is mask_blocks:
+                    move_check_blocks = mask_blocks.copy()
+                inside = np.zeros(mask_blocks.shape[1:], dtype=np.bool_)
+                inside[tuple(map(slice, pad_pre, np.asarray(mask_blocks.shape[1:]) - pad_post))] = True
+                move_check_blocks[n][~inside] = 0
+
+        values = self.get_batch_moves(move_check_blocks)
+        positions = np.asarray(mask_positions)[:, np.newaxis, :] + self.MOVE_DIRECTIONS[np.newaxis, :, :]
+        candidates = (values >= CONFIG.model.t_move) & self.pos_in_bounds(positions)
+
+        if self.prioritize_proximity:
+            for n, mask_pos in enumerate(mask_positions):
+                proximity = int(self.proximity[mask_pos]) + 1
+                self.proximity[mask_pos] = 0
+                for d in np.flatnonzero(candidates[n]):
+                    self.queue_move(positions[n, d], values[n, d], proximity)
+            return
+
+        positions = positions[candidates]
+        values = values[candidates]
+        if not len(positions):
+            return
+        # Only the first move to each unvisited position is queued.
+        _, first = np.unique(positions, axis=0, return_index=True)
+        first.sort()
+        positions = positions[first]
+        values = values[first]
+        unvisited = ~self.visited.get_many(positions)
+        positions = positions[unvisited]
+        values = values[unvisited]
+        self.visited.set_many(positions, True)
+        if CONFIG.model.move_priority == 'random':
+            priorities = np.random.rand(len(values))
+        else:
+            priorities = -values
+        self.queue.put_many(priorities.tolist(), [tuple(p) for p in positions.tolist()])
+
+    @staticmethod
+    def merge_mask_block(current_mask, mask_block):
+        """Update a mask block in place, biased against merge.
+
+        Mask values are only overwritten if they are unset, greater than 0.5,
+        or greater than the new value.
+        """
+        update_mask = np.isnan(current_mask) | (current_mask > 0.5) | np.less(mask_block, current_mask)
+        current_mask[update_mask] = mask_block[update_mask]
+
+    def get_mask_block(self, block_min, block_max):
+        """Get a copy of a block of the mask."""
+        mask_key = tuple(map(slice, block_min, block_max))
+        if isinstance(self.mask, OctreeVolume):
+            return self.mask.read_into(mask_key, np.empty(tuple(block_max - block_min), dtype=self.mask.dtype))
+        return self.mask[mask_key].copy()
 
     def get_move_priority(self, pos, value, proximity=None):
         if CONFIG.model.move_priority == 'proximity':
             priority = -value
-            self.proximity[tuple(pos)] = min(self.proximity.get(tuple(pos), proximity), proximity)
+            if not self.proximity[pos] or proximity < self.proximity[pos]:
+                self.proximity[pos] = proximity
             priority /= proximity
         elif CONFIG.model.move_priority == 'random':
             priority = np.random.rand()
@@ -335,57 +1021,90 @@ class Region(object):
 
         return priority
 
-    def get_next_block(self):
-        mask_block = None
+    def get_next_block(self, buffers=None, index=0):
+        """Take the next move from the queue and get its blocks.
 
-        while mask_block is None:
-            try:
-                queued_move = self.queue.get_nowait()
-            except queue.Empty:
-                return None
+        Parameters
+        ----------
+        buffers : BatchInputBuffers, optional
+            If provided, the image and mask blocks are written into this
+            batch's buffers rather than newly allocated.
+        index : int, optional
+            Index of the move in ``buffers``.
 
-            next_pos = np.asarray(queued_move[1])
-            next_vox = self.pos_to_vox(next_pos)
-            block_min, block_max, pad_pre, pad_post = self.get_block_bounds(next_vox, CONFIG.model.input_fov_shape)
+        Returns
+        -------
+        dict
+            Blocks for the move, as returned by ``get_move_block``, or
+            ``None`` if the queue is exhausted.
+        """
+        while self.queue:
+            _, next_pos = self.queue.pop()
+            next_pos = np.asarray(next_pos)
+
+            if not self.recheck_move(next_pos):
+                # Remove from the visited set: move was not taken, but later
+                # moves could queue it.
+                self.visited[next_pos] = False
+                continue
 
-            assert self.block_padding is not None or not (np.any(pad_pre) or np.any(pad_post)), \
-                'Position block extends out of region bounds, but padding is not enabled: {}'.format(next_pos)
+            return self.get_move_block(next_pos, buffers, index)
 
-            mask_block = self.mask[block_min[0]:block_max[0],
-                                   block_min[1]:block_max[1],
-                                   block_min[2]:block_max[2]].copy()
+        return None
 
-            mask_block[np.isnan(mask_block)] = CONFIG.model.v_false
+    def recheck_move(self, pos):
+        """Check that there is still some t_move threshold mask near a move."""
+        next_vox = self.pos_to_vox(pos)
+        block_min, block_max, pad_pre, pad_post = self.get_block_bounds(next_vox, CONFIG.model.input_fov_shape)
 
-            # Check that there is still some t_move threshold mask near the move.
-            if CONFIG.model.move_recheck and not (
-               np.array_equal(next_pos, self.seed_pos) or self.check_move_neighborhood(mask_block)):
-                logging.debug('Skipping move: no threshold mask in cube around voxel %s', np.array_str(next_vox))
-                # Remove from the visited set: move was not taken, but later
-                # moves could queue it.
-                self.visited.remove(tuple(next_pos))
-                mask_block = None
+        assert self.block_padding is not None or not (np.any(pad_pre) or np.any(pad_post)), \
+            'Position block extends out of region bounds, but padding is not enabled: {}'.format(pos)
+
+        if CONFIG.model.move_recheck and not (
+           np.array_equal(pos, self.seed_pos) or self.check_block_neighborhood(block_min, block_max)):
+            logging.debug('Skipping move: no threshold mask in cube around voxel %s', np.array_str(next_vox))
+            return False
+        return True
 
-        image_block = self.image[block_min[0]:block_max[0],
-                                 block_min[1]:block_max[1],
-                                 block_min[2]:block_max[2]]
+    def get_move_block(self, next_pos, buffers=None, index=0):
+        """Get the input blocks and target for a move to a position.
 
-        if np.any(pad_pre) or np.any(pad_post):
-            assert self.block_padding is not None, \
-                'Position block extends out of region bounds, but padding is not enabled: {}'.format(next_pos)
-            pad_width = zip(list(pad_pre), list(pad_post))
-            image_block = np.pad(image_block, pad_width, self.block_padding)
-            mask_block = np.pad(mask_block, pad_width, self.block_padding)
+        Parameters
+        ----------
+        next_pos : ndarray
+            Position of the move on the move grid.
+        buffers : BatchInputBuffers, optional
+            If provided, the image and mask blocks are written into this
+            batch's buffers rather than newly allocated.
+        index : int, optional
+            Index of the move in ``buffers``.
+
+        Returns
+        -------
+        dict
+            Image, mask and target blocks and position of the move.
+        """
+        next_vox = self.pos_to_vox(next_pos)
+        block_min, block_max, pad_pre, pad_post = self.get_block_bounds(next_vox, CONFIG.model.input_fov_shape)
+        assert self.block_padding is not None or not (np.any(pad_pre) or np.any(pad_post)), \
+            'Position block extends out of region bounds, but padding is not enabled: {}'.format(next_pos)
+
+        if buffers is not None:
+            image_block, mask_block = buffers.get_blocks(index)
+        else:
+            image_block = mask_block = None
+
+        if self.image_halo is not None:
+            image_block = self.image_halo.read(block_min - pad_pre, block_max + pad_post, image_block)
+        else:
+            image_block = self.read_block(self.image, block_min, block_max, pad_pre, pad_post, image_block)
+        mask_block = self.read_block(self.mask, block_min, block_max, pad_pre, pad_post, mask_block, copy=True)
+        mask_block[np.isnan(mask_block)] = CONFIG.model.v_false
 
         if self.target is not None:
             block_min, block_max, pad_pre, pad_post = self.get_block_bounds(
                     next_vox - self.target_offset, CONFIG.model.output_fov_shape, self.target_offset)
-            target_block = self.target[block_min[0]:block_max[0],
-                                       block_min[1]:block_max[1],
-                                       block_min[2]:block_max[2]]
-            if np.any(pad_pre) or np.any(pad_post):
-                pad_width = zip(list(pad_pre), list(pad_post))
-                target_block = np.pad(target_block, pad_width, self.block_padding)
+            target_block = self.read_block(self.target, block_min, block_max, pad_pre, pad_post)
         else:
             target_block = None
 
@@ -393,10 +1112,152 @@ class Region(object):
             'Image wrong shape: {}'.format(image_block.shape)
         assert mask_block.shape == tuple(CONFIG.model.input_fov_shape), \
             'Mask wrong shape: {}'.format(mask_block.shape)
-        return {'image': image_block,
-                'mask': mask_block,
-                'target': target_block,
-                'position': next_pos}
+        block_data = {'image': image_block,
+                      'mask': mask_block,
+                      'target': target_block,
+                      'position': next_pos}
+        if buffers is not None:
+            block_data['buffers'] = buffers
+            block_data['buffer_index'] = index
+        return block_data
+
+    def read_block(self, volume, block_min, block_max, pad_pre, pad_post, out=None, copy=False):
+        """Read a block of a region volume, padding it outside the region bounds.
+
+        Parameters
+        ----------
+        volume : ndarray or diluvian.octrees.OctreeVolume
+        block_min, block_max, pad_pre, pad_post : ndarray
+            Bounds of the block and its padding, as returned by
+            ``get_block_bounds``.
+        out : ndarray, optional
+            Array to read the block into.
+        copy : bool, optional
+            Whether the block must be a copy rather than a view of the volume.
+
+        Returns
+        -------
+        ndarray
+            The block, or ``out``.
+        """
+        key = tuple(map(slice, block_min, block_max))
+        padded = np.any(pad_pre) or np.any(pad_post)
+        if (out is not None or copy) and not padded and isinstance(volume, OctreeVolume):
+            # Reads within a single leaf are otherwise views of its data.
+            if out is None:
+                out = np.empty(tuple(block_max - block_min), dtype=volume.dtype)
+            return volume.read_into(key, out)
+
+        block = volume[key]
+        if padded:
+            block = self.pad_block(block, pad_pre, pad_post)
+        elif copy and out is None:
+            block = block.copy()
+
+        if out is not None:
+            out[:] = block
+            return out
+        return block
+
+    def pad_block(self, block, pad_pre, pad_post):
+        """Pad a block read inside the region bounds with ``block_padding``."""
+        if self.block_padding in ('edge', 'reflect', 'symmetric', 'wrap') and \
+                np.all(np.maximum(pad_pre, pad_post) < block.shape):
+            # Gather only along padded axes, which avoids the overhead of
+            # ``numpy.pad`` for the small blocks read for moves.
+            for axis, (pre, post, size) in enumerate(zip(pad_pre, pad_post, block.shape)):
+                if pre or post:
+                    block = np.take(block, pad_indices(-pre, size + post, size, self.block_padding), axis=axis)
+            return block
+        return np.pad(block, list(zip(pad_pre, pad_post)), self.block_padding)
+
+    def get_speculative_batch(self, size, buffers=None):
+        """Get blocks for moves from the top of the queue that do not affect each other.
+
+        The first move is taken as by ``get_next_block``. Further moves are
+        taken in queue order until the batch is full, or a move's input field
+        of view overlaps the output field of view of a move already in the
+        batch or fails its move recheck. That move is returned to the queue
+        to be retaken in a later batch.
+
+        Parameters
+        ----------
+        size : int
+            Maximum number of moves in the batch.
+        buffers : BatchInputBuffers, optional
+            If provided, the image and mask blocks are written into these
+            buffers rather than newly allocated.
+
+        Returns
+        -------
+        batch_block_data : list of dict
+            Blocks for each move, as returned by ``get_next_block``.
+        priorities : list of float
+            Queue priority of each move.
+        """
+        batch_block_data = []
+        priorities = []
+        outputs = []
+        while self.queue and len(batch_block_data) < size:
+            priority, pos = self.queue.pop()
+            next_pos = np.asarray(pos)
+            next_vox = self.pos_to_vox(next_pos)
+            input_min, input_max = self.get_block_bounds(next_vox, CONFIG.model.input_fov_shape)[:2]
+            if batch_block_data:
+                # Whether this move's input may be affected by earlier moves
+                # in the batch depends on their outputs, so it is deferred.
+                conflict = any(np.all(input_min < out_max) and np.all(out_min < input_max)
+                               for out_min, out_max in outputs)
+                if conflict or not self.recheck_move(next_pos):
+                    self.queue.put(priority, pos)
+                    break
+            elif not self.recheck_move(next_pos):
+                self.visited[next_pos] = False
+                continue
+            batch_block_data.append(self.get_move_block(next_pos, buffers, len(batch_block_data)))
+            priorities.append(priority)
+            outputs.append(self.get_block_bounds(next_vox, CONFIG.model.output_fov_shape)[:2])
+
+        return batch_block_data, priorities
+
+    def add_speculative_masks(self, mask_blocks, batch_block_data, priorities):
+        """Add predicted masks of a speculative batch while they match queue order.
+
+        Each move after the first is only added if it would still be the
+        next move taken from the queue after adding the moves before it. Its
+        input blocks are unaffected by the earlier moves in the batch, so its
+        prediction is the same as if the batch had been filled one move at a
+        time. Once a move would not be next, it and the rest of the batch are
+        left in the queue and their predictions discarded.
+
+        Parameters
+        ----------
+        mask_blocks : ndarray
+            Predicted mask blocks stacked along the first axis.
+        batch_block_data : list of dict
+            Blocks for each move, as returned by ``get_speculative_batch``.
+        priorities : list of float
+            Queue priority of each move.
+
+        Returns
+        -------
+        int
+            Number of moves added.
+        """
+        # Return moves after the first to the queue, so that adding earlier
+        # moves treats them as not yet taken.
+        for block_data, priority in zip(batch_block_data[1:], priorities[1:]):
+            self.queue.put(priority, tuple(block_data['position']))
+
+        for n, block_data in enumerate(batch_block_data):
+            if n > 0:
+                priority, pos = self.queue.pop()
+                if pos != tuple(block_data['position']):
+                    self.queue.put(priority, pos)
+                    return n
+            self.add_masks(mask_blocks[n:n + 1], [block_data['position']])
+
+        return len(batch_block_data)
 
     def prediction_metric(self, metric, threshold=True, **kwargs):
         pred_bounds = [None, None]
@@ -422,27 +1283,102 @@ class Region(object):
 
     def remask(self):
         """Reset the mask based on the seeded connected component.
+
+        Mask values of voxels not in the seeded connected component are
+        clipped so that they cannot generate moves. For sparse masks, the
+        mask outside the bounds of the voxels at or above ``t_final`` is
+        reset.
+
+        If the region tracks its seeded component, only tiles of the mask
+        changed since the last remask or with components not connected to
+        the seed are relabeled and clipped, and only the region written since
+        the last remask is reset, so that remasking costs in proportion to
+        the moves since the last remask rather than to the size of the body.
+        The result is the same as that of ``remask_body``.
+
+        Returns
+        -------
+        bool
+            Whether the seed is in the mask.
+        """
+        tracker = self.component_tracker
+        if tracker is None:
+            return self.remask_body()
+
+        changed = tracker.changed
+        seeded_labels = tracker.get_seeded_labels(self.mask)
+        if seeded_labels is None:
+            return False
+        bounds = tracker.get_bounds()
+        clip = 0.9 * CONFIG.model.t_move
+
+        tiles = changed.union(tile for tile, seeded in six.iteritems(seeded_labels) if not seeded[1:].all())
+        for tile in tiles:
+            tile_min, tile_max = tracker.get_tile_bounds(tile)
+            mask_block = self.get_mask_block(tile_min, tile_max)
+            if tile in tracker.labels:
+                unseeded = ~seeded_labels[tile][tracker.labels[tile][0]]
+            else:
+                unseeded = np.ones(mask_block.shape, dtype=np.bool_)
+            clipped = unseeded & (mask_block > clip)
+            if not clipped.any():
+                continue
+            mask_block[clipped] = clip
+            self.mask[tuple(map(slice, tile_min, tile_max))] = mask_block
+            tracker.mark_changed(tile_min, tile_max)
+
+        if isinstance(self.mask, OctreeVolume):
+            # Only regions written since the last remask, or inside its
+            # bounds, may be set outside the current bounds.
+            written_min, written_max = tracker.written_bounds
+            reset_min = np.maximum(written_min, 0)
+            reset_max = np.minimum(written_max, self.bounds)
+            for axis in range(3):
+                for lower, upper in [(reset_min[axis], bounds[0][axis]), (bounds[1][axis], reset_max[axis])]:
+                    if lower >= upper:
+                        continue
+                    key_min = reset_min.copy()
+                    key_max = reset_max.copy()
+                    key_min[axis] = lower
+                    key_max[axis] = upper
+                    if np.all(key_min < key_max):
+                        self.mask[tuple(map(slice, key_min, key_max))] = np.NAN
+                # Later axes only need to be reset within the bounds of this one.
+                reset_min[axis] = max(reset_min[axis], bounds[0][axis])
+                reset_max[axis] = min(reset_max[axis], bounds[1][axis])
+            tracker.written_bounds = bounds
+        return True
+
+    def remask_body(self):
+        """Reset the whole mask based on the seeded connected component of the body.
         """
         body = self.to_body()
         if not body.is_seed_in_mask():
             return False
         new_mask_bin, bounds = body.get_seeded_component(CONFIG.postprocessing.closing_shape)
-        new_mask_bin = new_mask_bin.astype(np.bool)
+        new_mask_bin = new_mask_bin.astype(np.bool_)
 
-        mask_block = self.mask[list(map(slice, bounds[0], bounds[1]))].copy()
+        if isinstance(self.mask, OctreeVolume):
+            mask_block = self.mask.to_dense(bounds=bounds)
+        else:
+            mask_block = self.mask[tuple(map(slice, bounds[0], bounds[1]))].copy()
         # Clip any values not in the seeded connected component so that they
         # cannot not generate moves when rechecking.
         mask_block[~new_mask_bin] = np.clip(mask_block[~new_mask_bin], None, 0.9 * CONFIG.model.t_move)
 
         self.mask[:] = np.NAN
-        self.mask[list(map(slice, bounds[0], bounds[1]))] = mask_block
+        self.mask[tuple(map(slice, bounds[0], bounds[1]))] = mask_block
+        if isinstance(self.mask, OctreeVolume):
+            self.mask.compact()
+        if self.component_tracker is not None:
+            self.component_tracker.mark_all_changed()
         return True
 
     class EarlyFillTermination(Exception):
         pass
 
     def fill(self, model, progress=False, move_batch_size=1, max_moves=None, stopping_callback=None,
-             remask_interval=None, generator=False):
+             remask_interval=None, generator=False, speculative=False, prediction_cache=None):
         """Flood fill this region.
 
         Note this returns a generator, so must be iterated to start filling.
@@ -473,12 +1409,52 @@ class Region(object):
             connected components.
         generator : bool
             If true, each tuple of batch inputs and outputs will be yielded.
+            Input blocks are written into buffers reused by later batches,
+            so must be copied to be kept after the next batch.
+        speculative : bool, optional
+            If true, batches only contain moves whose inputs are not affected
+            by the outputs of other moves in the batch, and only predictions
+            of moves that would be taken next are kept, so that filling has
+            the same result as with a ``move_batch_size`` of 1. Batches are
+            also cut short so that filling remasks and stops after the same
+            moves. See ``get_speculative_batch`` and
+            ``add_speculative_masks``.
+        prediction_cache : PredictionCache, optional
+            If provided, moves whose inputs have been predicted before are
+            taken from this cache rather than predicted by the model.
 
         Yields
         ------
         tuple
             Batch inputs and outputs if ``generator`` is true.
 
+        Raises
+        ------
+        Region.EarlyFillTermination
+            If filling was terminated early due to either exceeding the
+            maximum number of moves or the stopping callback.
+        """
+        steps = self.fill_steps(progress=progress, move_batch_size=move_batch_size, max_moves=max_moves,
+                                stopping_callback=stopping_callback, remask_interval=remask_interval,
+                                speculative=speculative)
+        for batch_block_data in steps:
+            output = predict_batch(model, batch_block_data, prediction_cache)
+            result = steps.send(output)
+            if generator:
+                yield result
+
+    def fill_steps(self, progress=False, move_batch_size=1, max_moves=None, stopping_callback=None,
+                   remask_interval=None, speculative=False):
+        """Flood fill this region, with predictions made by the caller.
+
+        This is a coroutine driving ``fill``, which allows predictions for
+        several regions to be made together. See ``fill`` for parameters.
+
+        Each batch of moves is yielded as a list of block data dicts, as
+        returned by ``get_next_block``. The model output for the batch must
+        then be sent to the generator, which adds it to the region and
+        yields a tuple of the batch block data and output that were added.
+
         Raises
         ------
         Region.EarlyFillTermination
@@ -493,38 +1469,48 @@ class Region(object):
         STOP_CHECK_INTERVAL = 100
         early_termination = False
 
+        buffers = BatchInputBuffers(move_batch_size)
+
         if progress:
             pbar = tqdm(desc='Move queue', position=progress)
-        while not self.queue.empty():
-            batch_block_data = [self.get_next_block() for _ in
-                                itertools.takewhile(lambda _: not self.queue.empty(), range(move_batch_size))]
-            batch_block_data = [b for b in batch_block_data if b is not None]
+        while self.queue:
+            if speculative:
+                # Stop and remask after the same moves as with a batch size of 1.
+                size = min(move_batch_size, last_remask + remask_interval - moves)
+                if max_moves is not None:
+                    size = min(size, max_moves + 1 - moves)
+                batch_block_data, priorities = self.get_speculative_batch(int(size), buffers)
+            else:
+                batch_block_data = []
+                while self.queue and len(batch_block_data) < move_batch_size:
+                    block_data = self.get_next_block(buffers, len(batch_block_data))
+                    if block_data is not None:
+                        batch_block_data.append(block_data)
             batch_moves = len(batch_block_data)
             if batch_moves == 0:
                 break
-            moves += batch_moves
-            if progress:
-                pbar.total = moves + self.queue.qsize()
-                pbar.set_description(str(self.seed_vox) + ' Move ' + str(batch_block_data[-1]['position']))
-                pbar.update(batch_moves)
 
-            if stopping_callback is not None and moves - last_check >= STOP_CHECK_INTERVAL:
-                last_check = moves
+            if stopping_callback is not None and moves + batch_moves - last_check >= STOP_CHECK_INTERVAL:
+                last_check = moves + batch_moves
                 if stopping_callback(self):
                     early_termination = True
                     break
 
-            image_input = np.concatenate([pad_dims(b['image']) for b in batch_block_data])
-            mask_input = np.concatenate([pad_dims(b['mask']) for b in batch_block_data])
-
-            output = model.predict_on_batch({'image_input': image_input,
-                                             'mask_input': mask_input})
+            output = yield batch_block_data
 
-            for ind, block_data in enumerate(batch_block_data):
-                self.add_mask(output[ind, :, :, :, 0], block_data['position'])
+            if speculative:
+                batch_moves = self.add_speculative_masks(output[:, :, :, :, 0], batch_block_data, priorities)
+                batch_block_data = batch_block_data[:batch_moves]
+                output = output[:batch_moves]
+            else:
+                self.add_masks(output[:, :, :, :, 0], [b['position'] for b in batch_block_data])
+            moves += batch_moves
+            if progress:
+                pbar.total = moves + len(self.queue)
+                pbar.set_description(str(self.seed_vox) + ' Move ' + str(batch_block_data[-1]['position']))
+                pbar.update(batch_moves)
 
-            if generator:
-                yield (batch_block_data, output)
+            yield (batch_block_data, output)
 
             if max_moves is not None and moves > max_moves:
                 early_termination = True
@@ -542,8 +1528,6 @@ class Region(object):
         if early_termination:
             raise Region.EarlyFillTermination()
 
-        return
-
     def fill_animation(self, movie_filename, *args, **kwargs):
         """Create an animated movie of the filling process for this region.
 
@@ -805,6 +1789,287 @@ class Region(object):
         mlab.show()
 
 
+class BatchInputBuffers(object):
+    """Preallocated model inputs for batches of moves.
+
+    Blocks of each move in a batch are written into these buffers by
+    ``Region.get_move_block``, so that when the moves of a batch fill the
+    buffers from the start, the model inputs are views of the buffers and
+    neither blocks nor inputs are allocated for each batch.
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of moves in a batch.
+    shape : sequence of int, optional
+        Shape of the input field of view. Defaults to the configured model
+        input field of view shape.
+    """
+    def __init__(self, size, shape=None):
+        if shape is None:
+            shape = CONFIG.model.input_fov_shape
+        shape = (size,) + tuple(shape) + (1,)
+        self.image = np.empty(shape, dtype=np.float32)
+        self.mask = np.empty(shape, dtype=np.float32)
+
+    def __len__(self):
+        return self.image.shape[0]
+
+    def get_blocks(self, index):
+        """Get the image and mask blocks of a move in the batch."""
+        return self.image[index, ..., 0], self.mask[index, ..., 0]
+
+    def get_inputs(self, size):
+        """Get the model inputs of the first moves in the batch."""
+        return {'image_input': self.image[:size],
+                'mask_input': self.mask[:size]}
+
+
+def get_batch_inputs(batch_block_data):
+    """Stack the blocks of a batch of moves into model inputs.
+
+    Parameters
+    ----------
+    batch_block_data : list of dict
+        Blocks for each move, as returned by ``Region.get_next_block``.
+
+    Returns
+    -------
+    dict
+        Image and mask inputs keyed by model input name. If the blocks are
+        the moves of a ``BatchInputBuffers`` in order, these are views of
+        its buffers.
+    """
+    buffers = batch_block_data[0].get('buffers')
+    if buffers is not None and all(b.get('buffers') is buffers and b['buffer_index'] == n
+                                   for n, b in enumerate(batch_block_data)):
+        return buffers.get_inputs(len(batch_block_data))
+    return {'image_input': np.concatenate([pad_dims(b['image']) for b in batch_block_data]),
+            'mask_input': np.concatenate([pad_dims(b['mask']) for b in batch_block_data])}
+
+
+def predict_batch(model, batch_block_data, prediction_cache=None):
+    """Predict output masks for a batch of moves.
+
+    Parameters
+    ----------
+    model : keras.models.Model
+    batch_block_data : list of dict
+        Blocks for each move, as returned by ``Region.get_next_block``.
+    prediction_cache : PredictionCache, optional
+        If provided, moves whose inputs have been predicted before are taken
+        from this cache.
+
+    Returns
+    -------
+    ndarray
+        Model output for the batch.
+    """
+    if prediction_cache is not None:
+        return prediction_cache.predict(model, batch_block_data)
+    return model.predict_on_batch(get_batch_inputs(batch_block_data))
+
+
+class PredictionCache(object):
+    """Bounded least-recently-used cache of model predictions for moves.
+
+    Predictions are keyed by a hash of the image and mask input blocks of a
+    move and the identity of the model object, so that moves with inputs
+    identical to ones already predicted, such as when refilling a region from
+    its seed, remasking, or resuming, are not predicted again. A cache may be
+    shared between regions.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Byte budget for cached predictions.
+    mask_levels : int, optional
+        If provided, mask inputs are quantized to this many levels between 0
+        and 1 for keying, so that moves with nearly identical masks share
+        predictions. By default masks must be bit-identical.
+
+    Attributes
+    ----------
+    nbytes : int
+        Current size of cached predictions.
+    hits, misses, evictions : int
+        Counts of moves whose predictions were cached, moves predicted, and
+        predictions evicted, respectively.
+    """
+    def __init__(self, max_bytes, mask_levels=None):
+        self.max_bytes = int(max_bytes)
+        self.mask_levels = mask_levels
+        self.predictions = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.predictions)
+
+    @property
+    def hit_rate(self):
+        """Fraction of moves whose predictions were cached."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_key(self, model, block_data):
+        digest = hashlib.sha1()
+        mask = block_data['mask']
+        if self.mask_levels is not None:
+            mask = np.rint(np.clip(mask, 0, 1) * (self.mask_levels - 1)).astype(np.uint32)
+        for block in (block_data['image'], mask):
+            block = np.ascontiguousarray(block)
+            digest.update(str((block.dtype.str, block.shape)).encode('ascii'))
+            digest.update(block)
+        return id(model), digest.digest()
+
+    def add(self, key, output):
+        if key in self.predictions:
+            self.nbytes -= self.predictions.pop(key).nbytes
+        self.predictions[key] = output
+        self.nbytes += output.nbytes
+        while self.nbytes > self.max_bytes and self.predictions:
+            _, evicted = self.predictions.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def predict(self, model, batch_block_data):
+        """Predict output masks for a batch of moves, using cached predictions.
+
+        Only moves without cached predictions are passed to the model.
+
+        Parameters
+        ----------
+        model : keras.models.Model
+        batch_block_data : list of dict
+            Blocks for each move, as returned by ``Region.get_next_block``.
+
+        Returns
+        -------
+        ndarray
+            Model output for the batch.
+        """
+        keys = [self.get_key(model, block_data) for block_data in batch_block_data]
+        outputs = [None] * len(keys)
+        missing = []
+        for n, key in enumerate(keys):
+            output = self.predictions.pop(key, None)
+            if output is None:
+                missing.append(n)
+            else:
+                # Reinsert to mark as most recently used.
+                self.predictions[key] = output
+                outputs[n] = output
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            predicted = model.predict_on_batch(get_batch_inputs([batch_block_data[n] for n in missing]))
+            for n, output in zip(missing, predicted):
+                outputs[n] = output
+                self.add(keys[n], output.copy())
+
+        return np.stack(outputs)
+
+
+class RegionFillScheduler(object):
+    """Flood fill several regions at once, sharing model predictions.
+
+    Regions are filled in lockstep through ``Region.fill_steps``. Each step,
+    the next batch of moves of every region being filled is predicted in a
+    single model batch, and the outputs are sent back to their regions. As
+    regions finish, further regions are started in their place, so that the
+    model is kept busy with larger batches than any one region provides.
+
+    Parameters
+    ----------
+    model : keras.models.Model
+        Model to use for object prediction.
+    max_regions : int
+        Maximum number of regions to fill at once.
+    prediction_cache : PredictionCache, optional
+        If provided, moves whose inputs have been predicted before are taken
+        from this cache.
+    **kwargs
+        Arguments passed to ``Region.fill_steps`` for every region.
+
+    Attributes
+    ----------
+    active : list of tuple
+        Regions being filled, with their fill coroutine and pending batch.
+    """
+    def __init__(self, model, max_regions, prediction_cache=None, **kwargs):
+        self.model = model
+        self.max_regions = max_regions
+        self.prediction_cache = prediction_cache
+        self.fill_kwargs = kwargs
+        self.active = []
+
+    def fill(self, regions):
+        """Fill regions, yielding each as it finishes.
+
+        Parameters
+        ----------
+        regions : iterable of Region
+            Regions to fill. The iterable may yield ``None`` when no region
+            is available yet, in which case the regions already being filled
+            are advanced and the iterable is retried after the next step. If
+            no regions are being filled, the iterable should instead block
+            until a region is available.
+
+        Yields
+        ------
+        region : Region
+            A region that has finished filling.
+        early_termination : bool
+            Whether filling the region was terminated early.
+        """
+        regions = iter(regions)
+        exhausted = False
+        while True:
+            while not exhausted and len(self.active) < self.max_regions:
+                try:
+                    region = six.next(regions)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if region is None:
+                    break
+                finished = self._advance(region, region.fill_steps(**self.fill_kwargs))
+                if finished is not None:
+                    yield finished
+
+            if not self.active:
+                if exhausted:
+                    return
+                continue
+
+            batch_block_data = [b for _, _, batch in self.active for b in batch]
+            output = predict_batch(self.model, batch_block_data, self.prediction_cache)
+
+            active, self.active = self.active, []
+            offset = 0
+            for region, steps, batch in active:
+                steps.send(output[offset:offset + len(batch)])
+                offset += len(batch)
+                finished = self._advance(region, steps)
+                if finished is not None:
+                    yield finished
+
+    def _advance(self, region, steps):
+        """Get the next batch of a region, or its result if it has finished."""
+        try:
+            batch = six.next(steps)
+        except StopIteration:
+            return region, False
+        except Region.EarlyFillTermination:
+            return region, True
+        self.active.append((region, steps, batch))
+        return None
+
+
 def mask_to_output_target(mask):
     target = np.full_like(mask, CONFIG.model.v_false, dtype=np.float32)
     target[mask] = CONFIG.model.v_true
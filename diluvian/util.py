@@ -108,6 +108,46 @@ def pad_dims(x):
     return np.expand_dims(np.expand_dims(x, x.ndim), 0)
 
 
+def pad_indices(start, stop, size, mode):
+    """Get indices along an axis that ``numpy.pad`` samples for coordinates.
+
+    Taking these along an axis of an array pads it as ``numpy.pad`` would.
+    This holds while padding on each side is narrower than the axis, beyond
+    which ``numpy.pad`` is no longer periodic.
+
+    Parameters
+    ----------
+    start, stop : int
+        Coordinates, which may lie outside ``[0, size)``, to sample.
+    size : int
+        Length of the axis.
+    mode : str
+        One of the ``numpy.pad`` modes 'edge', 'reflect', 'symmetric' or
+        'wrap'.
+
+    Returns
+    -------
+    ndarray
+        Indices in ``[0, size)`` for each coordinate.
+    """
+    idx = np.arange(start, stop)
+    if mode == 'edge':
+        return np.clip(idx, 0, size - 1)
+    elif mode == 'reflect':
+        if size == 1:
+            return np.zeros_like(idx)
+        period = 2 * (size - 1)
+        idx = np.mod(idx, period)
+        return np.where(idx >= size, period - idx, idx)
+    elif mode == 'symmetric':
+        period = 2 * size
+        idx = np.mod(idx, period)
+        return np.where(idx >= size, period - 1 - idx, idx)
+    elif mode == 'wrap':
+        return np.mod(idx, size)
+    raise ValueError('Padding mode {} has no index equivalent.'.format(mode))
+
+
 def get_nonzero_aabb(a):
     """Get the axis-aligned bounding box of nonzero elements of a 3D array.
 
@@ -6,6 +6,7 @@ from __future__ import division
 
 from collections import namedtuple
 import csv
+import json
 import logging
 import os
 import re
@@ -22,13 +23,36 @@ from six.moves import range as xrange
 import pyn5
 
 from .config import CONFIG
-from .octrees import OctreeVolume
+from .octrees import (
+        LeafCache,
+        OctreeVolume,
+        )
 from .util import get_nonzero_aabb
 
 
 DimOrder = namedtuple('DimOrder', ('X', 'Y', 'Z'))
 
 
+def get_leaf_cache(leaf_cache=None):
+    """Get a leaf cache for a block sparse volume's octrees.
+
+    Parameters
+    ----------
+    leaf_cache : diluvian.octrees.LeafCache, optional
+        An existing cache to use, for example to share a byte budget between
+        several volumes.
+
+    Returns
+    -------
+    diluvian.octrees.LeafCache
+        The provided cache, or if none is provided a new cache with the
+        configured ``leaf_cache_bytes`` budget. ``None`` if neither exist.
+    """
+    if leaf_cache is None and CONFIG.volume.leaf_cache_bytes is not None:
+        leaf_cache = LeafCache(CONFIG.volume.leaf_cache_bytes)
+    return leaf_cache
+
+
 def partition_volumes(volumes, downsample=True):
     """Paritition volumes into training and validation based on configuration.
 
@@ -692,22 +716,38 @@ class Volume(object):
             bounds_generator = self.subvolume_bounds_generator(**kwargs)
         return SubvolumeGenerator(self, bounds_generator)
 
-    def get_subvolume(self, bounds):
+    def get_subvolume(self, bounds, read_image=True):
+        """Extract a subvolume of image data and label mask.
+
+        Parameters
+        ----------
+        bounds : SubvolumeBounds
+        read_image : bool, optional
+            If false, the image of the returned subvolume is ``None``. This
+            is for wrapping volumes which read the image themselves.
+
+        Returns
+        -------
+        Subvolume
+        """
         if bounds.start is None or bounds.stop is None:
             raise ValueError('This volume does not support sparse subvolume access.')
 
-        image_subvol = self.image_data[
-                bounds.start[0]:bounds.stop[0],
-                bounds.start[1]:bounds.stop[1],
-                bounds.start[2]:bounds.stop[2]]
+        if read_image:
+            image_subvol = self.image_data[
+                    bounds.start[0]:bounds.stop[0],
+                    bounds.start[1]:bounds.stop[1],
+                    bounds.start[2]:bounds.stop[2]]
 
-        image_subvol = self.world_mat_to_local(image_subvol)
-        if np.issubdtype(image_subvol.dtype, np.integer):
-            image_subvol = image_subvol.astype(np.float32) / 256.0
+            image_subvol = self.world_mat_to_local(image_subvol)
+            if np.issubdtype(image_subvol.dtype, np.integer):
+                image_subvol = image_subvol.astype(np.float32) / 256.0
+        else:
+            image_subvol = None
 
         seed = bounds.seed
         if seed is None:
-            seed = np.array(image_subvol.shape, dtype=np.int64) // 2
+            seed = np.array(bounds.stop - bounds.start, dtype=np.int64) // 2
 
         if self.label_data is not None:
             label_start = bounds.start + bounds.label_margin
@@ -851,7 +891,7 @@ class VolumeView(Volume):
     def shape(self):
         return self.parent.shape
 
-    def get_subvolume(self, bounds):
+    def get_subvolume(self, bounds, read_image=True):
         # assumes bounds given are in local coordinates
         parent_start = self.local_to_parent(bounds.start) if bounds.start is not None else None
         parent_stop = self.local_to_parent(bounds.stop) if bounds.stop is not None else None
@@ -861,7 +901,7 @@ class VolumeView(Volume):
                                         seed=parent_seed,
                                         label_id=bounds.label_id,
                                         label_margin=bounds.label_margin)
-        return self.parent.get_subvolume(parent_bounds)
+        return self.parent.get_subvolume(parent_bounds, read_image=read_image)
 
 
 class PartitionedVolume(VolumeView):
@@ -945,17 +985,54 @@ class DownsampledVolume(VolumeView):
     def shape(self):
         return tuple(np.floor_divide(np.array(self.parent.shape), self.scale))
 
-    def get_subvolume(self, bounds):
+    def get_image_mip_start(self, parent_start):
+        """Find where a subvolume image can be read from an octree mip.
+
+        This is possible when the image data is an octree, the wrapped
+        volumes do not downsample, and the subvolume is aligned to the
+        downsampling scale.
+
+        Returns
+        -------
+        ndarray
+            Coordinates of the subvolume start in the mip of the image data,
+            or ``None`` if the image can not be read from a mip.
+        """
+        if not isinstance(self.image_data, OctreeVolume):
+            return None
+        volume = self.parent
+        start = parent_start
+        while isinstance(volume, VolumeView):
+            if isinstance(volume, DownsampledVolume):
+                return None
+            start = volume.local_to_parent(start)
+            volume = volume.parent
+        if np.any(np.mod(start, self.scale)):
+            return None
+        return np.floor_divide(start, self.scale)
+
+    def get_subvolume(self, bounds, read_image=True):
         subvol_shape = bounds.stop - bounds.start
         label_shape = subvol_shape - 2 * bounds.label_margin
         parent_bounds = SubvolumeBounds(self.local_to_parent(bounds.start),
                                         self.local_to_parent(bounds.stop),
                                         label_margin=self.local_to_parent(bounds.label_margin))
-        subvol = self.parent.get_subvolume(parent_bounds)
-        subvol.image = subvol.image.reshape(
-                [subvol_shape[0], self.scale[0],
-                 subvol_shape[1], self.scale[1],
-                 subvol_shape[2], self.scale[2]]).mean(5).mean(3).mean(1)
+        mip_start = self.get_image_mip_start(parent_bounds.start) if read_image else None
+        subvol = self.parent.get_subvolume(parent_bounds, read_image=read_image and mip_start is None)
+        if mip_start is not None:
+            # Read the image from a downsampled level of the octree, rather
+            # than reading and averaging full resolution data.
+            integral = np.issubdtype(self.image_data.dtype, np.integer)
+            mip = self.image_data.get_mip(self.scale, dtype=np.float32 if integral else None)
+            subvol.image = mip.read_into(tuple(map(slice, mip_start, mip_start + subvol_shape)),
+                                         np.empty(tuple(subvol_shape), dtype=mip.dtype))
+            if integral:
+                subvol.image /= 256.0
+        elif read_image:
+            subvol.image = subvol.image.reshape(
+                    [subvol_shape[0], self.scale[0],
+                     subvol_shape[1], self.scale[1],
+                     subvol_shape[2], self.scale[2]]).mean(5).mean(3).mean(1)
 
         if subvol.label_mask is not None:
             # Downsample body mask by considering blocks where the majority
@@ -984,20 +1061,25 @@ class DownsampledVolume(VolumeView):
 
 class SparseWrappedVolume(VolumeView):
     """Wrap a existing volume for memory cached block sparse access."""
-    def __init__(self, parent, image_leaf_shape=None, label_leaf_shape=None):
+    def __init__(self, parent, image_leaf_shape=None, label_leaf_shape=None, leaf_cache=None):
         if image_leaf_shape is None:
             image_leaf_shape = list(CONFIG.model.input_fov_shape)
         if label_leaf_shape is None:
             label_leaf_shape = list(CONFIG.model.input_fov_shape)
+        self.leaf_cache = get_leaf_cache(leaf_cache)
 
         image_data = OctreeVolume(image_leaf_shape,
                                   (np.zeros(3), parent.image_data.shape),
                                   parent.image_data.dtype,
-                                  populator=self.image_populator)
+                                  populator=self.image_populator,
+                                  leaf_cache=self.leaf_cache,
+                                  populator_threads=CONFIG.volume.populator_threads)
         label_data = OctreeVolume(label_leaf_shape,
                                   (np.zeros(3), parent.label_data.shape),
                                   parent.label_data.dtype,
-                                  populator=self.label_populator)
+                                  populator=self.label_populator,
+                                  leaf_cache=self.leaf_cache,
+                                  populator_threads=CONFIG.volume.populator_threads)
 
         super(SparseWrappedVolume, self).__init__(
                 parent,
@@ -1154,11 +1236,16 @@ class ImageStackVolume(Volume):
         Voxel z-indices where data is not available.
     image_leaf_shape : tuple of int or ndarray, optional
         Shape of image octree leaves in voxels. Defaults to 10 stacked tiles.
+        Configured by ``leaf_shape`` in volume TOML files. See
+        ``diluvian.octrees.AccessProfile`` for choosing a leaf shape.
     label_leaf_shape : tuple of int or ndarray, optional
         Shape of label octree leaves in voxels. Defaults to FFN model FOV.
+    leaf_cache : diluvian.octrees.LeafCache, optional
+        Cache bounding memory of populated octree leaves. Defaults to a new
+        cache if ``leaf_cache_bytes`` is configured.
     """
     @staticmethod
-    def from_catmaid_stack(stack_info, tile_source_parameters):
+    def from_catmaid_stack(stack_info, tile_source_parameters, image_leaf_shape=None):
         # See https://catmaid.readthedocs.io/en/stable/tile_sources.html
         format_url = {
             1: '{source_base_url}{{z}}/{{row}}_{{col}}_{{zoom_level}}.{file_extension}',
@@ -1174,7 +1261,8 @@ class ImageStackVolume(Volume):
         tile_width = int(tile_source_parameters['tile_width'])
         tile_height = int(tile_source_parameters['tile_height'])
         return ImageStackVolume(bounds, resolution, translation, tile_width, tile_height,
-                                format_url, missing_z=stack_info.get("broken_slices", None))
+                                format_url, missing_z=stack_info.get("broken_slices", None),
+                                image_leaf_shape=image_leaf_shape)
 
     def from_toml(filename):
         volumes = {}
@@ -1197,15 +1285,16 @@ class ImageStackVolume(Volume):
                     "tile_source_type",
                 ]
                 volume = ImageStackVolume.from_catmaid_stack(
-                    {si[key]: dataset[key] for key in si},
-                    {tsp[key]: dataset[key] for key in tsp},
+                    {key: dataset[key] for key in si if key in dataset},
+                    {key: dataset[key] for key in tsp},
+                    image_leaf_shape=dataset.get("leaf_shape", None),
                 )
                 volumes[dataset["title"]] = volume
 
         return volumes
 
     def __init__(self, bounds, orig_resolution, translation, tile_width, tile_height,
-                 tile_format_url, zoom_level=0, missing_z=None, image_leaf_shape=None):
+                 tile_format_url, zoom_level=0, missing_z=None, image_leaf_shape=None, leaf_cache=None):
         self.orig_bounds = bounds
         self.orig_resolution = orig_resolution
         self.translation = translation
@@ -1220,6 +1309,7 @@ class ImageStackVolume(Volume):
         self.missing_z = frozenset(missing_z)
         if image_leaf_shape is None:
             image_leaf_shape = [10, tile_height, tile_width]
+        self.leaf_cache = get_leaf_cache(leaf_cache)
 
         self.scale = np.exp2(np.array([0, self.zoom_level, self.zoom_level])).astype(np.int64)
 
@@ -1227,7 +1317,9 @@ class ImageStackVolume(Volume):
         self.image_data = OctreeVolume(image_leaf_shape,
                                        data_shape,
                                        'float32',
-                                       populator=self.image_populator)
+                                       populator=self.image_populator,
+                                       leaf_cache=self.leaf_cache,
+                                       populator_threads=CONFIG.volume.populator_threads)
 
         self.label_data = None
 
@@ -1247,6 +1339,11 @@ class ImageStackVolume(Volume):
     def resolution(self):
         return self.orig_resolution * np.exp2([0, self.zoom_level, self.zoom_level])
 
+    @property
+    def image_chunk_shape(self):
+        """Shape of the image tiles populating the image octree."""
+        return np.array([1, self.tile_height, self.tile_width], dtype=np.int64)
+
     def downsample(self, resolution):
         downsample = self._get_downsample_from_resolution(resolution)
         zoom_level = np.min(downsample[[self.DIM.X, self.DIM.Y]])
@@ -1260,7 +1357,8 @@ class ImageStackVolume(Volume):
                     self.tile_format_url,
                     zoom_level=self.zoom_level + zoom_level,
                     missing_z=self.missing_z,
-                    image_leaf_shape=self.image_data.leaf_shape).downsample(resolution)
+                    image_leaf_shape=self.image_data.leaf_shape,
+                    leaf_cache=self.leaf_cache).downsample(resolution)
         if np.all(np.equal(downsample, 0)):
             return self
         return DownsampledVolume(self, downsample)
@@ -1272,7 +1370,7 @@ class ImageStackVolume(Volume):
             return self.SparseSubvolumeBoundsGenerator(self, sparse_margin)
         return super(ImageStackVolume, self).subvolume_bounds_generator(**kwargs)
 
-    def get_subvolume(self, bounds):
+    def get_subvolume(self, bounds, read_image=True):
         if bounds.start is None or bounds.stop is None:
             image_subvol = self.image_data
             label_subvol = self.label_data
@@ -1280,15 +1378,18 @@ class ImageStackVolume(Volume):
             image_subvol = self.image_data[
                     bounds.start[0]:bounds.stop[0],
                     bounds.start[1]:bounds.stop[1],
-                    bounds.start[2]:bounds.stop[2]]
+                    bounds.start[2]:bounds.stop[2]] if read_image else None
             label_subvol = None
 
-        if np.issubdtype(image_subvol.dtype, np.integer):
+        if np.issubdtype(self.image_data.dtype, np.integer):
             raise ValueError('Sparse volume access does not support image data coercion.')
 
         seed = bounds.seed
         if seed is None:
-            seed = np.array(image_subvol.shape, dtype=np.int64) // 2
+            if image_subvol is None:
+                seed = np.array(bounds.stop - bounds.start, dtype=np.int64) // 2
+            else:
+                seed = np.array(image_subvol.shape, dtype=np.int64) // 2
 
         return Subvolume(image_subvol, label_subvol, seed, bounds.label_id)
 
@@ -1379,6 +1480,13 @@ class N5Volume(Volume):
     tile_width, tile_height : int, optional
         Size of tiles in pixels
         necessary if the volume is missing an attributes file
+    leaf_cache : diluvian.octrees.LeafCache, optional
+        Cache bounding memory of populated octree leaves. Defaults to a new
+        cache if ``leaf_cache_bytes`` is configured.
+    leaf_shape : iterable of int, optional
+        Shape of octree leaves in voxels. Defaults to 10 voxels along each
+        axis. Configured by ``leaf_shape`` in volume TOML files. See
+        ``diluvian.octrees.AccessProfile`` for choosing a leaf shape.
     """
 
     def from_toml(filename):
@@ -1389,14 +1497,16 @@ class N5Volume(Volume):
                 root_path = volume_config["root_path"]
                 datasets = volume_config["datasets"]
                 resolution = volume_config.get("resolution", None)
-                translation = volume_config.get["translation", None]
+                translation = volume_config.get("translation", None)
                 bounds = volume_config.get("bounds", None)
+                leaf_shape = volume_config.get("leaf_shape", None)
                 volume = N5Volume(
                     root_path,
                     datasets,
                     bounds,
                     resolution,
                     translation,
+                    leaf_shape=leaf_shape,
                 )
                 volumes[volume_config["title"]] = volume
 
@@ -1409,6 +1519,8 @@ class N5Volume(Volume):
         bounds=None,
         resolution=None,
         translation=None,
+        leaf_cache=None,
+        leaf_shape=None,
     ):
 
         self._dtype_map = {
@@ -1426,6 +1538,8 @@ class N5Volume(Volume):
         self.bounds = bounds
         self.resolution = resolution
         self.translation = translation
+        self.leaf_cache = get_leaf_cache(leaf_cache)
+        self.leaf_shape = leaf_shape
 
         self.scale = np.exp2(np.array([0, 0, 0])).astype(np.int64)
         self.data_shape = (np.array([0, 0, 0]), self.bounds / self.scale)
@@ -1454,8 +1568,25 @@ class N5Volume(Volume):
 
     @property
     def octree_leaf_shape(self):
+        if self.leaf_shape is not None:
+            return np.asarray(self.leaf_shape)
         return np.array([10, 10, 10])
 
+    @property
+    def image_chunk_shape(self):
+        """Block shape of the image dataset, or ``None`` if it is unknown."""
+        if self.image_config is None:
+            return None
+        attributes = os.path.join(self.root_path, self.image_config.get("path"), "attributes.json")
+        if not os.path.isfile(attributes):
+            return None
+        with open(attributes, "r") as fin:
+            block_size = json.load(fin).get("blockSize", None)
+        if block_size is None:
+            return None
+        # N5 attributes list dimensions fastest varying first.
+        return np.array(block_size[::-1], dtype=np.int64)
+
     @property
     def image_config(self):
         return self._image_config
@@ -1469,6 +1600,8 @@ class N5Volume(Volume):
                 self.data_shape,
                 self.dtype_map[dataset.get("dtype", "FLOAT32")],
                 populator=self.image_populator,
+                leaf_cache=self.leaf_cache,
+                populator_threads=CONFIG.volume.populator_threads,
             )
         else:
             self._image_data = None
@@ -1490,6 +1623,8 @@ class N5Volume(Volume):
                 self.data_shape,
                 self.dtype_map[dataset.get("dtype", "FLOAT32")],
                 populator=self.mask_populator,
+                leaf_cache=self.leaf_cache,
+                populator_threads=CONFIG.volume.populator_threads,
             )
         else:
             self._mask_data = None
@@ -1511,6 +1646,8 @@ class N5Volume(Volume):
                 self.data_shape,
                 self.dtype_map[dataset.get("dtype", "FLOAT32")],
                 populator=self.label_populator,
+                leaf_cache=self.leaf_cache,
+                populator_threads=CONFIG.volume.populator_threads,
             )
         else:
             self._label_data = None
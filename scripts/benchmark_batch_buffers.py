@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Report per-move time and allocation of assembling region fill batch inputs."""
+
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from diluvian.config import CONFIG
+from diluvian.regions import (
+        BatchInputBuffers,
+        get_batch_inputs,
+        Region,
+        )
+
+
+class BenchmarkModel(object):
+    """Cheap stand-in for a network, echoing the center of the image input."""
+
+    def predict_on_batch(self, inputs):
+        image = inputs['image_input']
+        margin = (np.array(image.shape[1:4]) - CONFIG.model.output_fov_shape) // 2
+        key = (slice(None),) + tuple(map(slice, margin, margin + CONFIG.model.output_fov_shape))
+        return image[key] - 0.01
+
+
+def fill_positions(region, move_batch_size):
+    """Fill a region with the benchmark model, returning the positions of its batches."""
+    batches = []
+    for batch_block_data, _ in region.fill(BenchmarkModel(), move_batch_size=move_batch_size, generator=True):
+        batches.append([b['position'] for b in batch_block_data])
+    return batches
+
+
+def assemble_allocating(region, batches, buffers):
+    """Assemble inputs allocating new blocks and inputs for each batch, as regions did."""
+    for positions in batches:
+        get_batch_inputs([region.get_move_block(pos) for pos in positions])
+
+
+def assemble_buffered(region, batches, buffers):
+    """Assemble inputs writing blocks into reused batch input buffers."""
+    for positions in batches:
+        get_batch_inputs([region.get_move_block(pos, buffers, n) for n, pos in enumerate(positions)])
+
+
+def batch_allocation(assemble, region, batches, buffers):
+    """Mean bytes allocated while assembling each batch."""
+    tracemalloc.start()
+    allocated = []
+    for positions in batches:
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        assemble(region, [positions], buffers)
+        allocated.append(tracemalloc.get_traced_memory()[1] - start)
+    tracemalloc.stop()
+    return np.mean(allocated)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare batch input assembly per move.')
+
+    parser.add_argument(
+        '--bounds', dest='bounds', default=[64, 256, 256], nargs=3, type=int,
+        help='Shape of the region.')
+    parser.add_argument(
+        '--move-batch-size', dest='move_batch_size', default=16, type=int,
+        help='Maximum number of moves in each prediction batch.')
+    parser.add_argument(
+        '--repeat', dest='repeat', default=5, type=int,
+        help='Number of times to repeat assembly, reporting the fastest.')
+
+    args = parser.parse_args()
+
+    # A bright image, so that the whole region is filled.
+    image = (0.95 + 0.05 * np.random.RandomState(0).rand(*args.bounds)).astype(np.float32)
+    region = Region(image, seed_vox=np.array(args.bounds) // 2)
+    batches = fill_positions(region, args.move_batch_size)
+    moves = sum(len(positions) for positions in batches)
+    buffers = BatchInputBuffers(args.move_batch_size)
+
+    print('{:>12} {:>10} {:>12} {:>18}'.format('inputs', 'moves', 'move (us)', 'batch alloc (KiB)'))
+    for name, assemble in [('allocating', assemble_allocating), ('buffered', assemble_buffered)]:
+        elapsed = min(timeit.repeat(lambda: assemble(region, batches, buffers), number=1, repeat=args.repeat))
+        allocated = batch_allocation(assemble, region, batches, buffers)
+        print('{:>12} {:>10d} {:>12.2f} {:>18.1f}'.format(
+                name, moves, elapsed * 1e6 / moves, allocated / 1024))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Report octree leaves touched per move by region mask leaf layouts."""
+
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from diluvian import octrees
+from diluvian.config import CONFIG
+from diluvian.regions import (
+        get_move_leaf_shape,
+        Region,
+        )
+
+
+def count_leaves(block_min, block_max, leaf_shape):
+    return int(np.prod((block_max - 1) // leaf_shape - block_min // leaf_shape + 1))
+
+
+def move_blocks(region, num_moves, seed=0):
+    """Input and output FOV bounds of random moves on a region's move grid."""
+    rng = np.random.RandomState(seed)
+    blocks = []
+    for _ in range(num_moves):
+        pos = np.array([rng.randint(lo, hi + 1) for lo, hi in zip(*region.move_bounds)])
+        vox = region.pos_to_vox(pos)
+        blocks.append((region.get_block_bounds(vox, CONFIG.model.input_fov_shape)[:2],
+                       region.get_block_bounds(vox, CONFIG.model.output_fov_shape)[:2]))
+    return blocks
+
+
+def benchmark_layout(region, leaf_shape, blocks):
+    leaf_shape = np.asarray(leaf_shape, dtype=np.int64)
+    touched = [(count_leaves(i[0], i[1], leaf_shape), count_leaves(o[0], o[1], leaf_shape)) for i, o in blocks]
+
+    mask = octrees.OctreeVolume(leaf_shape, (np.zeros(3), region.bounds), np.float32, background=np.NAN)
+    mask[:] = np.NAN
+    output = np.random.RandomState(0).rand(*CONFIG.model.output_fov_shape).astype(np.float32)
+
+    def moves():
+        for (in_min, in_max), (out_min, out_max) in blocks:
+            mask[tuple(map(slice, in_min, in_max))]
+            mask[tuple(map(slice, out_min, out_max))] = output[tuple(map(slice, out_max - out_min))]
+
+    move_time = min(timeit.repeat(moves, number=1, repeat=3)) / len(blocks)
+    touched = np.array(touched)
+    return touched.mean(axis=0), touched.max(axis=0), move_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare leaves touched per move by region mask layouts.')
+
+    parser.add_argument(
+        '--bounds', dest='bounds', default=[128, 512, 512], nargs=3, type=int,
+        help='Shape of the region.')
+    parser.add_argument(
+        '--image-leaf-shape', dest='image_leaf_shape', default=[10, 10, 10], nargs=3, type=int,
+        help='Leaf shape of a sparse image, which masks of octree images previously used.')
+    parser.add_argument(
+        '--num-moves', dest='num_moves', default=1000, type=int,
+        help='Number of random moves to measure.')
+    parser.add_argument(
+        '--seed', dest='seed', default=[61, 250, 253], nargs=3, type=int,
+        help='Seed voxel of the region, which determines the move grid offset.')
+
+    args = parser.parse_args()
+
+    image = np.zeros(args.bounds, dtype=np.float32)
+    region = Region(image, seed_vox=np.array(args.seed), sparse_mask=True)
+    blocks = move_blocks(region, args.num_moves)
+
+    layouts = [
+        ('training subvolume', CONFIG.model.training_subv_shape),
+        ('image leaves', args.image_leaf_shape),
+        ('move grid', get_move_leaf_shape([CONFIG.model.input_fov_shape, CONFIG.model.output_fov_shape],
+                                          region.MOVE_DELTA, region.MOVE_GRID_OFFSET)),
+    ]
+
+    print('{:>18} {:>14} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'layout', 'leaf shape', 'in mean', 'in max', 'out mean', 'out max', 'move (us)'))
+    for name, leaf_shape in layouts:
+        mean, most, move_time = benchmark_layout(region, leaf_shape, blocks)
+        print('{:>18} {:>14} {:>10.2f} {:>10d} {:>10.2f} {:>10d} {:>10.1f}'.format(
+                name, 'x'.join(str(s) for s in leaf_shape), mean[0], most[0], mean[1], most[1], move_time * 1e6))
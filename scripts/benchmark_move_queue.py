@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Report per-move overhead of region move queues on a synthetic fill."""
+
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+from six.moves import queue
+
+from diluvian.regions import MoveQueue
+
+
+NEIGHBORS = ((-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, -1), (0, 0, 1))
+
+
+def fill_priority_queue(shape, values):
+    """Fill a move grid the way regions did with a locking priority queue."""
+    q = queue.PriorityQueue()
+    visited = set()
+    start = tuple(s // 2 for s in shape)
+    q.put((None, start))
+    visited.add(start)
+    moves = 0
+    while not q.empty():
+        _, pos = q.get_nowait()
+        moves += 1
+        for d in NEIGHBORS:
+            new_pos = (pos[0] + d[0], pos[1] + d[1], pos[2] + d[2])
+            if all(0 <= p < s for p, s in zip(new_pos, shape)) and new_pos not in visited:
+                visited.add(new_pos)
+                q.put((-values[new_pos[0]][new_pos[1]][new_pos[2]], new_pos))
+        q.qsize()
+    return moves
+
+
+def fill_move_queue(shape, values):
+    """Fill a move grid with a region move queue."""
+    q = MoveQueue()
+    visited = set()
+    start = tuple(s // 2 for s in shape)
+    q.put(float('-inf'), start)
+    visited.add(start)
+    moves = 0
+    while q:
+        _, pos = q.pop()
+        moves += 1
+        for d in NEIGHBORS:
+            new_pos = (pos[0] + d[0], pos[1] + d[1], pos[2] + d[2])
+            if all(0 <= p < s for p, s in zip(new_pos, shape)) and new_pos not in visited:
+                visited.add(new_pos)
+                q.put(-values[new_pos[0]][new_pos[1]][new_pos[2]], new_pos)
+        len(q)
+    return moves
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare move queue overhead per move.')
+
+    parser.add_argument(
+        '--grid-shape', dest='grid_shape', default=[32, 64, 64], nargs=3, type=int,
+        help='Shape of the move grid filled, in moves.')
+    parser.add_argument(
+        '--repeat', dest='repeat', default=3, type=int,
+        help='Number of times to repeat each fill, reporting the fastest.')
+
+    args = parser.parse_args()
+
+    shape = tuple(args.grid_shape)
+    values = np.random.RandomState(0).rand(*shape).tolist()
+
+    print('{:>16} {:>10} {:>12}'.format('queue', 'moves', 'move (us)'))
+    for name, fill in [('PriorityQueue', fill_priority_queue), ('MoveQueue', fill_move_queue)]:
+        moves = fill(shape, values)
+        elapsed = min(timeit.repeat(lambda: fill(shape, values), number=1, repeat=args.repeat))
+        print('{:>16} {:>10d} {:>12.2f}'.format(name, moves, elapsed * 1e6 / moves))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for block sparse octree volume access."""
+
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from diluvian import octrees
+
+
+ENGINES = {
+    'tree': octrees.OctreeVolume,
+    'flat': octrees.FlatOctreeVolume,
+}
+
+
+def random_fov_keys(bounds, fov_shape, num, seed=0):
+    rng = np.random.RandomState(seed)
+    margin = np.asarray(fov_shape)
+    keys = []
+    for _ in range(num):
+        start = np.array([rng.randint(0, b - m) for b, m in zip(bounds, margin)])
+        keys.append(tuple(slice(s, s + m) for s, m in zip(start, margin)))
+    return keys
+
+
+def benchmark_access(engine, bounds, leaf_shape, fov_shape, num_keys, populated):
+    data = np.random.RandomState(0).rand(*bounds).astype(np.float32)
+
+    def populator(b):
+        return data[b[0][0]:b[1][0], b[0][1]:b[1][1], b[0][2]:b[1][2]]
+
+    volume = ENGINES[engine](leaf_shape, (np.zeros(3), np.array(bounds)), np.float32,
+                             populator=populator if populated else None)
+    if not populated:
+        volume[:] = np.NAN
+    keys = random_fov_keys(bounds, fov_shape, num_keys)
+    block = np.zeros(tuple(fov_shape), dtype=np.float32)
+
+    # Warm the volume so that population is not measured.
+    for key in keys:
+        volume[key] = volume[key]
+
+    def reads():
+        for key in keys:
+            volume[key]
+
+    def writes():
+        for key in keys:
+            volume[key] = block
+
+    read_time = min(timeit.repeat(reads, number=1, repeat=3)) / num_keys
+    write_time = min(timeit.repeat(writes, number=1, repeat=3)) / num_keys
+
+    return read_time, write_time
+
+
+def sparse_mask(bounds, fraction, seed=0):
+    """Create a NaN background mask with a random dense blob in its center."""
+    data = np.full(tuple(bounds), np.NAN, dtype=np.float32)
+    blob = tuple(slice(int(b * (1 - fraction) / 2), int(b * (1 + fraction) / 2)) for b in bounds)
+    data[blob] = np.random.RandomState(seed).rand(*[s.stop - s.start for s in blob])
+    return data
+
+
+def benchmark_dense(engine, bounds, leaf_shape, fraction):
+    data = sparse_mask(bounds, fraction)
+    key = tuple(slice(0, b) for b in bounds)
+    volume_bounds = (np.zeros(3), np.array(bounds))
+    out = np.empty_like(data)
+
+    def recursive_build():
+        volume = ENGINES[engine](leaf_shape, volume_bounds, np.float32)
+        volume[:] = np.NAN
+        volume[key] = data
+        return volume
+
+    def bulk_build():
+        return ENGINES[engine].from_dense(data, leaf_shape, default=np.NAN)
+
+    volume = bulk_build()
+
+    def recursive_export():
+        return volume[key]
+
+    def bulk_export():
+        return volume.to_dense(out=out)
+
+    return [min(timeit.repeat(f, number=1, repeat=3))
+            for f in [recursive_build, bulk_build, recursive_export, bulk_export]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark per-access latency of octree engines.')
+
+    parser.add_argument(
+        '--bounds', dest='bounds', default=[128, 512, 512], nargs=3, type=int,
+        help='Shape of the benchmarked volume.')
+    parser.add_argument(
+        '--leaf-shape', dest='leaf_shape', default=[19, 49, 49], nargs=3, type=int,
+        help='Shape of octree leaves.')
+    parser.add_argument(
+        '--fov-shape', dest='fov_shape', default=[13, 33, 33], nargs=3, type=int,
+        help='Shape of each read and write access.')
+    parser.add_argument(
+        '--num-keys', dest='num_keys', default=1000, type=int,
+        help='Number of random accesses per measurement.')
+    parser.add_argument(
+        '--dense-bounds', dest='dense_bounds', default=[512, 512, 512], nargs=3, type=int,
+        help='Shape of the volume for benchmarking conversion from and to dense arrays.')
+    parser.add_argument(
+        '--dense-fraction', dest='dense_fraction', default=0.25, type=float,
+        help='Fraction of each axis of the dense volume covered by non-uniform data.')
+
+    args = parser.parse_args()
+
+    print('{:>6} {:>10} {:>12} {:>12}'.format('engine', 'populated', 'read (us)', 'write (us)'))
+    for populated in [False, True]:
+        for engine in sorted(ENGINES):
+            read_time, write_time = benchmark_access(
+                    engine, args.bounds, args.leaf_shape, args.fov_shape, args.num_keys, populated)
+            print('{:>6} {:>10} {:>12.1f} {:>12.1f}'.format(
+                    engine, str(populated), read_time * 1e6, write_time * 1e6))
+
+    print()
+    print('{:>6} {:>14} {:>14} {:>14} {:>14}'.format(
+            'engine', 'setitem (s)', 'from_dense (s)', 'getitem (s)', 'to_dense (s)'))
+    for engine in sorted(ENGINES):
+        times = benchmark_dense(engine, args.dense_bounds, args.leaf_shape, args.dense_fraction)
+        print('{:>6} {:>14.3f} {:>14.3f} {:>14.3f} {:>14.3f}'.format(engine, *times))
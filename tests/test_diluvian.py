@@ -11,6 +11,13 @@ Tests for `diluvian` module.
 
 from __future__ import division
 
+import itertools
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+
 import numpy as np
 from pathlib import Path
 import shutil
@@ -82,6 +89,1023 @@ def test_octree_map_copy():
     assert np.array_equal(cot[7:9, 4:6, 4], expected_mat), 'Copy should have same uniformity.'
 
 
+def test_flat_octree_matches_octree():
+    clip_bounds = (np.zeros(3), np.array([11, 6, 5]))
+    ot = octrees.FlatOctreeVolume([5, 5, 5], clip_bounds, np.uint8)
+    ot[:] = 6
+    ot[8, 5, 4] = 5
+    expected_mat = np.array([[[6], [6]], [[6], [5]]], dtype=np.uint8)
+    assert np.array_equal(ot[7:9, 4:6, 4], expected_mat), "Assignment should break uniformity."
+    np.testing.assert_almost_equal(ot.fullness(), 2.0/3.0, err_msg='Octree fullness should be relative to clip bounds.')
+    cot = ot.map_copy(np.float32, lambda a: a * -1, lambda v: v * 1.5)
+    expected_mat = np.array([[[9.], [-6.]], [[9.], [-5.]]], dtype=np.float32)
+    assert np.array_equal(cot[7:9, 4:6, 4], expected_mat), 'Copy should have same uniformity.'
+    ot[10, 5, 4] = 5
+    np.testing.assert_almost_equal(ot.fullness(), 1.0, err_msg='Octree fullness should be relative to clip bounds.')
+    np.testing.assert_array_equal(ot.get_leaf_bounds()[1], clip_bounds[1],
+                                  err_msg='Leaf bounds should be clipped to clip bounds')
+
+    # Arrays of other dtypes are cast to the volume dtype, as in the branching octree.
+    value = np.arange(125).reshape((5, 5, 5)) * 10
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.array([10, 10, 10])), np.uint8)
+        ot[:] = 0
+        ot[0:5, 0:5, 0:5] = value
+        for key in [(slice(0, 5),) * 3, (slice(0, 10),) * 3]:
+            assert ot[key].dtype == np.uint8
+            assert ot[key].max() == value.astype(np.uint8).max()
+
+    # Random reads and writes should match the branching octree.
+    rng = np.random.RandomState(0)
+    data = rng.rand(37, 29, 23).astype(np.float32)
+
+    def populator(bounds):
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    bounds = (np.zeros(3), np.array(data.shape))
+    tree = octrees.OctreeVolume([4, 5, 6], bounds, np.float32, populator=populator)
+    flat = octrees.FlatOctreeVolume([4, 5, 6], bounds, np.float32, populator=populator)
+    for _ in range(200):
+        start = rng.randint(0, 20, 3)
+        key = tuple(map(slice, start, np.minimum(start + rng.randint(1, 15, 3), data.shape)))
+        if rng.rand() < 0.5:
+            value = rng.rand(*(key[i].stop - key[i].start for i in range(3))) \
+                if rng.rand() < 0.5 else rng.rand()
+            tree[key] = value
+            flat[key] = value
+        else:
+            assert flat[key].dtype == np.float32
+            np.testing.assert_array_equal(tree[key], flat[key])
+    np.testing.assert_array_equal(tree[0:37, 0:29, 0:23], flat[0:37, 0:29, 0:23])
+    assert all(leaf.data.dtype == np.float32 for leaf in flat.iter_leaves())
+
+
+def test_octree_leaf_cache():
+    data = np.arange(20 * 20 * 20, dtype=np.float32).reshape((20, 20, 20))
+    populated = []
+
+    def populator(bounds):
+        populated.append(tuple(bounds[0]))
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    leaf_bytes = 5 * 5 * 5 * 4
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        del populated[:]
+        cache = octrees.LeafCache(2 * leaf_bytes)
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                    populator=populator, leaf_cache=cache)
+        np.testing.assert_array_equal(ot[0:5, 0:5, 0:10], data[0:5, 0:5, 0:10])
+        assert cache.hits == 0 and cache.misses == 2, 'A cold read should only miss.'
+        np.testing.assert_array_equal(ot[0:5, 0:5, 5:10], data[0:5, 0:5, 5:10])
+        assert cache.hits == 1
+        np.testing.assert_array_equal(ot[0:5, 0:5, 10:15], data[0:5, 0:5, 10:15])
+        assert cache.evictions == 1 and cache.nbytes == 2 * leaf_bytes, 'LRU leaf should be evicted.'
+
+        ot[0, 0, 12] = -1
+        np.testing.assert_array_equal(ot[0:5, 0:5, 15:20], data[0:5, 0:5, 15:20])
+        np.testing.assert_array_equal(ot[0:5, 0:5, 0:5], data[0:5, 0:5, 0:5])
+        assert populated.count((0, 0, 0)) == 2, 'Evicted leaves should be repopulated.'
+        assert ot[0, 0, 12] == -1, 'Written leaves should never be evicted.'
+        assert cache.stats()['misses'] == len(populated)
+
+        # Leaves replaced by a uniform assignment are no longer evictable.
+        ot[:] = 0
+        assert len(cache) == 0 and cache.nbytes == 0
+        other = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                       populator=populator, leaf_cache=cache)
+        np.testing.assert_array_equal(other[0:5, 0:5, 0:15], data[0:5, 0:5, 0:15])
+        assert len(cache) == 2 and not ot.any()
+
+
+def test_octree_concurrent_population():
+    data = np.arange(20 * 20 * 20, dtype=np.float32).reshape((20, 20, 20))
+    populated = []
+
+    def populator(bounds):
+        populated.append(tuple(bounds[0]))
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        del populated[:]
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                    populator=populator, populator_threads=4)
+        ot[2:18, 2:18, 12:18] = -1
+        np.testing.assert_array_equal(ot[2:18, 2:18, 2:12], data[2:18, 2:18, 2:12])
+        np.testing.assert_array_equal(ot[2:18, 2:18, 12:18], -1)
+        assert len(populated) == len(set(populated)) == 4 * 4 * 4, 'Each leaf should be populated once.'
+        ot.close()
+        assert ot._populator_pool is None
+
+    # Leaves whose population failed are populated again by later accesses.
+    failures = []
+
+    def failing_populator(bounds):
+        if failures:
+            raise failures.pop()
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        failures.append(ValueError('Populator failed.'))
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                    populator=failing_populator, populator_threads=4)
+        try:
+            ot[0:5, 0:5, 0:5]
+            assert False, 'Population error should be raised.'
+        except ValueError:
+            pass
+        np.testing.assert_array_equal(ot[0:5, 0:5, 0:5], data[0:5, 0:5, 0:5])
+        ot.close()
+
+
+def test_octree_write_back():
+    data = np.arange(20 * 20 * 20, dtype=np.float32).reshape((20, 20, 20))
+
+    def populator(bounds):
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    leaf_bytes = 5 * 5 * 5 * 4
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        store = octrees.LeafStore(np.zeros(data.shape, dtype=np.float32))
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                    populator=populator, leaf_cache=2 * leaf_bytes, write_back=store)
+        ot[0:5, 0:5, 0:5] = -data[0:5, 0:5, 0:5]
+        ot[0, 0, 7] = -1
+        np.testing.assert_array_equal(ot[10:20, 0:5, 0:5], data[10:20, 0:5, 0:5])
+        assert store.writes == 2, 'Dirty leaves should be flushed on eviction.'
+        np.testing.assert_array_equal(ot[0:5, 0:5, 0:5], -data[0:5, 0:5, 0:5])
+        assert ot[0, 0, 7] == -1 and ot[0, 0, 6] == data[0, 0, 6]
+        assert store.reads == 2, 'Evicted dirty leaves should be reloaded from the store.'
+
+        # Uniform regions with no populator.
+        store = octrees.LeafStore(np.zeros(data.shape, dtype=np.float32))
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                    leaf_cache=leaf_bytes, write_back=store)
+        ot[:] = np.NAN
+        ot[3, 3, 3] = 1.0
+        ot[13, 13, 13] = 2.0
+        # The dirty leaf not yet evicted and the 62 uniform leaves.
+        assert ot.flush() == 63
+        assert ot.flush() == 0
+        assert ot[3, 3, 3] == 1.0 and ot[13, 13, 13] == 2.0 and np.isnan(ot[14, 14, 14])
+        assert store.dataset[13, 13, 13] == 2.0
+
+
+def test_octree_write_back_hdf5(tmpdir):
+    data = np.arange(20 * 20 * 20, dtype=np.float32).reshape((20, 20, 20))
+    bounds = (np.zeros(3, dtype=np.int64), np.array(data.shape))
+    filename = str(tmpdir.join('store.hdf5'))
+
+    def populator(bounds):
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    def unreadable(bounds):
+        raise AssertionError('Stored leaves should not be populated.')
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        name = engine.__name__
+        store = octrees.LeafStore.from_hdf5(filename, name, bounds, np.float32, [5, 5, 5])
+        ot = engine([5, 5, 5], bounds, np.float32, populator=populator, write_back=store)
+        ot[0:5, 0:5, 0:5] = -data[0:5, 0:5, 0:5]
+        ot[12, 12, 12] = -1
+        ot.close()
+
+        # Leaves written before the store was closed are read from it when
+        # it is reopened, rather than populated.
+        with octrees.LeafStore.from_hdf5(filename, name, bounds, np.float32, [5, 5, 5]) as store:
+            assert len(store.stored) == 2
+            ot = engine([5, 5, 5], bounds, np.float32, populator=unreadable, write_back=store)
+            np.testing.assert_array_equal(ot[0:5, 0:5, 0:5], -data[0:5, 0:5, 0:5])
+            expected = data[10:15, 10:15, 10:15].copy()
+            expected[2, 2, 2] = -1
+            np.testing.assert_array_equal(ot[10:15, 10:15, 10:15], expected)
+            assert store.reads == 2
+
+        # Leaves of stored regions overwritten uniformly, or made uniform by
+        # compaction, are rewritten with their uniform value.
+        name = engine.__name__ + '_uniform'
+        store = octrees.LeafStore.from_hdf5(filename, name, bounds, np.float32, [5, 5, 5])
+        ot = engine([5, 5, 5], bounds, np.float32, populator=populator, write_back=store)
+        ot[0, 0, 0] = 5
+        ot[10, 10, 10] = 6
+        assert ot.flush() == 2
+        ot[0:10, 0:10, 0:10] = 7
+        ot[10:15, 10:15, 10:15] = np.full((5, 5, 5), 8, dtype=np.float32)
+        ot.compact()
+        assert ot.flush() == 9
+        ot.close()
+
+        with octrees.LeafStore.from_hdf5(filename, name, bounds, np.float32, [5, 5, 5]) as store:
+            ot = engine([5, 5, 5], bounds, np.float32, populator=unreadable, write_back=store)
+            np.testing.assert_array_equal(ot[0:10, 0:10, 0:10], 7)
+            np.testing.assert_array_equal(ot[10:15, 10:15, 10:15], 8)
+
+
+def test_octree_leaf_compression():
+    data = np.full((20, 20, 20), np.NAN, dtype=np.float32)
+    data[5:15, 5:15, 5:15] = 1.0
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32, compress_after=2)
+        ot[:] = np.NAN
+        ot[:] = data
+        ot[0:5, 0:5, 0:5]
+        ot[0:5, 0:5, 0:5]
+        leaves = list(ot.iter_leaves())
+        compressed = [leaf for leaf in leaves if leaf.compressed is not None]
+        assert len(compressed) == len(leaves) - 1, 'Only the recently accessed leaf should be uncompressed.'
+        np.testing.assert_array_equal(ot[:], data)
+        assert all(leaf.compressed is None for leaf in leaves)
+
+        hard_mask = ot.map_copy(np.bool_, lambda a: a >= 0.5, lambda a: a >= 0.5)
+        assert hard_mask.compress() == len(leaves)
+        np.testing.assert_array_equal(hard_mask[:], data >= 0.5)
+
+        # Reads served by a single uniform leaf also count toward sweeps.
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32, compress_after=2)
+        ot[:] = 0
+        ot[10:20, 10:20, 10:20] = np.tile([0, 1], 500).reshape((10, 10, 10))
+        ot[:]
+        for _ in range(4):
+            ot[0:2, 0:2, 0:2]
+        leaves = list(ot.iter_leaves())
+        assert len(leaves) == 8 and all(leaf.compressed is not None for leaf in leaves)
+
+
+def test_octree_concurrent_decompression():
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.full(3, 10)), np.float32, thread_safe=True)
+        ot[:] = 0
+        ot[0, 0, 0] = 1
+        leaf = next(ot.iter_leaves())
+        assert ot.compress() == 1
+        decoding = threading.Event()
+        written = threading.Event()
+        decode = leaf.decode
+
+        def slow_decode(*compressed):
+            data = decode(*compressed)
+            if threading.current_thread() is reader:
+                decoding.set()
+                written.wait(0.5)
+            return data
+
+        # A reader decompressing the leaf while a writer writes to it does
+        # not replace the written data with its decoded copy.
+        leaf.decode = slow_decode
+        reader = threading.Thread(target=lambda: ot[1, 1, 1])
+        reader.start()
+        decoding.wait(10)
+        ot[0, 0, 1] = 2
+        written.set()
+        reader.join()
+        assert ot[0, 0, 1] == 2, 'Concurrent decompression should not lose writes.'
+
+
+def test_octree_compact():
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.array([20, 18, 20])), np.float32)
+        ot[:] = np.NAN
+        data = np.random.rand(20, 18, 20).astype(np.float32)
+        ot[:] = data
+        ot[0:10, 0:10, 0:10] = np.full((10, 10, 10), np.NAN, dtype=np.float32)
+        ot[10:20, 10:18, 10:20] = np.full((10, 8, 10), 0.5, dtype=np.float32)
+        data[0:10, 0:10, 0:10] = np.NAN
+        data[10:20, 10:18, 10:20] = 0.5
+        num_leaves = len(list(ot.iter_leaves()))
+
+        assert ot.compact() == 8 + 8
+        assert len(list(ot.iter_leaves())) == num_leaves - 16
+        np.testing.assert_array_equal(ot[:], data)
+
+        ot[:] = np.full((20, 18, 20), 0.25, dtype=np.float32)
+        ot.compact()
+        assert not list(ot.iter_leaves()), 'Entirely uniform volume should collapse.'
+        assert ot.fullness() == 0.0
+        ot[3, 3, 3] = 1.0
+        data[:] = 0.25
+        data[3, 3, 3] = 1.0
+        np.testing.assert_array_equal(ot[:], data)
+
+
+def test_octree_read_into_update():
+    data = np.random.rand(20, 18, 20).astype(np.float32)
+
+    def populator(bounds):
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    def clip_half(current, value):
+        current[current > 0.5] = value[current > 0.5]
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32, populator=populator)
+        expected = data.copy()
+        ot[0:10, 0:10, 0:10] = 0.75
+        expected[0:10, 0:10, 0:10] = 0.75
+
+        key = np.s_[3:17, 2:16, 4:19]
+        out = np.empty((14, 14, 15), dtype=np.float32)
+        assert ot.read_into(key, out) is out
+        np.testing.assert_array_equal(out, expected[key])
+
+        value = np.zeros((14, 14, 15), dtype=np.float32)
+        ot.update(key, clip_half, value)
+        clip_half(expected[key], value)
+        np.testing.assert_array_equal(ot[:], expected)
+
+
+def test_octree_reductions():
+    data = np.full((20, 18, 20), np.NAN, dtype=np.float32)
+    data[2:9, 3:11, 4:18] = np.random.rand(7, 8, 14)
+    data[5, 5, 5] = 0
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32)
+        ot[:] = np.NAN
+        ot[2:9, 3:11, 4:18] = data[2:9, 3:11, 4:18]
+        for key in [np.s_[:, :, :], np.s_[1:10, 2:12, 3:19], np.s_[12:20, 0:18, 0:20]]:
+            block = data[key]
+            if np.isnan(block).all():
+                assert np.isnan(ot.nanmax(key))
+            else:
+                assert ot.nanmax(key) == np.nanmax(block)
+            assert ot.count_nonzero(key) == np.count_nonzero(block)
+            assert ot.any(key) == np.any(block)
+            assert np.isnan(ot.max(key)) and np.isnan(ot.sum(key))
+        key = np.s_[2:9, 3:11, 4:18]
+        assert ot.max(key) == np.max(data[key])
+        np.testing.assert_allclose(ot.sum(key), np.sum(data[key]), rtol=1e-5)
+        assert not ot.all(key) and ot.all(np.s_[6:9, 6:11, 6:18])
+
+
+def test_octree_mip():
+    data = np.random.rand(20, 36, 40).astype(np.float32)
+
+    def populator(bounds):
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32, populator=populator)
+        mip = ot.get_mip((1, 4, 4))
+        expected = data.reshape((20, 9, 4, 10, 4)).mean(4).mean(2)
+        np.testing.assert_allclose(mip[:], expected, rtol=1e-6)
+        assert ot.get_mip((1, 4, 4)) is mip and ot.get_mip((1, 1, 1)) is ot
+
+        ot[0:4, 0:8, 0:8] = 1.0
+        expected[0:4, 0:2, 0:2] = 1.0
+        np.testing.assert_allclose(mip[:], expected, rtol=1e-6)
+
+        # Mip levels keep the leaf shape, so a coarse read spans few leaves.
+        np.testing.assert_array_equal(ot.get_mip((4, 4, 4)).leaf_shape, ot.leaf_shape)
+        for scale in [(1, 3, 3), (0, 2, 2), (2, 2)]:
+            try:
+                ot.get_mip(scale)
+                assert False, 'Scales other than powers of two should be rejected.'
+            except ValueError:
+                pass
+
+
+def test_octree_leaf_index():
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine([5, 5, 5], (np.zeros(3), np.array([20, 18, 20])), np.float32, background=np.NAN)
+        ot[:] = np.NAN
+        bounds = ot.get_leaf_bounds()
+        assert np.all(bounds[0] >= bounds[1]), 'Background volume should have empty bounds.'
+
+        ot[6:8, 6:8, 11] = 1.0
+        ot[12, 2, 3] = 1.0
+        np.testing.assert_array_equal(ot.get_leaf_bounds(), [[5, 0, 0], [15, 10, 15]])
+        assert len(list(ot.iter_leaves())) == 2
+
+        # Non-background uniform regions are occupied.
+        ot[10:20, 10:18, 10:20] = 0.5
+        np.testing.assert_array_equal(ot.get_leaf_bounds(), [[5, 0, 0], [20, 18, 20]])
+
+        ot[10:20, 10:18, 10:20] = np.NAN
+        ot[12, 2, 3] = np.NAN
+        ot.compact()
+        np.testing.assert_array_equal(ot.get_leaf_bounds(), [[5, 5, 10], [10, 10, 15]])
+        assert len(list(ot.iter_leaves())) == 1
+
+        body = ot.map_copy(np.bool_, lambda a: a > 0.5, lambda a: a > 0.5)
+        np.testing.assert_array_equal(body.get_leaf_bounds(), [[5, 5, 10], [10, 10, 15]])
+
+
+class CountingPopulator(object):
+    """Picklable octree populator counting its calls across processes."""
+
+    def __init__(self, data):
+        self.data = data
+        self.calls = multiprocessing.Value('i', 0)
+
+    def __call__(self, bounds):
+        with self.calls.get_lock():
+            self.calls.value += 1
+        return self.data[tuple(map(slice, bounds[0], bounds[1]))]
+
+
+def read_shared_octree(volume, key, results):
+    results.put(volume[key].sum())
+
+
+def exit_populator(bounds):
+    os._exit(1)
+
+
+def lock_shared_octree_slot(volume, slot, results):
+    volume._get_shared()
+    results.put(volume._lock_file(slot, block=False))
+
+
+def test_shared_octree():
+    data = np.random.RandomState(0).rand(20, 18, 20).astype(np.float32)
+    populator = CountingPopulator(data)
+    ot = octrees.SharedOctreeVolume([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                                    populator=populator)
+    try:
+        key = (slice(2, 18), slice(1, 17), slice(3, 19))
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=read_shared_octree, args=(ot, key, results)) for _ in range(3)]
+        for w in workers:
+            w.start()
+        sums = [results.get(True, 30) for _ in workers]
+        for w in workers:
+            w.join()
+        np.testing.assert_allclose(sums, data[key].sum(), rtol=1e-5)
+        # Each leaf is populated once, by whichever process claimed it.
+        assert populator.calls.value == ot.shared_leaves() == 4 * 4 * 4
+
+        # Leaves populated by workers are read from shared memory here.
+        np.testing.assert_array_equal(ot[:], data)
+        assert populator.calls.value == ot.shared_leaves() == 4 * 4 * 4
+        np.testing.assert_array_equal(ot.get_mip((2, 2, 2))[:, :, :].shape, (10, 9, 10))
+    finally:
+        ot.close()
+    assert not os.path.exists(ot.path)
+
+    # A slot left unfinished by a process that died is populated again.
+    populator = CountingPopulator(data)
+    ot = octrees.SharedOctreeVolume([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                                    populator=populator)
+    try:
+        ot.populator = exit_populator
+        worker = multiprocessing.Process(target=read_shared_octree, args=(ot, (0, 0, 0), results))
+        worker.start()
+        worker.join(30)
+        assert worker.exitcode == 1
+        assert ot._directory[0, 0, 0] == ot.POPULATING
+        ot.populator = populator
+        np.testing.assert_array_equal(ot[0:5, 0:5, 0:5], data[0:5, 0:5, 0:5])
+        assert populator.calls.value == ot.shared_leaves() == 1
+
+        # Volumes can also be shared by plain pickling, given a picklable
+        # populator. The copy reads the leaf populated here.
+        ot.populator = None
+        copy = pickle.loads(pickle.dumps(ot))
+        np.testing.assert_array_equal(copy[0:5, 0:5, 0:5], data[0:5, 0:5, 0:5])
+        copy.close()
+        assert os.path.exists(ot.path)
+
+        # Volumes backed by the same file in one process share its descriptor,
+        # so threads of each exclude each other, and closing one does not
+        # release the slot locks held by the others.
+        claimed = threading.Event()
+        release = threading.Event()
+
+        def blocking_populator(bounds):
+            claimed.set()
+            release.wait(30)
+            return populator(bounds)
+
+        copy = pickle.loads(pickle.dumps(ot))
+        other = pickle.loads(pickle.dumps(ot))
+        assert copy._shared is other._shared is ot._shared
+        ot.populator = blocking_populator
+        copy.populator = populator
+        writer = threading.Thread(target=lambda: ot[5:10, 0:5, 0:5])
+        writer.start()
+        assert claimed.wait(30)
+        reader = threading.Thread(target=lambda: copy[5:10, 0:5, 0:5])
+        reader.start()
+        other.close()
+        slot = int(np.ravel_multi_index((1, 0, 0), ot.grid_shape))
+        worker = multiprocessing.Process(target=lock_shared_octree_slot, args=(ot, slot, results))
+        worker.start()
+        assert results.get(True, 30) is False
+        worker.join()
+        release.set()
+        writer.join(30)
+        reader.join(30)
+        np.testing.assert_array_equal(copy[5:10, 0:5, 0:5], data[5:10, 0:5, 0:5])
+        assert populator.calls.value == ot.shared_leaves() == 2
+        copy.close()
+    finally:
+        ot.close()
+
+    # Leaves populated concurrently are also populated into the shared file.
+    populator = CountingPopulator(data)
+    ot = octrees.SharedOctreeVolume([5, 5, 5], (np.zeros(3), np.array(data.shape)), np.float32,
+                                    populator=populator, populator_threads=4)
+    try:
+        np.testing.assert_array_equal(ot[:], data)
+        assert populator.calls.value == ot.shared_leaves() == 4 * 4 * 4
+    finally:
+        ot.close()
+
+
+def test_octree_thread_safe_stress():
+    shape = (40, 64, 64)
+    data = np.random.RandomState(0).rand(*shape).astype(np.float32)
+
+    def populator(bounds):
+        return data[tuple(map(slice, bounds[0], bounds[1]))]
+
+    num_threads = 8
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        # A small cache and frequent compression make readers race with
+        # eviction and compression, as well as with writers.
+        ot = engine([5, 8, 8], (np.zeros(3), np.array(shape)), np.float32, populator=populator,
+                    leaf_cache=data.nbytes // 8, compress_after=7, thread_safe=True)
+        # Each thread writes only to its own slab of the lower half, and all
+        # threads read from the upper half.
+        expected = data.copy()
+        errors = []
+
+        def hammer(t):
+            try:
+                rng = np.random.RandomState(t)
+                slab = (0, 8 * t)
+                for _ in range(100):
+                    size = rng.randint(1, [13, 9, 20])
+                    start = [rng.randint(20, 41 - size[0]), rng.randint(0, 65 - size[1]), rng.randint(0, 65 - size[2])]
+                    key = tuple(slice(s, s + z) for s, z in zip(start, size))
+                    np.testing.assert_array_equal(ot[key], data[key])
+
+                    size = rng.randint(1, [13, 9, 20])
+                    start = [slab[0] + rng.randint(0, 21 - size[0]), slab[1] + rng.randint(0, 9 - size[1]),
+                             rng.randint(0, 65 - size[2])]
+                    key = tuple(slice(s, s + z) for s, z in zip(start, size))
+                    value = rng.rand(*size).astype(np.float32) if rng.rand() < 0.7 else np.float32(rng.rand())
+                    ot[key] = value
+                    expected[key] = value
+                    np.testing.assert_array_equal(ot[key], expected[key])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=hammer, args=(t,)) for t in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors, errors
+        np.testing.assert_array_equal(ot[:, :, :], expected)
+        assert ot.leaf_cache.evictions > 0, 'Stress test should evict leaves.'
+
+        # Writers evict leaves of other volumes sharing their cache only after
+        # releasing their own lock, so do not deadlock with writers to those.
+        cache = octrees.LeafCache(data.nbytes)
+        a, b = [engine([5, 8, 8], (np.zeros(3), np.array(shape)), np.float32, populator=populator,
+                       leaf_cache=cache, thread_safe=True) for _ in range(2)]
+        b[0:10, 0:16, 0:16]
+        cache.max_bytes = 0
+        with b.locked():
+            writer = threading.Thread(target=a.__setitem__, args=((0, 0, 0), 1.0))
+            writer.daemon = True
+            writer.start()
+            while not cache.evictions:
+                time.sleep(0.001)
+            acquired = a.locked().acquire(timeout=10)
+            assert acquired, 'Writer should not hold its lock while evicting.'
+            a.locked().release()
+        writer.join(10)
+        assert not writer.is_alive() and not len(cache)
+
+
+def test_octree_from_dense():
+    data = np.full((20, 18, 23), np.NAN, dtype=np.float32)
+    data[5:10, 5:10, 5:10] = 1.0
+    data[11:14, 2:9, 13:17] = np.random.RandomState(0).rand(3, 7, 4)
+    data[15:20, 15:18, 20:23] = 2.0
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ot = engine.from_dense(data, [5, 5, 5], default=np.NAN)
+        np.testing.assert_array_equal(ot[:, :, :], data)
+        # Only the leaves intersecting the random block are not uniform.
+        assert len(list(ot.iter_leaves())) == 4
+        np.testing.assert_array_equal(ot.get_leaf_bounds(), [[5, 0, 5], [20, 18, 23]])
+
+        out = np.zeros((5, 8, 9), dtype=np.float32)
+        bounds = (np.array([10, 3, 12]), np.array([15, 11, 21]))
+        assert ot.to_dense(out=out, bounds=bounds) is out
+        np.testing.assert_array_equal(out, data[10:15, 3:11, 12:21])
+        np.testing.assert_array_equal(ot.to_dense(), data)
+
+        ot = engine.from_dense(np.zeros((8, 8, 8), dtype=np.uint8), [2, 2, 2], offset=[4, 0, 0])
+        assert ot.fullness() == 0.0
+        np.testing.assert_array_equal(ot[4:12, 0:8, 0:8], 0)
+
+
+def test_octree_set_algebra():
+    rng = np.random.RandomState(0)
+    a = np.zeros((20, 18, 23), dtype=np.bool_)
+    a[2:9, 3:12, 4:20] = rng.rand(7, 9, 16) > 0.3
+    a[10:20, 10:15, 0:10] = True
+    b = np.zeros_like(a)
+    b[5:16, 0:18, 10:23] = rng.rand(11, 18, 13) > 0.5
+
+    def unreadable(bounds):
+        raise AssertionError('Uniform false regions should not be read.')
+
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        ota = engine.from_dense(a, [5, 5, 5], default=False)
+        otb = engine.from_dense(b, [5, 5, 5], default=False)
+        for other in [otb, b]:
+            np.testing.assert_array_equal(ota.logical_and(other)[:, :, :], a & b)
+            np.testing.assert_array_equal(ota.logical_or(other)[:, :, :], a | b)
+            np.testing.assert_array_equal(ota.logical_andnot(other)[:, :, :], a & ~b)
+        result = ota.logical_and(otb)
+        assert result.background is False
+        np.testing.assert_array_equal(result.get_leaf_bounds(), [[5, 0, 10], [10, 15, 20]])
+
+        # The other operand is only read where this volume is occupied.
+        sparse = engine([5, 5, 5], (np.zeros(3), np.array(a.shape)), np.bool_, populator=unreadable)
+        sparse[:] = False
+        sparse[0:5, 0:5, 0:5] = True
+        lazy = engine.from_dense(b, [5, 5, 5], default=False)
+        lazy.populator = unreadable
+        lazy.discard_leaves(lazy.get_checked_np_key((slice(5, 20), slice(0, 18), slice(0, 23))))
+        assert not sparse.logical_and(lazy).any()
+
+        labels = engine.from_dense(np.zeros(a.shape, dtype=np.uint64), [5, 5, 5])
+        assert labels.masked_assign(ota, 3) == np.count_nonzero(a)
+        values = np.arange(a.size, dtype=np.uint64).reshape(a.shape)
+        assert labels.masked_assign(b, values) == np.count_nonzero(b)
+        expected = np.where(a, 3, 0).astype(np.uint64)
+        expected[b] = values[b]
+        np.testing.assert_array_equal(labels[:, :, :], expected)
+
+        # Unpopulated leaves are read through the populator.
+        def populator(bounds):
+            return a[tuple(map(slice, bounds[0], bounds[1]))]
+
+        def unpopulated():
+            return engine([5, 5, 5], (np.zeros(3), np.array(a.shape)), np.bool_, populator=populator)
+
+        np.testing.assert_array_equal(unpopulated().logical_or(np.ones_like(a))[:, :, :], np.ones_like(a))
+        np.testing.assert_array_equal(unpopulated().logical_and(otb)[:, :, :], a & b)
+        labels = engine.from_dense(np.zeros(a.shape, dtype=np.uint64), [5, 5, 5])
+        assert labels.masked_assign(unpopulated(), 3) == np.count_nonzero(a)
+        np.testing.assert_array_equal(labels[:, :, :], np.where(a, 3, 0))
+        labels = engine([5, 5, 5], (np.zeros(3), np.array(a.shape)), np.uint64,
+                        populator=lambda bounds: np.zeros(tuple(bounds[1] - bounds[0]), dtype=np.uint64))
+        assert labels.masked_assign(b, 3) == np.count_nonzero(b)
+        np.testing.assert_array_equal(labels[:, :, :], np.where(b, 3, 0))
+
+
+def test_octree_access_profile():
+    for engine in [octrees.OctreeVolume, octrees.FlatOctreeVolume]:
+        calls = []
+
+        def populator(bounds):
+            calls.append(bounds)
+            return np.zeros(tuple(bounds[1] - bounds[0]), dtype=np.float32)
+
+        v = engine([4, 4, 4], (np.zeros(3), np.array([16, 64, 64])), np.float32, populator=populator)
+        profile = v.profile_accesses(chunk_shape=[1, 16, 16])
+        rng = np.random.RandomState(0)
+        for _ in range(50):
+            lower = rng.randint(0, [12, 48, 48])
+            v[tuple(map(slice, lower, lower + [4, 16, 16]))]
+
+        assert len(profile) == 50
+        assert profile.key_shapes() == {(4, 16, 16): 50}
+        # With leaves never evicted, the profile predicts populator calls.
+        assert profile.evaluate(v.leaf_shape)[0] == len(calls)
+        # Leaves aligned to chunks do not read chunks more than once.
+        assert profile.evaluate([4, 16, 16])[1] <= profile.evaluate([4, 12, 12])[1]
+        recommended = profile.recommend_leaf_shape()
+        np.testing.assert_array_equal(recommended % [1, 16, 16], 0)
+        assert profile.evaluate(recommended)[0] < len(calls)
+
+
+def test_move_leaf_shape():
+    fov_shapes = [np.array([13, 33, 33]), np.array([9, 17, 33])]
+    step = np.array([3, 8, 8])
+    for offset in [np.array([0, 0, 0]), np.array([2, 5, 7])]:
+        leaf_shape = regions.get_move_leaf_shape(fov_shapes, step, offset)
+        np.testing.assert_array_equal(leaf_shape % step, 0)
+        for fov in fov_shapes:
+            counts = []
+            for pos in itertools.product(*[range(n // s) for n, s in zip(leaf_shape, step)]):
+                block_min = offset + np.array(pos) * step - (fov - 1) // 2
+                counts.append((block_min + fov - 1) // leaf_shape - block_min // leaf_shape + 1)
+            assert np.all(np.array(counts).mean(axis=0) <= 1.5)
+            assert np.all(np.array(counts) <= 2)
+
+
+def test_move_queue():
+    q = regions.MoveQueue()
+    assert q.put(0.5, (0, 0, 1))
+    assert q.put(-0.5, (0, 0, 2))
+    assert q.put(0.5, (0, 0, 0))
+    assert q.put(0.1, (1, 0, 0))
+    # Priorities of queued moves can only be decreased.
+    assert not q.put(0.2, (1, 0, 0))
+    assert q.put(-1.0, (1, 0, 0))
+    q.remove((0, 0, 2))
+    assert len(q) == 3
+    assert (0, 0, 2) not in q
+    assert q.pop() == (-1.0, (1, 0, 0))
+    assert q.pop_batch(5) == [(0.5, (0, 0, 0)), (0.5, (0, 0, 1))]
+    assert not q
+    try:
+        q.pop()
+        assert False, 'Expected empty queue to raise.'
+    except IndexError:
+        pass
+
+
+def test_move_grid():
+    bounds = (np.array([-2, 0, 1]), np.array([3, 4, 5]))
+    for max_dense in [2**24, 0]:
+        grid = regions.MoveGrid(bounds, np.uint16, 0, max_dense=max_dense)
+        assert (grid.values is None) == (max_dense == 0)
+        grid[np.array([-2, 0, 1])] = 3
+        grid[(2, 3, 4)] = 5
+        assert grid[(-2, 0, 1)] == 3
+        assert grid[np.array([2, 3, 4])] == 5
+        assert grid[(0, 0, 1)] == 0
+        grid[(2, 3, 4)] = 0
+        assert grid[(2, 3, 4)] == 0
+
+
+class MaskEchoModel(object):
+    """Deterministic stand-in for a network, predicting each move independently."""
+
+    def __init__(self):
+        self.batches = 0
+
+    def predict_on_batch(self, inputs):
+        self.batches += 1
+        image = inputs['image_input']
+        mask = inputs['mask_input']
+        margin = (np.array(image.shape[1:4]) - CONFIG.model.output_fov_shape) // 2
+        key = (slice(None),) + tuple(map(slice, margin, margin + CONFIG.model.output_fov_shape))
+        noise = np.sin(mask.sum(axis=(1, 2, 3, 4)))[:, np.newaxis, np.newaxis, np.newaxis]
+        return (0.92 * image[key] + 0.05 * (mask[key] > 0.5) + 0.01 * noise[..., np.newaxis]).astype(np.float32)
+
+
+def test_region_speculative_fill():
+    shape = CONFIG.model.input_fov_shape * 3
+    rng = np.random.RandomState(0)
+    image = (rng.rand(*(shape // 3)) > 0.4).repeat(3, axis=0).repeat(3, axis=1).repeat(3, axis=2)
+    image = image.astype(np.float32)
+    seed = shape // 2
+    image[tuple(seed)] = 1
+
+    masks = []
+    batches = []
+    for batch_size, speculative in [(1, False), (16, True)]:
+        region = regions.Region(image, seed_vox=seed)
+        region.bias_against_merge = True
+        model = MaskEchoModel()
+        for _ in region.fill(model, move_batch_size=batch_size, speculative=speculative, generator=True):
+            pass
+        masks.append(region.mask)
+        batches.append(model.batches)
+
+    np.testing.assert_array_equal(masks[1], masks[0])
+    assert batches[1] < batches[0]
+
+    # Filling also stops and remasks after the same moves.
+    for kwargs in [{'remask_interval': 5}, {'max_moves': 20}]:
+        masks = []
+        moves = []
+        for batch_size, speculative in [(1, False), (16, True)]:
+            region = regions.Region(image, seed_vox=seed)
+            region.bias_against_merge = True
+            count = 0
+            try:
+                for batch_block_data, _ in region.fill(MaskEchoModel(), move_batch_size=batch_size,
+                                                       speculative=speculative, generator=True, **kwargs):
+                    count += len(batch_block_data)
+            except regions.Region.EarlyFillTermination:
+                pass
+            masks.append(region.mask)
+            moves.append(count)
+
+        np.testing.assert_array_equal(masks[1], masks[0])
+        assert moves[1] == moves[0]
+
+
+def test_region_fill_scheduler():
+    shape = CONFIG.model.input_fov_shape * 2
+    rng = np.random.RandomState(0)
+    images = [(rng.rand(*(shape // 2)) > 0.3).repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+              .astype(np.float32) for _ in range(3)]
+    for image in images:
+        image[tuple(shape // 2)] = 1
+
+    separate_model = MaskEchoModel()
+    separate = []
+    for image in images:
+        region = regions.Region(image, seed_vox=shape // 2)
+        for _ in region.fill(separate_model, generator=True):
+            pass
+        separate.append(region.mask)
+
+    def make_regions():
+        yield regions.Region(images[0], seed_vox=shape // 2)
+        # No region is available for a step.
+        yield None
+        for image in images[1:]:
+            yield regions.Region(image, seed_vox=shape // 2)
+
+    shared_model = MaskEchoModel()
+    scheduler = regions.RegionFillScheduler(shared_model, 2)
+    finished = list(scheduler.fill(make_regions()))
+    assert len(finished) == 3
+    assert not any(early for _, early in finished)
+    masks = {id(region.image): region.mask for region, _ in finished}
+    for image, mask in zip(images, separate):
+        np.testing.assert_array_equal(masks[id(image)], mask)
+    assert shared_model.batches < separate_model.batches
+    assert not scheduler.active
+
+
+def test_batch_input_buffers():
+    shape = CONFIG.model.input_fov_shape * 2
+    image = np.random.RandomState(0).rand(*shape).astype(np.float32)
+    region = regions.Region(image, seed_vox=shape // 2)
+    region.mask[:] = np.random.RandomState(1).rand(*shape)
+    positions = [region.seed_pos, region.seed_pos + 1, region.seed_pos - 1]
+
+    buffers = regions.BatchInputBuffers(len(positions))
+    allocated = [region.get_move_block(pos) for pos in positions]
+    buffered = [region.get_move_block(pos, buffers, n) for n, pos in enumerate(positions)]
+    expected = regions.get_batch_inputs(allocated)
+    inputs = regions.get_batch_inputs(buffered)
+    for k in ['image_input', 'mask_input']:
+        np.testing.assert_array_equal(inputs[k], expected[k])
+    assert np.shares_memory(inputs['image_input'], buffers.image)
+    assert not np.shares_memory(regions.get_batch_inputs(buffered[1:])['image_input'], buffers.image)
+
+    # Blocks read without buffers do not modify the mask they are read from.
+    region = regions.Region(image, seed_vox=shape // 2, sparse_mask=True)
+    region.mask[tuple(map(slice, shape // 4, shape // 2))] = 0.75
+    mask = region.mask.to_dense()
+    for pos in positions:
+        block = region.get_move_block(pos)
+        assert not np.isnan(block['mask']).any()
+    np.testing.assert_array_equal(region.mask.to_dense(), mask)
+
+
+def test_region_block_padding():
+    shape = CONFIG.model.input_fov_shape + CONFIG.model.move_step * 2
+    rng = np.random.RandomState(0)
+    image = rng.rand(*shape).astype(np.float32)
+    target = rng.rand(*shape).astype(np.float32)
+    target[tuple(shape // 2)] = CONFIG.model.v_true
+    sparse_image = octrees.OctreeVolume.from_dense(image, [5, 5, 5])
+
+    for mode in ['reflect', 'edge', 'symmetric', 'constant']:
+        padded = []
+        for volume, image_halo in [(image, False), (image, mode != 'constant'), (sparse_image, mode != 'constant')]:
+            region = regions.Region(volume, target=target, seed_vox=shape // 2, block_padding=mode,
+                                    image_halo=image_halo)
+            region.mask[:] = rng.rand(*shape)
+            positions = [np.array(p) for p in itertools.product(*[[0, b] for b in region.vox_to_pos(shape - 1)])]
+            blocks = [region.get_move_block(pos) for pos in positions]
+            padded.append(blocks)
+
+            for pos, block in zip(positions, blocks):
+                block_min, block_max, pad_pre, pad_post = region.get_block_bounds(
+                        region.pos_to_vox(pos), CONFIG.model.input_fov_shape)
+                key = tuple(map(slice, block_min, block_max))
+                pad_width = list(zip(pad_pre, pad_post))
+                np.testing.assert_array_equal(block['image'], np.pad(image[key], pad_width, mode))
+                np.testing.assert_array_equal(block['mask'], np.pad(np.asarray(region.mask[key]), pad_width, mode))
+
+        for blocks in padded[1:]:
+            for block, expected in zip(blocks, padded[0]):
+                np.testing.assert_array_equal(block['target'], expected['target'])
+
+    # Halo tiles are only padded where blocks are read across faces.
+    halo = regions.ImageHalo(image, 'reflect')
+    halo.read(np.array([1, 1, 1]), np.array([4, 4, 4]))
+    assert not halo.tiles
+    margin = halo.margin
+    expected = np.pad(image, list(zip(margin, margin)), 'reflect')[
+            margin[0] - 1:margin[0] + 2, margin[1]:margin[1] + 3, margin[2]:margin[2] + 3]
+    np.testing.assert_array_equal(halo.read(np.array([-1, 0, 0]), np.array([2, 3, 3])), expected)
+    assert list(halo.tiles) == [(0, (0, 0, 0))]
+
+    # Tiles of octree images span only leaves near the blocks read.
+    halo = regions.ImageHalo(sparse_image, 'reflect', tile_shape=[5, 5, 5])
+    expected = np.pad(image, list(zip(margin, margin)), 'reflect')[
+            margin[0] - 1:margin[0] + 2, margin[1] + 3:margin[1] + 7, margin[2] + 3:margin[2] + 7]
+    np.testing.assert_array_equal(halo.read(np.array([-1, 3, 3]), np.array([2, 7, 7])), expected)
+    assert len(halo.tiles) == 4
+    assert all(tile.shape[1:] == (5, 5) for tile in halo.tiles.values())
+
+
+def test_region_remask():
+    shape = CONFIG.model.input_fov_shape * 3
+    rng = np.random.RandomState(0)
+    image = (rng.rand(*(shape // 3)) > 0.5).repeat(3, axis=0).repeat(3, axis=1).repeat(3, axis=2)
+    image = image.astype(np.float32)
+    seed = shape // 2
+    image[tuple(seed)] = 1
+    rng = np.random.RandomState(0)
+    sparse_image = (rng.rand(*(shape // 3)) > 0.7).repeat(3, axis=0).repeat(3, axis=1).repeat(3, axis=2)
+    sparse_image = sparse_image.astype(np.float32)
+    sparse_image[tuple(seed)] = 1
+
+    for sparse_mask in [False, True]:
+        region = regions.Region(image, seed_vox=seed, sparse_mask=sparse_mask)
+        # Remask incrementally while filling.
+        for _ in region.fill(MaskEchoModel(), generator=True, remask_interval=5):
+            pass
+
+        body = region.to_body()
+        component, bounds = body.get_seeded_component()
+        expected = np.zeros(tuple(shape), dtype=np.bool_)
+        expected[tuple(map(slice, bounds[0], bounds[1]))] = component
+        assert np.count_nonzero(np.asarray(body.mask[:, :, :])) > np.count_nonzero(expected), \
+            'Mask should have components not connected to the seed.'
+
+        assert region.remask()
+        np.testing.assert_array_equal(np.asarray(region.mask[:, :, :]) >= CONFIG.model.t_final, expected)
+
+        # Remasking incrementally gives the same mask as remasking the whole
+        # body, including the values outside the seeded component that later
+        # moves are biased against and read as input. A sparser image keeps
+        # the thresholded bounds smaller than the filled volume.
+        masks = []
+        for track in [True, False]:
+            region = regions.Region(sparse_image, seed_vox=seed, sparse_mask=sparse_mask)
+            region.bias_against_merge = True
+            if not track:
+                region.component_tracker = None
+            for _ in region.fill(MaskEchoModel(), generator=True, remask_interval=5):
+                pass
+            assert region.remask()
+            masks.append(np.asarray(region.mask[:, :, :]))
+        np.testing.assert_array_equal(masks[0], masks[1])
+
+
+def test_prediction_cache():
+    rng = np.random.RandomState(0)
+    blocks = [{'image': rng.rand(*CONFIG.model.input_fov_shape).astype(np.float32),
+               'mask': rng.rand(*CONFIG.model.input_fov_shape).astype(np.float32)}
+              for _ in range(3)]
+    model = MaskEchoModel()
+    expected = model.predict_on_batch(regions.get_batch_inputs(blocks))
+
+    cache = regions.PredictionCache(2**30)
+    np.testing.assert_array_equal(cache.predict(model, blocks), expected)
+    np.testing.assert_array_equal(cache.predict(model, blocks[::-1]), expected[::-1])
+    assert (cache.hits, cache.misses, len(cache)) == (3, 3, 3)
+    assert model.batches == 2
+
+    changed = dict(blocks[0], mask=blocks[0]['mask'] + 1e-3)
+    cache.predict(model, [changed])
+    assert cache.misses == 4
+    assert cache.predict(MaskEchoModel(), blocks[:1]) is not None
+    assert cache.misses == 5
+
+    binary = dict(blocks[0], mask=(blocks[0]['mask'] > 0.5).astype(np.float32))
+    near = dict(binary, mask=np.abs(binary['mask'] - 1e-3))
+    quantized = regions.PredictionCache(2**30, mask_levels=3)
+    quantized.predict(model, [binary])
+    quantized.predict(model, [near])
+    assert (quantized.hits, quantized.misses) == (1, 1)
+
+    small = regions.PredictionCache(2 * expected[0].nbytes)
+    small.predict(model, blocks)
+    assert len(small) == 2
+    assert small.evictions == 1
+    assert small.nbytes <= small.max_bytes
+    small.predict(model, blocks[:1])
+    assert small.hits == 0
+
+    # Refilling a region from its seed predicts nothing new.
+    shape = CONFIG.model.input_fov_shape * 2
+    image = (rng.rand(*(shape // 2)) > 0.3).repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+    image = image.astype(np.float32)
+    image[tuple(shape // 2)] = 1
+    region = regions.Region(image, seed_vox=shape // 2)
+    cache = regions.PredictionCache(2**30)
+    for _ in region.fill(model, generator=True, prediction_cache=cache):
+        pass
+    misses = cache.misses
+    refill = region.unfilled_copy()
+    for _ in refill.fill(model, generator=True, prediction_cache=cache):
+        pass
+    np.testing.assert_array_equal(refill.mask, region.mask)
+    assert cache.misses == misses
+    assert cache.hits >= misses
+
+
 def test_region_moves():
     mock_image = np.zeros(tuple(CONFIG.model.training_subv_shape), dtype=np.float32)
     region = regions.Region(mock_image)
@@ -115,6 +1139,20 @@ def test_region_moves():
     for move in moves:
         np.testing.assert_allclose(expected_moves[tuple(move['move'])], move['v'])
 
+    # Batched move extraction matches adding masks one at a time.
+    mock_image = np.zeros(tuple(CONFIG.model.input_fov_shape * 3), dtype=np.float32)
+    sequential = regions.Region(mock_image)
+    batched = regions.Region(mock_image)
+    rng = np.random.RandomState(0)
+    masks = rng.rand(*((6,) + tuple(CONFIG.model.output_fov_shape))).astype(np.float32)
+    positions = [sequential.seed_pos + rng.randint(-2, 3, size=3) for _ in range(len(masks))]
+    for mask, pos in zip(masks, positions):
+        sequential.add_mask(mask, pos)
+    batched.add_masks(masks, positions)
+    np.testing.assert_array_equal(batched.visited.values, sequential.visited.values)
+    np.testing.assert_array_equal(batched.mask, sequential.mask)
+    assert sorted(batched.queue.entries.values()) == sorted(sequential.queue.entries.values())
+
 
 def test_volume_transforms():
     mock_image = np.arange(64 * 64 * 64, dtype=np.uint8).reshape((64, 64, 64))
@@ -137,6 +1175,16 @@ def test_volume_transforms():
 
     np.testing.assert_array_equal(dpsv.image, sv.image.reshape((1, 4, 1, 4, 1, 1)).mean(5).mean(3).mean(1))
 
+    # Downsampled sparse volumes read images from octree mips.
+    spv = v.sparse_wrapper([8, 8, 8], [8, 8, 8]).partition([1, 1, 2], [0, 0, 1]).downsample((4, 4, 1))
+    dpsvb = volumes.SubvolumeBounds(np.array((0, 0, 0), dtype=np.int64),
+                                    np.array((8, 8, 4), dtype=np.int64))
+    spsv = spv.get_subvolume(dpsvb)
+    dpsv = dpv.get_subvolume(dpsvb)
+    np.testing.assert_allclose(spsv.image, dpsv.image, rtol=1e-6)
+    np.testing.assert_array_equal(spsv.label_mask, dpsv.label_mask)
+    assert spv.image_data._mips, 'Image should be read from a mip.'
+
 
 def test_volume_transforms_image_stacks():
     # stack info